@@ -0,0 +1,223 @@
+"""
+asyncio front end for sqlite-schemaless.
+
+Every database call is run on a dedicated executor, so a coroutine awaiting a
+query never blocks the event loop. By default the executor has a single
+thread, which owns the connection for the lifetime of the database. Rows and
+queries returned by the async API are thin wrappers around the objects in
+`schemaless`, so indexes and query expressions are shared between the two.
+
+    db = AsyncSchemaless('app.db')
+    users = db.keyspace('users', username_idx)
+    await users.create()
+
+    row = await users.create_row(user={'username': 'huey'})
+    await row.get('user')
+
+    async for row in users.query(username_idx == 'huey'):
+        ...
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from schemaless import Schemaless
+
+
+class AsyncSchemaless(object):
+    def __init__(self, filename, workers=1, loop=None, **kwargs):
+        # Using more than one worker requires an on-disk database, since
+        # each worker thread opens its own connection. Pass `readers` to
+        # share a pool of connections between the workers.
+        self.db = Schemaless(filename, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.loop = loop
+
+    def run(self, fn, *args, **kwargs):
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        return self.loop.run_in_executor(
+            self.executor,
+            functools.partial(fn, *args, **kwargs))
+
+    async def close(self):
+        await self.run(self.db.close)
+        self.executor.shutdown()
+
+    def keyspace(self, name, *indexes, **options):
+        return AsyncKeySpace(self, self.db.keyspace(name, *indexes, **options))
+
+    def _wrap_handler(self, fn):
+        # Handlers run on the thread that wrote the row (or on the event
+        # dispatcher). If a handler returns a coroutine, it is scheduled on
+        # the event loop instead, and is not awaited by the writer.
+        def wrapper(*args):
+            result = fn(*args)
+            if asyncio.iscoroutine(result):
+                asyncio.run_coroutine_threadsafe(result, self.loop)
+            else:
+                return result
+        return wrapper
+
+    def handler(self, *keyspaces, **kwargs):
+        columns = kwargs.pop('columns', None)
+        def decorator(fn):
+            wrapper = self._wrap_handler(fn)
+            for keyspace in keyspaces:
+                self.db.bind_handler(keyspace.keyspace, wrapper, columns)
+            return fn
+        return decorator
+
+
+class AsyncKeySpace(object):
+    def __init__(self, database, keyspace):
+        self.database = database
+        self.keyspace = keyspace
+
+    @property
+    def name(self):
+        return self.keyspace.name
+
+    async def create(self):
+        await self.database.run(self.keyspace.create)
+
+    async def drop(self):
+        await self.database.run(self.keyspace.drop)
+
+    def handler(self, fn=None, columns=None):
+        if fn is None:
+            return lambda fn: self.handler(fn, columns)
+        wrapper = self.database._wrap_handler(fn)
+        self.keyspace.handler(wrapper, columns)
+        fn.unbind = wrapper.unbind
+        return fn
+
+    def __getitem__(self, identifier):
+        return AsyncRow(self, self.keyspace[identifier])
+
+    async def get_row(self, identifier, preload=None):
+        row = await self.database.run(
+            self.keyspace.get_row,
+            identifier,
+            preload)
+        return AsyncRow(self, row)
+
+    async def get_many(self, row_keys, columns=None, chunk_size=500):
+        result = await self.database.run(
+            self.keyspace.get_many,
+            list(row_keys),
+            columns,
+            chunk_size)
+        return result._replace(
+            rows=[AsyncRow(self, row) for row in result.rows])
+
+    async def create_row(self, **data):
+        row = await self.database.run(self.keyspace.create_row, **data)
+        return AsyncRow(self, row)
+
+    async def create_rows(self, rows, chunk_size=500):
+        return await self.database.run(
+            self.keyspace.create_rows,
+            list(rows),
+            chunk_size)
+
+    async def delete(self, identifier):
+        return await self.database.run(self.keyspace.__delitem__, identifier)
+
+    def all(self, batch_size=100):
+        return AsyncQuery(self, self.keyspace.all(), batch_size)
+
+    def query(self, index_query, batch_size=100):
+        return AsyncQuery(self, index_query, batch_size)
+
+
+class AsyncQuery(object):
+    # Rows are fetched `batch_size` at a time on the executor, so iterating
+    # a large result does not load it all at once. Each batch is a separate
+    # query resuming after the last row_key of the previous one, so batches
+    # may run on any worker and no read transaction is held across awaits.
+    def __init__(self, keyspace, query, batch_size=100):
+        self.keyspace = keyspace
+        self.query = query
+        self.batch_size = batch_size
+
+    def _wrap(self, query):
+        return AsyncQuery(self.keyspace, query, self.batch_size)
+
+    def limit(self, limit):
+        return self._wrap(self.query.limit(limit))
+
+    def after(self, row_key):
+        return self._wrap(self.query.after(row_key))
+
+    def before(self, row_key):
+        return self._wrap(self.query.before(row_key))
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        run = self.keyspace.database.run
+        remaining = self.query._limit
+        query = self.query
+        while remaining is None or remaining > 0:
+            count = self.batch_size
+            if remaining is not None:
+                count = min(count, remaining)
+                remaining -= count
+            batch = await run(list, query.limit(count))
+            for row in batch:
+                yield AsyncRow(self.keyspace, row)
+            if len(batch) < count:
+                break
+            if query.reverse:
+                query = query.before(batch[-1].identifier)
+            else:
+                query = query.after(batch[-1].identifier)
+
+    def __await__(self):
+        return self._all().__await__()
+
+    async def _all(self):
+        rows = await self.keyspace.database.run(list, self.query)
+        return [AsyncRow(self.keyspace, row) for row in rows]
+
+
+class AsyncRow(object):
+    def __init__(self, keyspace, row):
+        self.keyspace = keyspace
+        self.row = row
+
+    @property
+    def identifier(self):
+        return self.row.identifier
+
+    def _run(self, fn, *args):
+        return self.keyspace.database.run(fn, *args)
+
+    async def get(self, column):
+        return await self._run(self.row.__getitem__, column)
+
+    async def set(self, column, value):
+        await self._run(self.row.__setitem__, column, value)
+
+    async def remove(self, column):
+        await self._run(self.row.__delitem__, column)
+
+    async def multi_get(self, columns):
+        return await self._run(self.row.multi_get, columns)
+
+    async def multi_set(self, data):
+        await self._run(self.row.multi_set, data)
+
+    async def items(self):
+        return await self._run(lambda: dict(self.row.items()))
+
+    async def delete(self):
+        return await self._run(self.row.delete)
+
+    async def history(self, column):
+        return await self._run(self.row.history, column)
+
+    async def as_of(self, timestamp, columns=True):
+        return await self._run(self.row.as_of, timestamp, columns)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the JSON codecs supported by `Schemaless(json_codec=...)`.
+
+For each codec that is installed, this times encoding and decoding a typical
+document, then writing and reading rows through a keyspace:
+
+    python bench.py -n 20000
+"""
+import optparse
+import time
+
+from schemaless import get_json_codec
+from schemaless import Index
+from schemaless import JSON_CODECS
+from schemaless import Schemaless
+
+
+DOCUMENT = {
+    'url': '/blog/sqlite-schemaless/',
+    'title': 'Building a schemaless database on top of SQLite',
+    'ip': '127.0.0.1',
+    'timestamp': 1500000000.123,
+    'referrer': 'https://news.ycombinator.com/',
+    'headers': dict(('X-Header-%s' % i, 'value %s' % i) for i in range(20)),
+    'params': {'q': ['sqlite', 'json'], 'page': 2, 'debug': False},
+}
+
+
+def timed(fn, *args):
+    start = time.time()
+    fn(*args)
+    return time.time() - start
+
+
+def bench_codec(codec, n):
+    text = codec.dumps(DOCUMENT)
+    return (
+        timed(lambda: [codec.dumps(DOCUMENT) for i in range(n)]),
+        timed(lambda: [codec.loads(text) for i in range(n)]))
+
+
+def bench_keyspace(name, n):
+    db = Schemaless(':memory:', json_codec=name)
+    url_idx = Index('pageview', '$.url')
+    pageviews = db.keyspace('pageviews', url_idx)
+    pageviews.create()
+
+    write = timed(lambda: pageviews.create_rows(
+        {'pageview': DOCUMENT} for i in range(n)))
+    read = timed(lambda: [row['pageview'] for row in pageviews.all()])
+    db.close()
+    return write, read
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', type='int', default=10000,
+                      help='Number of documents (default 10000).')
+    options, args = parser.parse_args()
+
+    print('%-12s %10s %10s %12s %12s' % (
+        'codec', 'dumps', 'loads', 'write rows', 'read rows'))
+    for name in JSON_CODECS:
+        codec = get_json_codec(name)
+        if codec.name != name:
+            print('%-12s not installed' % name)
+            continue
+        dumps, loads = bench_codec(codec, options.n)
+        write, read = bench_keyspace(name, options.n)
+        print('%-12s %9.3fs %9.3fs %11.3fs %11.3fs' % (
+            name, dumps, loads, write, read))
+
+
+if __name__ == '__main__':
+    main()
@@ -35,7 +35,7 @@ database = Schemaless(DATABASE_FILE)
 
 # Define indexes on the `pageview` column.
 url_index = Index('pageview', '$.url')
-timestamp_index = Index('pageview', '$.timestamp')
+timestamp_index = Index('pageview', '$.timestamp', value_type='real')
 referer_index = Index('pageview', '$.Referer')
 
 # Define indexes on the `headers` column.
@@ -63,6 +63,11 @@ RefererHost = database.keyspace(
     rh_url_index)
 
 
+# Buffer page-views in memory and write them in batches, so that each request
+# does not pay for a commit of its own.
+pageview_writer = PageView.buffered(max_rows=500, max_delay=1.0)
+
+
 @app.route('/a.gif')
 def analyze():
     if not request.args.get('url'):
@@ -75,7 +80,7 @@ def analyze():
     # 1. pageview: generic data about the pageview.
     # 2. headers: request headers sent by user's browser.
     # 3. query: query-string parameters.
-    PageView.create_row(
+    pageview_writer.create_row(
         pageview={
             'ip': request.remote_addr,
             'url': parsed.path,
@@ -102,9 +107,9 @@ def not_found(e):
 # Here we will create an event handler so that whenver a pageview is created,
 # we will also store a mapping of the referer's host to the URL that was
 # visited.
-@PageView.handler
+@PageView.handler(columns=('pageview',))
 def store_referer_host(row_key, column, value):
-    if column == 'pageview' and value['referer']:
+    if value['referer']:
         parsed = urlparse(value['referer'])
         RefererHost.create_row(data={
             'referer_host': parsed.netloc,
@@ -120,4 +125,5 @@ if __name__ == '__main__':
     try:
         app.run()
     finally:
+        pageview_writer.close()  # Write any buffered page-views.
         database.close()  # Close database on exit.
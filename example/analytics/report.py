@@ -9,9 +9,10 @@ from analytics import PageView, RefererHost
 from analytics import url_index
 
 
-# Print all URLs viewed in the ordered in which they were viewed.
+# Print all URLs viewed in the ordered in which they were viewed. Only the URL
+# is read from each pageview, and the other columns are not read at all.
 print 'All URLs:'
-for pageview in PageView.all():
+for pageview in PageView.all().columns().paths('pageview', '$.url'):
     print pageview['pageview']['url']
 
 
@@ -19,12 +20,28 @@ for pageview in PageView.all():
 # corresponding title.
 print
 print 'URLs containing "sqlite":'
-for pageview in url_index.query('%sqlite%', 'LIKE'):
+query = (url_index
+         .query('%sqlite%', 'LIKE')
+         .columns()
+         .paths('pageview', '$.title'))
+for pageview in query:
     print pageview['pageview']['title']
 
 
 # Query for the referer hostnames and list the URLs visited.
 print
 print 'Referer host and URL:'
-for referer_host in RefererHost.all():
+query = (RefererHost
+         .all()
+         .columns()
+         .paths('data', '$.referer_host', '$.url'))
+for referer_host in query:
     print referer_host['data']['referer_host'], referer_host['data']['url']
+
+
+# Count the views for each URL, most popular first. The counts are computed
+# from the URL index alone.
+print
+print 'Views per URL:'
+for url, count in url_index.group_counts(limit=10):
+    print count, url
@@ -29,21 +29,43 @@ the JSON blobs.
 `sqlite-schemaless` also allows you to bind event handlers that will execute
 whenever data is inserted or updated in a keyspace.
 """
+import calendar
+import copy
+import datetime
+import heapq
+import itertools
+import logging
 import operator
 import re
 import sys
+import threading
+import struct
 import time
+import zlib
 from collections import defaultdict
 from collections import namedtuple
+from collections import OrderedDict
+from functools import reduce
+from multiprocessing.pool import ThreadPool
 
 from peewee import *
+from peewee import savepoint_sqlite
+from peewee import Func
 from peewee import sqlite3 as _sqlite3
 from playhouse.sqlite_ext import *
+try:
+    from queue import Full
+    from queue import Queue
+except ImportError:
+    from Queue import Full
+    from Queue import Queue
 
 
 if sys.version_info[0] == 3:
     basestring = str
 
+logger = logging.getLogger(__name__)
+
 
 USE_JSON_FALLBACK = True
 if _sqlite3.sqlite_version_info >= (3, 9, 0):
@@ -59,51 +81,766 @@ if _sqlite3.sqlite_version_info >= (3, 9, 0):
 split_re = re.compile('(?:(\[\d+\])|\.)')
 
 
-def _json_extract_fallback(json_text, path):
-    json_data = json.loads(json_text)
-    path = path.lstrip('$.')
-    parts = split_re.split(path)
-    for part in filter(None, parts):
+JSONCodec = namedtuple('JSONCodec', ('name', 'dumps', 'loads'))
+
+# JSON libraries in order of preference when the codec is "auto".
+JSON_CODECS = ('orjson', 'ujson', 'simplejson', 'json')
+
+
+def _load_json_codec(name):
+    if name == 'json':
+        return JSONCodec(name, json.dumps, json.loads)
+    elif name == 'orjson':
+        import orjson
+        # orjson encodes to bytes, which SQLite would store as a BLOB.
+        return JSONCodec(
+            name,
+            lambda obj: orjson.dumps(obj).decode('utf-8'),
+            orjson.loads)
+    module = __import__(name)
+    return JSONCodec(name, module.dumps, module.loads)
+
+
+def get_json_codec(name='auto'):
+    # Returns the named codec, falling back to the standard library if it
+    # is not installed.
+    if name == 'auto':
+        names = JSON_CODECS
+    elif name in JSON_CODECS:
+        names = (name, 'json')
+    else:
+        raise ValueError('Unrecognized JSON codec "%s", must be one of %s.' %
+                         (name, ', '.join(('auto',) + JSON_CODECS)))
+    for codec_name in names:
         try:
-            if part.startswith('['):
-                json_data = json_data[int(part.strip('[]'))]
+            return _load_json_codec(codec_name)
+        except ImportError:
+            if codec_name == name:
+                logger.warning('JSON codec "%s" is not installed, using '
+                               'json instead.', name)
+
+
+STDLIB_JSON = _load_json_codec('json')
+
+
+# Header byte of cells stored by BinaryStorage.
+STORAGE_RAW = 1
+STORAGE_ZLIB = 2
+
+
+def _decode_storage(value, zdicts):
+    # Returns the JSON text of a cell. Cells stored as text are returned
+    # unchanged, so keyspaces can hold a mix of both while being migrated.
+    if value is None or isinstance(value, basestring):
+        return value
+    data = bytes(value)
+    header, payload = ord(data[:1]), data[1:]
+    if header == STORAGE_ZLIB:
+        # A zlib stream compressed with a preset dictionary records the
+        # dictionary's adler32 checksum (RFC 1950), which is used to find it.
+        if ord(payload[1:2]) & 0x20:
+            dict_id = struct.unpack('>I', payload[2:6])[0]
+            if dict_id not in zdicts:
+                raise ValueError('Unknown compression dictionary %s.' %
+                                 dict_id)
+            payload = zlib.decompressobj(zdict=zdicts[dict_id]).decompress(
+                payload)
+        else:
+            payload = zlib.decompress(payload)
+    elif header != STORAGE_RAW:
+        raise ValueError('Unrecognized storage header %s.' % header)
+    return payload.decode('utf-8')
+
+
+class BinaryStorage(object):
+    # Stores cells as UTF-8 encoded JSON behind a header byte, compressing
+    # values of at least `threshold` bytes with zlib. A preset dictionary
+    # (`zdict`, e.g. a sample of typical documents) improves compression of
+    # small, repetitive values.
+    def __init__(self, compress=True, threshold=256, level=6, zdict=None):
+        self.compress = compress
+        self.threshold = threshold
+        self.level = level
+        self.zdict = zdict
+        self.zdicts = {}
+        if zdict is not None:
+            self.zdicts[zlib.adler32(zdict) & 0xffffffff] = zdict
+
+    def encode(self, text):
+        data = text.encode('utf-8')
+        if self.compress and len(data) >= self.threshold:
+            if self.zdict is not None:
+                compressor = zlib.compressobj(
+                    self.level, zlib.DEFLATED, zlib.MAX_WBITS, 8,
+                    zlib.Z_DEFAULT_STRATEGY, self.zdict)
             else:
-                json_data = json_data[part]
-        except (KeyError, IndexError):
-            return None
+                compressor = zlib.compressobj(self.level)
+            compressed = compressor.compress(data) + compressor.flush()
+            if len(compressed) < len(data):
+                return _sqlite3.Binary(struct.pack('B', STORAGE_ZLIB) +
+                                       compressed)
+        return _sqlite3.Binary(struct.pack('B', STORAGE_RAW) + data)
+
+    def decode(self, value):
+        return _decode_storage(value, self.zdicts)
+
+
+class _IntegerValueField(IntegerField):
+    # INTEGER affinity, but values are passed to SQLite unchanged, so a query
+    # operand of 2.5 is not truncated to 2 and a non-numeric operand is
+    # compared using SQLite's rules instead of raising.
+    def db_value(self, value):
+        return value
+
+    def python_value(self, value):
+        return value
+
+
+class _RealValueField(FloatField):
+    # REAL affinity, values passed through unchanged (see above).
+    def db_value(self, value):
+        return value
+
+    def python_value(self, value):
+        return value
+
+
+class _JSONField(JSONField):
+    # JSONField that encodes and decodes values using the given codec, and
+    # optionally stores them using a BinaryStorage.
+    def __init__(self, codec=STDLIB_JSON, storage=None, *args, **kwargs):
+        self.codec = codec
+        self.storage = storage
+        super(_JSONField, self).__init__(*args, **kwargs)
+
+    def clone_base(self, **kwargs):
+        return super(_JSONField, self).clone_base(
+            codec=self.codec,
+            storage=self.storage,
+            **kwargs)
+
+    def python_value(self, value):
+        if value is not None:
+            if not isinstance(value, basestring):
+                value = _decode_storage(
+                    value,
+                    self.model_class._meta.database._zdicts)
+            try:
+                return self.codec.loads(value)
+            except (TypeError, ValueError):
+                return value
+
+    def db_value(self, value):
+        if value is not None:
+            value = self.codec.dumps(value)
+            if self.storage is not None:
+                value = self.storage.encode(value)
+            return value
+
+
+_path_cache = {}
+
+
+def _compile_path(path):
+    # Split a JSON path into object keys and array indexes. Paths come from
+    # index definitions and queries, so each is only parsed once.
+    try:
+        return _path_cache[path]
+    except KeyError:
+        pass
+    keys = tuple(
+        int(part.strip('[]')) if part.startswith('[') else part
+        for part in split_re.split(path.lstrip('$.')) if part)
+    if len(_path_cache) >= 1000:
+        _path_cache.clear()
+    _path_cache[path] = keys
+    return keys
+
+
+_missing = object()
+
+
+def _lookup(json_data, path):
+    for key in _compile_path(path):
+        try:
+            json_data = json_data[key]
+        except (KeyError, IndexError, TypeError):
+            return _missing
     return json_data
 
 
+def _json_extract_fallback(json_text, path, loads=json.loads):
+    json_data = _lookup(loads(json_text), path)
+    return None if json_data is _missing else json_data
+
+
+def _sql_value(value):
+    # Objects and arrays are returned to SQLite as (minified) JSON text.
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, separators=(',', ':'))
+    return value
+
+
+def _json_type(value):
+    if value is None:
+        return 'null'
+    elif value is True:
+        return 'true'
+    elif value is False:
+        return 'false'
+    elif isinstance(value, int):
+        return 'integer'
+    elif isinstance(value, float):
+        return 'real'
+    elif isinstance(value, basestring):
+        return 'text'
+    return 'array' if isinstance(value, list) else 'object'
+
+
+class _JSONFunctions(object):
+    # Emulates the JSON1 functions used by schemaless when SQLite is built
+    # without them. The most recently parsed document is kept, so the index
+    # triggers fired by one write (and the several calls each trigger makes)
+    # only parse the value once.
+    def __init__(self, loads=json.loads, zdicts=None):
+        self.loads = loads
+        self.zdicts = zdicts if zdicts is not None else {}
+        self._local = threading.local()
+
+    def parse(self, json_text):
+        last = getattr(self._local, 'last', None)
+        if last is not None and last[0] == json_text:
+            return last[1]
+        json_data = self.loads(_decode_storage(json_text, self.zdicts))
+        self._local.last = (json_text, json_data)
+        return json_data
+
+    def extract(self, json_text, *paths):
+        # Several paths return a JSON array of the values.
+        if json_text is None:
+            return None
+        json_data = self.parse(json_text)
+        values = []
+        for path in paths:
+            value = _lookup(json_data, path)
+            values.append(None if value is _missing else value)
+        if len(paths) > 1:
+            return _sql_value(values)
+        return _sql_value(values[0])
+
+    def type(self, json_text, path='$'):
+        if json_text is None:
+            return None
+        value = _lookup(self.parse(json_text), path)
+        return None if value is _missing else _json_type(value)
+
+    def array_length(self, json_text, path='$'):
+        if json_text is None:
+            return None
+        value = _lookup(self.parse(json_text), path)
+        if value is _missing:
+            return None
+        return len(value) if isinstance(value, list) else 0
+
+    def each(self, json_text, path):
+        # Return the values json_each() would produce for the given path:
+        # the elements of an array, the members of an object or the value
+        # itself. Nested containers are returned as JSON text.
+        json_data = _lookup(self.parse(json_text), path)
+        if json_data is None or json_data is _missing:
+            return []
+        elif isinstance(json_data, dict):
+            json_data = list(json_data.values())
+        elif not isinstance(json_data, list):
+            json_data = [json_data]
+        return [_sql_value(item) for item in json_data]
+
+    def register(self, database, fallback):
+        # schemaless_extract() is json_extract() for binary storage.
+        database.func('schemaless_extract')(self.extract)
+        if fallback:
+            database.func('json_extract')(self.extract)
+            database.func('json_type')(self.type)
+            database.func('json_array_length')(self.array_length)
+
+
+def _set_path(data, path, value):
+    # Store a value at a JSON path, creating the objects and arrays that
+    # contain it.
+    keys = _compile_path(path)
+    if not keys:
+        return value
+    if data is None:
+        data = [] if isinstance(keys[0], int) else {}
+    container = data
+    for i, key in enumerate(keys):
+        if isinstance(key, int):
+            container.extend([None] * (key + 1 - len(container)))
+        else:
+            container.setdefault(key, None)
+        if i == len(keys) - 1:
+            container[key] = value
+        else:
+            if container[key] is None:
+                container[key] = [] if isinstance(keys[i + 1], int) else {}
+            container = container[key]
+    return data
+
+
+class EventDispatcher(object):
+    # Delivers events to handlers on worker threads. All events for a
+    # keyspace are sent to the same worker, so they are handled in the order
+    # they were committed. When a worker's queue is full, `overflow` decides
+    # whether the committing thread blocks or the event is dropped.
+    #
+    # Handlers that write to the database use the worker's own connection,
+    # so this requires an on-disk database. A worker never waits for room in
+    # a queue, since the queue may be its own: when it is full, the event is
+    # handled inline (or dropped, with the "drop" policy).
+    #
+    # Workers are started by the first event, and stopped by close().
+    def __init__(self, database, workers=1, queue_size=1000,
+                 overflow='block'):
+        if overflow not in ('block', 'drop'):
+            raise ValueError('overflow must be "block" or "drop".')
+        self.database = database
+        self.overflow = overflow
+        self.dropped = 0
+        self._queues = [Queue(queue_size) for i in range(workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for queue in self._queues:
+                thread = threading.Thread(target=self._run, args=(queue,))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def is_worker(self):
+        return getattr(self._local, 'worker', False)
+
+    def put(self, event):
+        worker = self.is_worker()
+        if not self._threads:
+            if worker:
+                # The dispatcher is being closed.
+                return self.database._dispatch(*event)
+            self._start()
+        queue = self._queues[hash(event[0]) % len(self._queues)]
+        if self.overflow == 'block' and not worker:
+            queue.put(event)
+            return
+        try:
+            queue.put_nowait(event)
+        except Full:
+            if self.overflow == 'drop':
+                self.dropped += 1
+            else:
+                self.database._dispatch(*event)
+
+    def join(self):
+        # Wait until all queued events have been handled.
+        for queue in self._queues:
+            queue.join()
+
+    def close(self):
+        # Handle the queued events, then stop the workers.
+        with self._lock:
+            threads, self._threads = self._threads, []
+            for queue in self._queues[:len(threads)]:
+                queue.put(None)
+            for thread in threads:
+                thread.join()
+
+    def _run(self, queue):
+        self._local.worker = True
+        while True:
+            event = queue.get()
+            try:
+                if event is None:
+                    break
+                self.database._dispatch(*event)
+            except Exception:
+                logger.exception('Error handling event for %s.', event[0])
+            finally:
+                queue.task_done()
+        if not self.database.is_closed():
+            self.database.close()
+
+
+class _savepoint(savepoint_sqlite):
+    # Discards the events queued since the savepoint when it is rolled back.
+    __slots__ = ('events',)
+
+    def _begin(self):
+        self.events = len(self.db._pending_events())
+        super(_savepoint, self)._begin()
+
+    def rollback(self):
+        super(_savepoint, self).rollback()
+        del self.db._pending_events()[self.events:]
+
+
+class ConnectionPool(object):
+    # A bounded pool of warm, read-only connections, plus a single writer
+    # connection shared by all threads. Each thread borrows a reader when it
+    # first connects and returns it to the pool when it closes its
+    # connection. The writer is held by one thread at a time, for a single
+    # statement or for the duration of a transaction.
+    def __init__(self, connect, readers=4, busy_timeout=5.0, timeout=None):
+        self._connect = connect
+        self.max_readers = readers
+        self.busy_timeout = busy_timeout
+        self.timeout = timeout
+        self._idle = []
+        self._readers = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._writer = None
+        self._write_lock = threading.RLock()
+        self._local = threading.local()
+
+    def get_reader(self):
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        with self._condition:
+            while not self._idle and self._readers >= self.max_readers:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise OperationalError('Timed out waiting for a '
+                                               'reader connection.')
+                self._condition.wait(remaining)
+            if self._idle:
+                return self._idle.pop()
+            self._readers += 1
+
+        try:
+            conn = self._connect()
+            conn.execute('PRAGMA query_only = 1')
+        except:
+            with self._condition:
+                self._readers -= 1
+                self._condition.notify()
+            raise
+        return conn
+
+    def put_reader(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._condition:
+            closed = self._closed
+            if closed:
+                self._readers -= 1
+            else:
+                self._idle.append(conn)
+            self._condition.notify()
+        if closed:
+            conn.close()
+
+    def is_reader(self, conn):
+        return conn is not self._writer
+
+    @property
+    def writer_depth(self):
+        return getattr(self._local, 'depth', 0)
+
+    def acquire_writer(self):
+        self._write_lock.acquire()
+        if self._writer is None:
+            try:
+                self._writer = self._connect(timeout=self.busy_timeout)
+            except:
+                self._write_lock.release()
+                raise
+        self._local.depth = self.writer_depth + 1
+        return self._writer
+
+    def release_writer(self):
+        self._local.depth -= 1
+        self._write_lock.release()
+
+    def writer_version(self):
+        # PRAGMA data_version of the writer, which only changes when a
+        # connection outside of the pool commits. None if the writer is not
+        # open, or is held by another thread.
+        if not self._write_lock.acquire(False):
+            return None
+        try:
+            if self._writer is None:
+                return None
+            return self._writer.execute('PRAGMA data_version').fetchone()[0]
+        finally:
+            self._write_lock.release()
+
+    def close(self):
+        # Close idle readers and the writer. Readers that are checked out
+        # are closed when they are returned.
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._readers -= len(idle)
+        for conn in idle:
+            conn.close()
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+
 class Schemaless(SqliteExtDatabase):
     def __init__(self, filename, wal_mode=True, cache_size=4000,
-                 use_json_fallback=USE_JSON_FALLBACK, **kwargs):
+                 use_json_fallback=USE_JSON_FALLBACK, event_dispatch='sync',
+                 event_workers=1, event_queue_size=1000,
+                 event_overflow='block', readers=None, busy_timeout=5.0,
+                 write_retries=3, retry_delay=0.05, pool_timeout=None,
+                 json_codec='json', **kwargs):
         pragmas = [('cache_size', cache_size)]
         if wal_mode:
             pragmas.append(('journal_mode', 'wal'))
+
+        # With `readers`, reads are served by a pool of read-only connections
+        # and writes are sent to a single writer connection. Writes that find
+        # the database locked are retried `write_retries` times.
+        self._pool = None
+        if readers:
+            if filename == ':memory:':
+                raise ValueError('A connection pool requires an on-disk '
+                                 'database.')
+            self._pool = ConnectionPool(
+                self._pool_connect,
+                readers,
+                busy_timeout,
+                pool_timeout)
+        self.write_retries = write_retries
+        self.retry_delay = retry_delay
         super(Schemaless, self).__init__(filename, pragmas=pragmas, **kwargs)
         self._handlers = defaultdict(list)
+        self._writers = []
         self.func('emit_event')(self.event_handler)
+        # Codec used to encode and decode cell values: "json", "orjson",
+        # "ujson", "simplejson", or "auto" for the fastest one installed.
+        self.json_codec = get_json_codec(json_codec)
         self._json_fallback = use_json_fallback
-        if self._json_fallback:
-            self.func('json_extract', _json_extract_fallback)
+        self._zdicts = {}
+        self._json_functions = _JSONFunctions(self.json_codec.loads,
+                                              self._zdicts)
+        self._json_functions.register(self, self._json_fallback)
+        self.func('index_array')(self.index_array)
+
+        # With "async" dispatch, events are queued while the transaction is
+        # open and handed to the dispatcher once it commits.
+        if event_dispatch not in ('sync', 'async'):
+            raise ValueError('event_dispatch must be "sync" or "async".')
+        self._events = threading.local()
+        self._dispatcher = None
+        if event_dispatch == 'async':
+            self._dispatcher = EventDispatcher(
+                self,
+                event_workers,
+                event_queue_size,
+                event_overflow)
+
+    def close(self):
+        # Flush any buffered writes and deliver the queued events before
+        # closing the connection.
+        for writer in list(self._writers):
+            writer.flush()
+        if self._dispatcher is not None and not self._dispatcher.is_worker():
+            self._dispatcher.close()
+        return super(Schemaless, self).close()
+
+    def close_pool(self):
+        if self._pool is not None:
+            self._pool.close()
+
+    def _pool_connect(self, **kwargs):
+        params = dict(self.connect_kwargs, check_same_thread=False)
+        params.update(kwargs)
+        return super(Schemaless, self)._connect(self.database, **params)
+
+    def connect(self):
+        if self._pool is None:
+            return super(Schemaless, self).connect()
+
+        # Waiting for a reader must not hold the lock used by close(), or a
+        # thread returning its reader would never acquire it.
+        if not self._local.closed:
+            raise OperationalError('Connection already open')
+        self._local.conn = self._pool.get_reader()
+        self._local.closed = False
+        with self.exception_wrapper:
+            self.initialize_connection(self._local.conn)
+
+    def _close(self, conn):
+        if self._pool is not None and conn is None:
+            return
+        elif self._pool is not None and self._pool.is_reader(conn):
+            self._pool.put_reader(conn)
+        else:
+            super(Schemaless, self)._close(conn)
+
+    def get_conn(self):
+        # Threads that hold the writer (inside a transaction, or while
+        # executing a write) use it for all of their queries.
+        if self._pool is not None and self._pool.writer_depth:
+            return self._pool._writer
+        return super(Schemaless, self).get_conn()
+
+    def _retry(self, fn, *args):
+        # Retry when the database is locked by another process.
+        for attempt in range(self.write_retries + 1):
+            try:
+                return fn(*args)
+            except OperationalError as exc:
+                if attempt == self.write_retries or 'locked' not in str(exc):
+                    raise
+                time.sleep(self.retry_delay * (2 ** attempt))
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        # Events queued by the triggers of a statement that fails are
+        # discarded, since peewee does not roll back a failed statement
+        # outside of a transaction.
+        pending = self._pending_events()
+        queued = len(pending)
+        try:
+            return self._execute_sql(sql, params, require_commit)
+        except:
+            del pending[queued:]
+            raise
+
+    def _execute_sql(self, sql, params, require_commit):
+        if (self._pool is None or not require_commit or
+                self._pool.writer_depth):
+            return super(Schemaless, self).execute_sql(
+                sql, params, require_commit)
+
+        # A write outside of a transaction holds the writer for the duration
+        # of the statement.
+        self._pool.acquire_writer()
+        try:
+            return self._retry(
+                super(Schemaless, self).execute_sql,
+                sql, params, require_commit)
+        finally:
+            self._pool.release_writer()
+
+    def begin(self, lock_type=None):
+        if self._pool is None:
+            return super(Schemaless, self).begin(lock_type)
+
+        # Transactions hold the writer until they commit or roll back.
+        self._pool.acquire_writer()
+        try:
+            self._retry(super(Schemaless, self).begin, lock_type)
+        except:
+            self._pool.release_writer()
+            raise
+        self._events.in_transaction = True
+
+    def _pending_events(self):
+        try:
+            return self._events.pending
+        except AttributeError:
+            self._events.pending = []
+            return self._events.pending
+
+    def _end_transaction(self):
+        if getattr(self._events, 'in_transaction', False):
+            self._events.in_transaction = False
+            self._pool.release_writer()
+
+    def commit(self):
+        super(Schemaless, self).commit()
+        self._end_transaction()
+        if self._dispatcher is not None:
+            events = self._pending_events()
+            self._events.pending = []
+            for event in events:
+                self._dispatcher.put(event)
+
+    def rollback(self):
+        try:
+            super(Schemaless, self).rollback()
+        finally:
+            self._end_transaction()
+        del self._pending_events()[:]
+
+    def savepoint(self, sid=None):
+        return _savepoint(self, sid)
+
+    def flush_events(self):
+        # Wait for events that have been committed to be handled.
+        if self._dispatcher is not None:
+            self._dispatcher.join()
+
+    def _has_handler(self, table, column):
+        return any(columns is None or column in columns
+                   for _, columns in self._handlers[table])
 
     def event_handler(self, table, row_key, column, value):
-        for handler in self._handlers[table]:
-            if handler(table, row_key, column, json.loads(value)) is False:
+        if self._dispatcher is not None:
+            # Only events that will be handled are queued.
+            if self._has_handler(table, column):
+                self._pending_events().append(
+                    (table, row_key, column, value))
+        else:
+            self._dispatch(table, row_key, column, value)
+
+    def _dispatch(self, table, row_key, column, value):
+        # The value is decoded once and shared by all of the handlers.
+        decoded = False
+        for handler, columns in self._handlers[table]:
+            if columns is not None and column not in columns:
+                continue
+            if not decoded:
+                value = self.json_codec.loads(
+                    _decode_storage(value, self._zdicts))
+                decoded = True
+            if handler(table, row_key, column, value) is False:
                 break
 
-    def bind_handler(self, keyspace, handler):
-        self._handlers[keyspace.db_table].append(handler)
-
-    def handler(self, *keyspaces):
+    def index_array(self, table, row_key, json_text, path):
+        # Populate a multi-valued index table when json_each() is missing.
+        values = set(self._json_functions.each(json_text, path))
+        if values:
+            self.get_cursor().executemany(
+                'INSERT INTO %s (row_key, value) VALUES (?, ?)' % table,
+                [(row_key, value) for value in values])
+
+    def bind_handler(self, keyspace, handler, columns=None):
+        # If `columns` is given, the handler is only called for those columns.
+        if columns is not None:
+            columns = frozenset(columns)
+        self._handlers[keyspace.db_table].append((handler, columns))
+        keyspace._update_trigger()
+
+    def unbind_handler(self, keyspace, handler):
+        self._handlers[keyspace.db_table] = [
+            (fn, columns) for fn, columns in self._handlers[keyspace.db_table]
+            if fn is not handler]
+        keyspace._update_trigger()
+
+    def handler(self, *keyspaces, **kwargs):
+        columns = kwargs.pop('columns', None)
         def decorator(fn):
             for keyspace in keyspaces:
-                self.bind_handler(keyspace.db_table, fn)
+                self.bind_handler(keyspace, fn, columns)
             return fn
         return decorator
 
-    def keyspace(self, item, *indexes):
-        return KeySpace(self, item, *indexes)
+    def keyspace(self, item, *indexes, **options):
+        return KeySpace(self, item, *indexes, **options)
+
+    def partitioned_keyspace(self, item, *indexes, **options):
+        return PartitionedKeySpace(self, item, *indexes, **options)
 
 
 def clean(s):
@@ -129,75 +866,423 @@ def row_iterator(keyspace, query):
         yield Row(keyspace=keyspace, identifier=row_key, **accum)
 
 
-class IndexQuery(object):
-    def __init__(self, index, expression, operations=None, reverse=False):
+class _PlanLeaf(object):
+    # A condition on a single index, evaluated against the index table.
+    def __init__(self, index, expression):
         self.index = index
         self.expression = expression
+        self.estimate = index._estimate(expression)
+
+    def sql(self, depth=0):
+        model = self.index.model
+        return model.select(model.row_key).where(self.expression).sql()
+
+    def probe(self, alias):
+        # Correlated lookup of a single row_key in the index table.
+        model = self.index.model
+        sql, params = (model
+                       .select(SQL('1'))
+                       .where(
+                           (model.row_key == SQL('%s.row_key' % alias)) &
+                           self.expression)
+                       .sql())
+        return 'EXISTS (%s)' % sql, params
+
+    def describe(self, action, depth):
+        sql, params = self.sql()
+        return ['%s%s %s WHERE %s %r (estimated rows: %s)' % (
+            '  ' * depth,
+            action,
+            self.index.db_table,
+            sql.split(' WHERE ', 1)[1],
+            params,
+            self.estimate)]
+
+
+class _PlanNode(object):
+    # AND / OR of several conditions. Children are ordered from the most to
+    # the least selective: an AND scans its first child and probes the rest
+    # for each row_key found, while an OR is the union of its children.
+    def __init__(self, op, children):
+        flattened = []
+        for child in children:
+            if isinstance(child, _PlanNode) and child.op == op:
+                flattened.extend(child.children)
+            else:
+                flattened.append(child)
+        self.op = op
+        self.children = sorted(flattened, key=lambda child: child.estimate)
+        if op == 'AND':
+            self.estimate = self.children[0].estimate
+        else:
+            self.estimate = sum(child.estimate for child in self.children)
+
+    def sql(self, depth=0):
+        if self.op == 'OR':
+            queries = [child.sql(depth + 1) for child in self.children]
+            return (' UNION '.join(sql for sql, _ in queries),
+                    [param for _, params in queries for param in params])
+
+        alias = '_r%s' % depth
+        sql, params = self.children[0].sql(depth + 1)
+        conditions = []
+        for child in self.children[1:]:
+            if isinstance(child, _PlanLeaf):
+                child_sql, child_params = child.probe(alias)
+            else:
+                child_sql, child_params = child.sql(depth + 1)
+                child_sql = '%s.row_key IN (%s)' % (alias, child_sql)
+            conditions.append(child_sql)
+            params.extend(child_params)
+        return ('SELECT %s.row_key FROM (%s) AS %s WHERE %s' % (
+            alias, sql, alias, ' AND '.join(conditions)), params)
+
+    def describe(self, action, depth):
+        lines = ['%s%s %s (estimated rows: %s)' % (
+            '  ' * depth, action, self.op, self.estimate)]
+        for i, child in enumerate(self.children):
+            if self.op == 'OR':
+                child_action = 'UNION'
+            else:
+                child_action = 'SCAN' if i == 0 else 'PROBE'
+            lines.extend(child.describe(child_action, depth + 1))
+        return lines
+
+
+def _replace_model(node, source, target):
+    # Copy of an expression with the fields of one model class replaced by
+    # the fields of the same name on another.
+    if isinstance(node, Field) and node.model_class is source:
+        return getattr(target, node.name)
+    elif isinstance(node, Expression):
+        clone = node.clone()
+        clone.lhs = _replace_model(node.lhs, source, target)
+        clone.rhs = _replace_model(node.rhs, source, target)
+        return clone
+    elif isinstance(node, Func):
+        clone = node.clone()
+        clone.arguments = tuple(_replace_model(argument, source, target)
+                                for argument in node.arguments)
+        return clone
+    elif isinstance(node, Clause):
+        clone = node.clone()
+        clone.nodes = [_replace_model(child, source, target)
+                       for child in node.nodes]
+        return clone
+    elif isinstance(node, (list, tuple)):
+        return type(node)(_replace_model(item, source, target)
+                          for item in node)
+    return node
+
+
+class RowQuery(object):
+    # Base class for queries returning rows in row_key order. Subclasses
+    # provide the SQL for the matching row_keys. Results can be limited and
+    # resumed after (or before) a given row_key, and iterate() streams them
+    # one page at a time.
+    def __init__(self, reverse=False):
         self.reverse = reverse
-        self.query_operations = operations or []
+        self._limit = None
+        self._after = None
+        self._before = None
+        self._columns = None
+        self._paths = {}
+
+    def _clone(self):
+        raise NotImplementedError
 
     def clone(self):
-        return IndexQuery(
-            self.index,
-            self.expression,
-            list(self.query_operations),
-            self.reverse)
+        clone = self._clone()
+        clone._limit = self._limit
+        clone._after = self._after
+        clone._before = self._before
+        clone._columns = self._columns
+        clone._paths = dict(self._paths)
+        return clone
 
     def __neg__(self):
         clone = self.clone()
         clone.reverse = not self.reverse
         return clone
 
-    def __or__(self, rhs):
+    def limit(self, limit):
         clone = self.clone()
-        if rhs.index.name == self.index.name:
-            clone.expression = (clone.expression | rhs.expression)
-        else:
-            clone.query_operations.append((operator.or_, rhs))
+        clone._limit = limit
         return clone
 
-    def __and__(self, rhs):
+    def after(self, row_key):
         clone = self.clone()
-        if rhs.index == self.index:
-            clone.expression = (clone.expression & rhs.expression)
-        else:
-            clone.query_operations.append((operator.and_, rhs))
+        clone._after = row_key
+        return clone
+
+    def before(self, row_key):
+        clone = self.clone()
+        clone._before = row_key
+        return clone
+
+    def columns(self, *columns):
+        # Only read the given columns of each row.
+        clone = self.clone()
+        clone._columns = columns
+        return clone
+
+    def paths(self, column, *paths):
+        # Only read the given JSON paths of a column. They are extracted by
+        # SQLite, and the column is returned as an object containing just
+        # those paths, e.g. paths('pageview', '$.url') -> {'url': ...}.
+        clone = self.clone()
+        clone._paths[column] = paths
         return clone
 
+    def _row_keys(self):
+        raise NotImplementedError
+
+    def row_keys(self):
+        # Returns the SQL and parameters for the matching row_keys.
+        sql, params = self._row_keys()
+        conditions = []
+        expiry = self.keyspace.expiry
+        if expiry is not None:
+            expired_sql, expired_params = expiry.expired().sql()
+            conditions.append('_k.row_key NOT IN (%s)' % expired_sql)
+            params.extend(expired_params)
+        if self._limit is None and self._after is None and \
+                self._before is None and not conditions:
+            return sql, params
+
+        if self._after is not None:
+            conditions.append('_k.row_key > ?')
+            params.append(self._after)
+        if self._before is not None:
+            conditions.append('_k.row_key < ?')
+            params.append(self._before)
+        sql = 'SELECT DISTINCT _k.row_key FROM (%s) AS _k' % sql
+        if conditions:
+            sql += ' WHERE %s' % ' AND '.join(conditions)
+        sql += ' ORDER BY _k.row_key%s' % (' DESC' if self.reverse else '')
+        if self._limit is not None:
+            sql += ' LIMIT ?'
+            params.append(self._limit)
+        return sql, params
+
+    def _value(self):
+        # Value expression for projected columns. json_extract() only
+        # returns a JSON array when given more than one path, so a single
+        # path is passed twice.
+        model = self.keyspace.model
+        clause = [SQL('CASE'), model.column]
+        for column, paths in sorted(self._paths.items()):
+            if len(paths) == 1:
+                paths = paths * 2
+            clause.extend((
+                SQL('WHEN ? THEN', column),
+                getattr(fn, self.keyspace._extract)(model.value, *paths)))
+        clause.extend((SQL('ELSE'), model.value, SQL('END')))
+        return Clause(*clause)
+
+    def _row_key_condition(self):
+        sql, params = self.row_keys()
+        return self.keyspace.model.row_key << SQL('(%s)' % sql, *params)
+
     def query(self):
-        model = self.index.keyspace.model
-        query = (model
-                 .select(
-                     model.row_key,
-                     model.column,
-                     model.value)
-                 .join(
-                     self.index.model,
-                     on=(self.index.model.row_key == model.row_key))
-                 .where(self.expression)
+        # The matching row_keys are found first, and the keyspace is only
+        # read for those rows.
+        model = self.keyspace.model
+        fields = ()
+        if self._paths:
+            fields = (model.row_key, model.column, self._value())
+        query = (self.keyspace
+                 ._select_cells(*fields)
                  .group_by(
                      model.row_key,
                      model.column))
-
-        for op, idx_query in self.query_operations:
-            query = op(query, idx_query.query())
-
+        condition = self._row_key_condition()
+        if condition is not None:
+            query = query.where(condition)
+        if self._columns is not None:
+            columns = set(self._columns)
+            if self._paths:
+                columns.update(self._paths)
+            query = query.where(model.column << list(columns))
         return query
 
+    def _decode(self, cells):
+        # Projected values are read as JSON text and decoded here.
+        python_value = self.keyspace.model.value.python_value
+        for row_key, column, value in cells:
+            if value is not None:
+                value = python_value(value)
+                if column in self._paths:
+                    data = None
+                    for path, item in zip(self._paths[column], value):
+                        data = _set_path(data, path, item)
+                    value = data
+            yield row_key, column, value
+
     def __iter__(self):
         query = self.query()
         if self.reverse:
             query = query.order_by(SQL('1 DESC'))
         else:
             query = query.order_by(SQL('1'))
-        for row in row_iterator(self.index.keyspace, query.tuples()):
+        cells = query.tuples()
+        if self._paths:
+            cells = self._decode(cells)
+        for row in row_iterator(self.keyspace, cells):
             yield row
 
+    def count(self):
+        # Number of matching rows, counted without reading the keyspace.
+        sql, params = self.row_keys()
+        return self.keyspace.database.execute_sql(
+            'SELECT COUNT(DISTINCT _c.row_key) FROM (%s) AS _c' % sql,
+            params,
+            require_commit=False).fetchone()[0]
+
+    def iterate(self, page_size=100):
+        # Each page is a separate query that resumes after the last row_key
+        # of the previous page, so no read transaction stays open while the
+        # results are consumed.
+        remaining = self._limit
+        query = self
+        while remaining is None or remaining > 0:
+            count = page_size
+            if remaining is not None:
+                count = min(count, remaining)
+                remaining -= count
+            rows = list(query.limit(count))
+            for row in rows:
+                yield row
+            if len(rows) < count:
+                break
+            if self.reverse:
+                query = query.before(rows[-1].identifier)
+            else:
+                query = query.after(rows[-1].identifier)
+
+
+class ScanQuery(RowQuery):
+    # All rows of a keyspace.
+    def __init__(self, keyspace, reverse=False):
+        super(ScanQuery, self).__init__(reverse)
+        self.keyspace = keyspace
+
+    def _clone(self):
+        return ScanQuery(self.keyspace, self.reverse)
+
+    def _row_keys(self):
+        model = self.keyspace.model
+        return model.select(model.row_key).sql()
+
+    def _row_key_condition(self):
+        # Without a limit or a range, every row is read, so the cells are
+        # selected directly (expired rows are left out by _select_cells).
+        if self._limit is None and self._after is None and \
+                self._before is None:
+            return None
+        return super(ScanQuery, self)._row_key_condition()
+
+
+class IndexQuery(RowQuery):
+    def __init__(self, index, expression, operations=None, reverse=False):
+        super(IndexQuery, self).__init__(reverse)
+        self.index = index
+        self.expression = expression
+        self.query_operations = operations or []
+
+    @property
+    def keyspace(self):
+        return self.index.keyspace
+
+    def _clone(self):
+        return IndexQuery(
+            self.index,
+            self.expression,
+            list(self.query_operations),
+            self.reverse)
+
+    def _merge(self, rhs):
+        # Conditions on the same index can be folded into one expression,
+        # unless either side already combines several indexes.
+        return (rhs.index is self.index and
+                not self.query_operations and
+                not rhs.query_operations)
+
+    def __or__(self, rhs):
+        clone = self.clone()
+        if self._merge(rhs):
+            clone.expression = (clone.expression | rhs.expression)
+        else:
+            clone.query_operations.append((operator.or_, rhs))
+        return clone
+
+    def __and__(self, rhs):
+        clone = self.clone()
+        if self._merge(rhs):
+            clone.expression = (clone.expression & rhs.expression)
+        else:
+            clone.query_operations.append((operator.and_, rhs))
+        return clone
+
+    def plan(self):
+        # Build the boolean tree of index conditions. Operations are applied
+        # left-to-right, i.e. (a & b) | c.
+        plan = _PlanLeaf(self.index, self.expression)
+        for op, idx_query in self.query_operations:
+            op = 'AND' if op is operator.and_ else 'OR'
+            plan = _PlanNode(op, [plan, idx_query.plan()])
+        return plan
+
+    def explain(self):
+        return '\n'.join(self.plan().describe('SCAN', 0))
+
+    def rebind(self, keyspace):
+        # Copy of the query against the corresponding indexes of another
+        # keyspace declared with the same indexes, such as a partition.
+        position = [i for i, index in enumerate(self.keyspace.indexes)
+                    if index is self.index]
+        if not position:
+            raise ValueError('%s is not an index of %s.' % (
+                self.index.name, self.keyspace.name))
+        clone = self.clone()
+        clone.index = keyspace.indexes[position[0]]
+        clone.expression = _replace_model(
+            self.expression,
+            self.index.model,
+            clone.index.model)
+        clone.query_operations = [
+            (op, idx_query.rebind(keyspace))
+            for op, idx_query in self.query_operations]
+        return clone
+
+    # Aggregates over the values of the query's index (or another index of
+    # the keyspace) for the matching rows.
+    def distinct(self, index=None, path=None):
+        return (index or self.index).distinct(path, self.row_keys())
+
+    def group_counts(self, limit=None, index=None, path=None):
+        return (index or self.index).group_counts(
+            limit, path, self.row_keys())
+
+    def min(self, index=None, path=None):
+        return (index or self.index).min(path, self.row_keys())
+
+    def max(self, index=None, path=None):
+        return (index or self.index).max(path, self.row_keys())
+
+    def histogram(self, bucket_size, start=0, index=None, path=None):
+        return (index or self.index).histogram(
+            bucket_size, start, path, self.row_keys())
+
+    def _row_keys(self):
+        return self.plan().sql()
+
 
 class _QueryDescriptor(object):
     def __get__(self, instance, instance_type=None):
         if instance:
-            return instance.model.value
+            fields = instance._value_fields()
+            return fields[0] if len(fields) == 1 else tuple(fields)
         return self
 
 
@@ -213,12 +1298,35 @@ class Index(object):
         'IN': operator.lshift,
     }
 
-    def __init__(self, column, path):
+    # Declared value types, which determine the column affinity of the index
+    # table (and therefore whether comparisons are textual or numeric).
+    _value_types = {
+        'text': TextField,
+        'integer': _IntegerValueField,
+        'real': _RealValueField,
+    }
+
+    def __init__(self, column, path, value_type='text'):
+        self._check_value_type(value_type)
         self.column = column
         self.path = path
+        self.value_type = value_type
         self.name = clean(path)
         self.keyspace = None
 
+    def _check_value_type(self, value_type):
+        if value_type not in self._value_types:
+            raise ValueError('Unrecognized value type "%s", must be one of '
+                             '%s.' % (value_type,
+                                      ', '.join(sorted(self._value_types))))
+
+    def clone(self):
+        # Unbound copy of the index, e.g. for another keyspace with the same
+        # indexes.
+        index = copy.copy(self)
+        index.keyspace = None
+        return index
+
     def bind(self, keyspace):
         self.keyspace = keyspace
         self.db_table = '%s_%s_%s' % (
@@ -230,7 +1338,7 @@ class Index(object):
     def get_model_class(self):
         class BaseModel(Model):
             row_key = IntegerField(unique=True)
-            value = TextField(null=True)
+            value = self._value_types[self.value_type](null=True)
 
             class Meta:
                 database = self.keyspace.database
@@ -242,63 +1350,223 @@ class Index(object):
 
     def all_items(self):
         return (self.model
-                .select(self.model.row_key, self.model.value)
+                .select(self.model.row_key, *self._value_fields())
                 .order_by(self.model.row_key)
                 .dicts())
 
+    def _value_fields(self):
+        return [self.model.value]
+
+    def field(self, path):
+        if path != self.path:
+            raise ValueError('%s is not indexed by %s.' % (path, self.name))
+        return self.model.value
+
+    # Aggregates are computed over the index table alone. When called on an
+    # IndexQuery, they are restricted to the row_keys matched by the query.
+    def _aggregate(self, selection, path=None, row_keys=None):
+        field = self._value_fields()[0] if path is None else self.field(path)
+        query = (self.model
+                 .select(*selection(field))
+                 .where(field.is_null(False)))
+        if row_keys is not None:
+            sql, params = row_keys
+            query = query.where(
+                self.model.row_key << SQL('(%s)' % sql, *params))
+        elif self.keyspace.expiry is not None:
+            query = query.where(
+                self.model.row_key.not_in(self.keyspace.expiry.expired()))
+        return query
+
+    def count(self, path=None, row_keys=None):
+        # Number of rows with a value at the indexed path.
+        return self._aggregate(
+            lambda field: [fn.COUNT(fn.DISTINCT(self.model.row_key))],
+            path, row_keys).scalar()
+
+    def distinct(self, path=None, row_keys=None):
+        return [value for value, in self
+                ._aggregate(lambda field: [field], path, row_keys)
+                .distinct()
+                .order_by(SQL('1'))
+                .tuples()]
+
+    def group_counts(self, limit=None, path=None, row_keys=None):
+        # Number of rows per value, most common first.
+        query = (self
+                 ._aggregate(
+                     lambda field: [
+                         field,
+                         fn.COUNT(fn.DISTINCT(self.model.row_key))],
+                     path, row_keys)
+                 .group_by(SQL('1'))
+                 .order_by(SQL('2 DESC'), SQL('1'))
+                 .tuples())
+        if limit is not None:
+            query = query.limit(limit)
+        return list(query)
+
+    def min(self, path=None, row_keys=None):
+        return self._aggregate(
+            lambda field: [fn.MIN(field)], path, row_keys).scalar()
+
+    def max(self, path=None, row_keys=None):
+        return self._aggregate(
+            lambda field: [fn.MAX(field)], path, row_keys).scalar()
+
+    def histogram(self, bucket_size, start=0, path=None, row_keys=None):
+        # Number of rows per bucket of numeric values, as a list of
+        # (bucket start, count) for the buckets that are not empty.
+        def selection(field):
+            offset = (field - start) / float(bucket_size)
+            truncated = fn.CAST(Clause(offset, SQL('AS INTEGER')))
+            # CAST truncates towards zero, so round negatives down.
+            return [truncated - (offset < truncated),
+                    fn.COUNT(fn.DISTINCT(self.model.row_key))]
+        query = (self
+                 ._aggregate(selection, path, row_keys)
+                 .group_by(SQL('1'))
+                 .order_by(SQL('1'))
+                 .tuples())
+        return [(start + bucket * bucket_size, count)
+                for bucket, count in query]
+
+    def _value_expressions(self, alias):
+        return ['%s(%s.value, \'%s\')' % (
+            self.keyspace._extract, alias, self.path)]
+
+    def _format(self, query, alias, **params):
+        # Fill in the table names and the value columns and expressions, which
+        # are shared by the triggers and the populate query.
+        expressions = self._value_expressions(alias)
+        params.update(
+            keyspace=self.keyspace.db_table,
+            column=self.column,
+            index=self.db_table,
+            path=self.path,
+            current=self.keyspace._latest_condition(alias) or '1',
+            columns=', '.join(f.db_column for f in self._value_fields()),
+            values=', '.join(expressions),
+            not_null=' OR '.join('%s IS NOT NULL' % expression
+                                 for expression in expressions))
+        return query % params
+
     def _create_triggers(self):
         self.model.create_table(True)
-        trigger_name = '%s_populate' % self.name
-        query = (
-            'CREATE TRIGGER IF NOT EXISTS %(trigger_name)s '
-            'AFTER INSERT ON %(keyspace)s '
-            'FOR EACH ROW WHEN ('
-            'new.column = \'%(column)s\' AND '
-            'json_extract(new.value, \'%(path)s\') IS NOT NULL) '
-            'BEGIN '
-            'INSERT OR REPLACE INTO %(index)s (row_key, value) '
-            'VALUES (new.row_key, json_extract(new.value, \'%(path)s\')); '
-            'END') % {
-                'trigger_name': trigger_name,
-                'keyspace': self.keyspace.db_table,
-                'column': self.column,
-                'index': self.db_table,
-                'path': self.path}
-        self.keyspace.database.execute_sql(query)
+        self._drop_legacy_triggers()
+
+        # Covering index on the value(s) followed by the row_key, so lookups
+        # and range scans can be answered from the index b-tree alone.
+        self.keyspace.database.execute_sql(self._format(
+            'CREATE INDEX IF NOT EXISTS %(index)s_value_row_key '
+            'ON %(index)s (%(columns)s, row_key)', 'new'))
 
-        trigger_name = '%s_delete' % self.name
+        self.keyspace.database.execute_sql(self._format(
+            self._populate_trigger_sql(), 'new',
+            trigger_name='%s_populate' % self.db_table))
+
+        latest = self.keyspace._latest_condition('OLD')
         query = (
             'CREATE TRIGGER IF NOT EXISTS %(trigger_name)s '
             'BEFORE DELETE ON %(keyspace)s '
-            'FOR EACH ROW WHEN OLD.column = \'%(column)s\' BEGIN '
+            'FOR EACH ROW WHEN OLD.column = \'%(column)s\'%(latest)s BEGIN '
             'DELETE FROM %(index)s WHERE '
             'row_key = OLD.row_key; '
-            'END') % {
-                'trigger_name': trigger_name,
-                'keyspace': self.keyspace.db_table,
-                'column': self.column,
-                'index': self.db_table}
-        self.keyspace.database.execute_sql(query)
+            'END')
+        self.keyspace.database.execute_sql(self._format(
+            query, 'old', trigger_name='%s_delete' % self.db_table,
+            latest=' AND %s' % latest if latest else ''))
+
+    def _populate_trigger_sql(self):
+        # The previous entry is cleared first, so that replacing a cell with
+        # one that lacks the path does not leave a stale entry behind.
+        return (
+            'CREATE TRIGGER IF NOT EXISTS %(trigger_name)s '
+            'AFTER INSERT ON %(keyspace)s '
+            'FOR EACH ROW WHEN new.column = \'%(column)s\' '
+            'BEGIN '
+            'DELETE FROM %(index)s WHERE row_key = new.row_key; '
+            'INSERT INTO %(index)s (row_key, %(columns)s) '
+            'SELECT new.row_key, %(values)s WHERE (%(not_null)s); '
+            'END')
 
     def _drop_triggers(self):
         for name in ('_populate', '_delete'):
             self.keyspace.database.execute_sql('DROP TRIGGER IF EXISTS %s%s' %
-                                               (self.name, name))
+                                               (self.db_table, name))
+        self._drop_legacy_triggers()
+
+    def _drop_legacy_triggers(self):
+        # Triggers used to be named after the path alone, which clashed
+        # between keyspaces indexing the same path. Only those on this
+        # keyspace's table are removed.
+        database = self.keyspace.database
+        cursor = database.execute_sql(
+            'SELECT name FROM sqlite_master WHERE type = \'trigger\' AND '
+            'tbl_name = ? AND name IN (?, ?)',
+            (self.keyspace.db_table,
+             '%s_populate' % self.name,
+             '%s_delete' % self.name))
+        for name, in cursor.fetchall():
+            database.execute_sql('DROP TRIGGER IF EXISTS %s' % name)
+
+    def _drop(self):
+        self._drop_triggers()
+        self.model.drop_table(True)
 
     def _populate(self):
-        query = (
-            'INSERT INTO %(index)s (row_key, value) '
-            'SELECT k.row_key, json_extract(k.value, \'%(path)s\') '
+        query = self._format(
+            'INSERT INTO %(index)s (row_key, %(columns)s) '
+            'SELECT k.row_key, %(values)s '
             'FROM %(keyspace)s AS k '
-            'WHERE ('
-            'k.column = ? AND '
-            'json_extract(k.value, \'%(path)s\') IS NOT NULL)') % {
-                'keyspace': self.keyspace.db_table,
-                'index': self.db_table,
-                'column': self.column,
-                'path': self.path}
+            'WHERE (k.column = ? AND (%(not_null)s) AND %(current)s)', 'k')
         self.keyspace.database.execute_sql(query, (self.column,))
 
+    def _statistics(self):
+        # Returns the number of index entries and the average number of
+        # entries per value, using the statistics gathered by ANALYZE when
+        # they are available.
+        database = self.keyspace.database
+        try:
+            row = database.execute_sql(
+                'SELECT stat FROM sqlite_stat1 WHERE idx = ?',
+                ('%s_value_row_key' % self.db_table,),
+                require_commit=False).fetchone()
+        except OperationalError:
+            row = None
+        if row:
+            stat = [int(n) for n in row[0].split()[:2]]
+            if len(stat) == 2:
+                return stat
+        total = database.execute_sql(
+            'SELECT MAX(rowid) FROM %s' % self.db_table,
+            require_commit=False).fetchone()[0]
+        return total or 0, None
+
+    def _estimate(self, expression, statistics=None):
+        # Estimated number of index entries matching the expression. Without
+        # statistics, an equality is assumed to match 10 entries and a range
+        # a quarter of the table, as SQLite's own planner does.
+        total, per_value = statistics or self._statistics()
+        if not isinstance(expression, Expression):
+            return total
+        op = expression.op
+        if op in (OP.AND, OP.OR):
+            lhs = self._estimate(expression.lhs, (total, per_value))
+            rhs = self._estimate(expression.rhs, (total, per_value))
+            return min(lhs, rhs) if op == OP.AND else min(total, lhs + rhs)
+        elif op == OP.EQ:
+            estimate = per_value or 10
+        elif op == OP.IN and isinstance(expression.rhs, (list, tuple)):
+            estimate = len(expression.rhs) * (per_value or 10)
+        elif op in (OP.LT, OP.LTE, OP.GT, OP.GTE, OP.BETWEEN):
+            estimate = total // 4
+        elif op in (OP.LIKE, OP.ILIKE):
+            estimate = total // 2
+        else:
+            estimate = total
+        return min(total, estimate)
+
     def query(self, value, operation=operator.eq, reverse=False):
         # Support string operations in addition to functional, for readability.
         if isinstance(value, Expression):
@@ -322,110 +1590,1523 @@ class Index(object):
     v = _QueryDescriptor()
 
 
-class KeySpace(object):
-    def __init__(self, database, name, *indexes):
-        self.database = database
-        self.name = name
-        self.db_table = clean(self.name)
-        self.model = self.get_model_class()
-        self.indexes = []
-        for index in indexes:
-            index.bind(self)
-            self.indexes.append(index)
+class CompositeIndex(Index):
+    # Index on several JSON paths of the same column. The extracted values are
+    # stored side-by-side and covered by a single index on (value_0, value_1,
+    # ..., row_key), so a query constraining a prefix of the paths is answered
+    # by one index range scan.
+    def __init__(self, column, *paths, **kwargs):
+        value_types = kwargs.pop('value_types', None)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments: %s' %
+                            ', '.join(sorted(kwargs)))
+        if len(paths) < 2:
+            raise ValueError('CompositeIndex requires at least two paths.')
+        value_types = value_types or ['text'] * len(paths)
+        if len(value_types) != len(paths):
+            raise ValueError('A value type must be given for each path.')
+        for value_type in value_types:
+            self._check_value_type(value_type)
+        super(CompositeIndex, self).__init__(column, paths[0])
+        self.paths = paths
+        self.value_types = value_types
+        self.name = '_'.join(clean(path) for path in paths)
 
-    def add_index(self, index):
-        # Add index to existing KeySpace.
-        index.bind(self)
-        index._create_triggers()
-        index._populate()
-        self.indexes.append(index)
+    def get_model_class(self):
+        attrs = {'row_key': IntegerField(unique=True)}
+        for i, value_type in enumerate(self.value_types):
+            attrs['value_%s' % i] = self._value_types[value_type](null=True)
 
-    def handler(self, fn):
-        def wrapper(table, row_key, column, value):
-            return fn(row_key, column, value)
-        self.database.bind_handler(self, wrapper)
-        def unbind():
-            self.database._handlers[self.db_table].remove(wrapper)
-        fn.unbind = unbind
-        return fn
+        class Meta:
+            database = self.keyspace.database
+            db_table = self.db_table
+
+        attrs['Meta'] = Meta
+        return type(self.name, (Model,), attrs)
+
+    def _value_fields(self):
+        return [getattr(self.model, 'value_%s' % i)
+                for i in range(len(self.paths))]
+
+    def _value_expressions(self, alias):
+        return ['%s(%s.value, \'%s\')' % (
+                    self.keyspace._extract, alias, path)
+                for path in self.paths]
+
+    def field(self, path):
+        # Return the index field corresponding to the given JSON path.
+        return self._value_fields()[self.paths.index(path)]
+
+    def query(self, value, operation=operator.eq, reverse=False):
+        # A tuple of values is compared against a prefix of the paths, e.g.
+        # idx.query(('/about/',)) matches on the first path only.
+        if isinstance(value, Expression):
+            return IndexQuery(self, value, reverse=reverse)
+        if isinstance(operation, basestring):
+            operation = self._op_map[operation]
+        if not isinstance(value, (list, tuple)):
+            value = (value,)
+        if len(value) > len(self.paths):
+            raise ValueError('Too many values for %s paths.' %
+                             len(self.paths))
+        expression = reduce(operator.and_, [
+            operation(field, item)
+            for field, item in zip(self._value_fields(), value)])
+        return IndexQuery(self, expression, reverse=reverse)
+
+
+class ArrayIndex(Index):
+    # Multi-valued index: each element of the array found at the path (which
+    # may be written "$.tags" or "$.tags[*]") gets its own index entry. Rows
+    # with several matching elements are returned once by IndexQuery, as the
+    # results are grouped by row_key and column.
+    def __init__(self, column, path, value_type='text'):
+        if path.endswith('[*]'):
+            path = path[:-3]
+        super(ArrayIndex, self).__init__(column, path, value_type)
 
     def get_model_class(self):
         class BaseModel(Model):
             row_key = IntegerField(index=True)
-            column = TextField(index=True)
-            value = JSONField(null=True)
-            timestamp = FloatField(default=time.time, index=True)
+            value = self._value_types[self.value_type](null=True)
 
             class Meta:
-                database = self.database
-                indexes = (
-                    (('row_key', 'column'), True),
-                )
+                database = self.keyspace.database
 
         class Meta:
             db_table = self.db_table
 
         return type(self.name, (BaseModel,), {'Meta': Meta})
 
-    def create(self):
-        self.model.create_table(True)
-        self._create_trigger()
-        for index in self.indexes:
-            index._create_triggers()
-
-    def drop(self):
-        for index in self.indexes:
-            index._drop_triggers()
-        self._drop_trigger()
-        self.model.drop_table()
+    def all_items(self):
+        return (self.model
+                .select(self.model.row_key, self.model.value)
+                .order_by(self.model.row_key, self.model.value)
+                .dicts())
 
-    def _create_trigger(self):
-        trigger_name = '%s_signal' % self.db_table
-        query = (
+    def _populate_trigger_sql(self):
+        # The row's previous entries are cleared first, since replacing a
+        # cell does not fire the delete trigger.
+        if self.keyspace._python_json:
+            insert = ('SELECT index_array(\'%(index)s\', new.row_key, '
+                      'new.value, \'%(path)s\'); ')
+        else:
+            insert = ('INSERT INTO %(index)s (row_key, value) '
+                      'SELECT DISTINCT new.row_key, j.value '
+                      'FROM json_each(new.value, \'%(path)s\') AS j; ')
+        return (
             'CREATE TRIGGER IF NOT EXISTS %(trigger_name)s '
             'AFTER INSERT ON %(keyspace)s '
-            'FOR EACH ROW BEGIN '
-            'SELECT emit_event('
-            '\'%(keyspace)s\', new.row_key, new.column, new.value);'
-            'END') % {
-                'trigger_name': trigger_name,
-                'keyspace': self.db_table,
-            }
-        self.database.execute_sql(query)
+            'FOR EACH ROW WHEN new.column = \'%(column)s\' '
+            'BEGIN '
+            'DELETE FROM %(index)s WHERE row_key = new.row_key; ' +
+            insert +
+            'END')
 
-    def _drop_trigger(self):
-        trigger_name = '%s_signal' % self.db_table
-        self.database.execute_sql('DROP TRIGGER IF EXISTS %s' % trigger_name)
+    def _populate(self):
+        database = self.keyspace.database
+        if not self.keyspace._python_json:
+            query = self._format(
+                'INSERT INTO %(index)s (row_key, value) '
+                'SELECT DISTINCT k.row_key, j.value '
+                'FROM %(keyspace)s AS k, '
+                'json_each(k.value, \'%(path)s\') AS j '
+                'WHERE k.column = ? AND %(current)s', 'k')
+            database.execute_sql(query, (self.column,))
+            return
+
+        cursor = database.execute_sql(self._format(
+            'SELECT k.row_key, k.value FROM %(keyspace)s AS k '
+            'WHERE k.column = ? AND %(current)s', 'k'),
+            (self.column,), require_commit=False)
+        with database.atomic():
+            for row_key, json_text in cursor.fetchall():
+                database.index_array(self.db_table, row_key, json_text,
+                                     self.path)
+
+
+RollupBucket = namedtuple('RollupBucket', ('value', 'bucket', 'count', 'sums'))
+
+
+class Rollup(object):
+    # Summary table holding the number of cells, and optionally the sums of
+    # numeric paths, for each value of a JSON path and time bucket. Triggers
+    # keep it up to date as cells are inserted, replaced and deleted, so
+    # reading it costs one row per value and bucket rather than per cell.
+    # Buckets are taken from the cell's timestamp, or from the `timestamp`
+    # path if one is given. With `bucket=None` there is a single bucket, 0.
+    def __init__(self, column, path, bucket=3600, timestamp=None, sums=(),
+                 value_type='text'):
+        if value_type not in Index._value_types:
+            raise ValueError('Unrecognized value type "%s", must be one of '
+                             '%s.' % (value_type,
+                                      ', '.join(sorted(Index._value_types))))
+        self.column = column
+        self.path = path
+        self.bucket = bucket
+        self.timestamp = timestamp
+        self.sums = tuple(sums)
+        self.value_type = value_type
+        self.name = clean(path)
+        if bucket:
+            self.name += '_%s' % clean(str(bucket))
+        self.keyspace = None
 
-    def __getitem__(self, identifier):
-        return Row(self, identifier)
+    def clone(self):
+        # Unbound copy of the rollup, e.g. for another keyspace.
+        rollup = copy.copy(self)
+        rollup.keyspace = None
+        return rollup
 
-    def __delitem__(self, identifier):
-        row = Row(self, identifier)
+    def bind(self, keyspace):
+        self.keyspace = keyspace
+        self.db_table = '%s_rollup_%s_%s' % (
+            self.keyspace.db_table,
+            clean(self.column),
+            self.name)
+        self.model = self.get_model_class()
+
+    def _sum_column(self, path):
+        return 'sum_%s' % clean(path)
+
+    def get_model_class(self):
+        if self.bucket is None or isinstance(self.bucket, int):
+            bucket_field = IntegerField
+        else:
+            bucket_field = FloatField
+        attrs = {
+            'value': Index._value_types[self.value_type](),
+            'bucket': bucket_field(),
+            'count': IntegerField(default=0, constraints=[SQL('DEFAULT 0')])}
+        for path in self.sums:
+            attrs[self._sum_column(path)] = FloatField(
+                default=0,
+                constraints=[SQL('DEFAULT 0')])
+
+        class Meta:
+            database = self.keyspace.database
+            db_table = self.db_table
+            indexes = (
+                (('value', 'bucket'), True),
+            )
+
+        attrs['Meta'] = Meta
+        return type(self.db_table, (Model,), attrs)
+
+    def _expressions(self, alias):
+        # SQL for the value, bucket and summed values of the given cell.
+        extract = self.keyspace._extract
+        value = '%s(%s.value, \'%s\')' % (extract, alias, self.path)
+        if not self.bucket:
+            bucket = '0'
+        else:
+            if self.timestamp is None:
+                timestamp = '%s.timestamp' % alias
+            else:
+                timestamp = '%s(%s.value, \'%s\')' % (
+                    extract, alias, self.timestamp)
+            # CAST truncates towards zero, so round negatives down.
+            offset = '(%s) / %s' % (timestamp, float(self.bucket))
+            bucket = (
+                '(CAST(%s AS INTEGER) - (%s < CAST(%s AS INTEGER))) * %s' %
+                (offset, offset, offset, self.bucket))
+        sums = ['COALESCE(%s(%s.value, \'%s\'), 0)' % (extract, alias, path)
+                for path in self.sums]
+        return value, bucket, sums
+
+    def _previous(self, expression):
+        # Evaluate an expression against the cell that the new cell replaces
+        # (or, for a versioned keyspace, the current version of it).
+        latest = self.keyspace._latest_condition('k')
+        return (
+            '(SELECT %s FROM %s AS k WHERE k.row_key = new.row_key AND '
+            'k.column = new.column%s)' % (
+                expression,
+                self.keyspace.db_table,
+                ' AND %s' % latest if latest else ''))
+
+    def _update_sql(self, value, bucket, sums, sign):
+        where = 'WHERE value = %s AND bucket = %s' % (value, bucket)
+        assignments = ['count = count %s 1' % sign]
+        assignments.extend(
+            '%s = %s %s %s' % (self._sum_column(path),
+                               self._sum_column(path), sign, expression)
+            for path, expression in zip(self.sums, sums))
+        sql = 'UPDATE %s SET %s %s; ' % (
+            self.db_table, ', '.join(assignments), where)
+        if sign == '-':
+            sql += 'DELETE FROM %s %s AND count <= 0; ' % (
+                self.db_table, where)
+        return sql
+
+    def _create_triggers(self):
+        self.model.create_table(True)
+        database = self.keyspace.database
+        params = {
+            'rollup': self.db_table,
+            'keyspace': self.keyspace.db_table,
+            'column': self.column.replace("'", "''")}
+
+        # Replacing a cell does not fire the delete trigger, so the previous
+        # cell is subtracted before the new one is inserted.
+        value, bucket, sums = self._expressions('k')
+        params['subtract'] = self._update_sql(
+            self._previous(value),
+            self._previous(bucket),
+            [self._previous(expression) for expression in sums],
+            '-')
+        database.execute_sql(
+            'CREATE TRIGGER IF NOT EXISTS %(rollup)s_replace '
+            'BEFORE INSERT ON %(keyspace)s '
+            'FOR EACH ROW WHEN new.column = \'%(column)s\' BEGIN '
+            '%(subtract)s'
+            'END' % params)
+
+        value, bucket, sums = self._expressions('new')
+        params.update(
+            value=value,
+            bucket=bucket,
+            add=self._update_sql(value, bucket, sums, '+'))
+        # The outer statement's conflict clause overrides the trigger's (an
+        # OR IGNORE would become an OR REPLACE when a cell is replaced), so
+        # the bucket is checked for explicitly.
+        database.execute_sql(
+            'CREATE TRIGGER IF NOT EXISTS %(rollup)s_insert '
+            'AFTER INSERT ON %(keyspace)s '
+            'FOR EACH ROW WHEN new.column = \'%(column)s\' BEGIN '
+            'INSERT INTO %(rollup)s (value, bucket) '
+            'SELECT %(value)s, %(bucket)s '
+            'WHERE %(value)s IS NOT NULL AND %(bucket)s IS NOT NULL '
+            'AND NOT EXISTS (SELECT 1 FROM %(rollup)s '
+            'WHERE value = %(value)s AND bucket = %(bucket)s); '
+            '%(add)s'
+            'END' % params)
+
+        value, bucket, sums = self._expressions('old')
+        latest = self.keyspace._latest_condition('old')
+        params.update(
+            latest=' AND %s' % latest if latest else '',
+            subtract=self._update_sql(value, bucket, sums, '-'))
+        database.execute_sql(
+            'CREATE TRIGGER IF NOT EXISTS %(rollup)s_delete '
+            'BEFORE DELETE ON %(keyspace)s '
+            'FOR EACH ROW WHEN old.column = \'%(column)s\'%(latest)s BEGIN '
+            '%(subtract)s'
+            'END' % params)
+
+    def _drop_triggers(self):
+        for name in ('_replace', '_insert', '_delete'):
+            self.keyspace.database.execute_sql(
+                'DROP TRIGGER IF EXISTS %s%s' % (self.db_table, name))
+
+    def drop(self):
+        self._drop_triggers()
+        self.model.drop_table(True)
+
+    def backfill(self):
+        # Rebuild the summary from the cells currently in the keyspace.
+        value, bucket, sums = self._expressions('k')
+        columns = ['value', 'bucket', 'count']
+        columns.extend(self._sum_column(path) for path in self.sums)
+        current = self.keyspace._latest_condition('k')
+        query = (
+            'INSERT INTO %s (%s) '
+            'SELECT %s, %s, COUNT(*)%s FROM %s AS k '
+            'WHERE k.column = ? AND %s IS NOT NULL AND %s IS NOT NULL%s '
+            'GROUP BY 1, 2' % (
+                self.db_table,
+                ', '.join(columns),
+                value,
+                bucket,
+                ''.join(', SUM(%s)' % expression for expression in sums),
+                self.keyspace.db_table,
+                value,
+                bucket,
+                ' AND %s' % current if current else ''))
+        database = self.keyspace.database
+        with database.atomic():
+            self.model.delete().execute()
+            database.execute_sql(query, (self.column,))
+
+    def _bucket_query(self, query, start, end):
+        if start is not None:
+            query = query.where(self.model.bucket >= start)
+        if end is not None:
+            query = query.where(self.model.bucket < end)
+        return query
+
+    def query(self, value=None, start=None, end=None):
+        # Buckets in [start, end), for one value, a list of values, or all
+        # values, ordered by value and bucket.
+        model = self.model
+        sum_fields = [getattr(model, self._sum_column(path))
+                      for path in self.sums]
+        query = (model
+                 .select(model.value, model.bucket, model.count, *sum_fields)
+                 .order_by(model.value, model.bucket)
+                 .tuples())
+        if isinstance(value, (list, tuple)):
+            query = query.where(model.value << list(value))
+        elif value is not None:
+            query = query.where(model.value == value)
+        return [RollupBucket(row[0], row[1], row[2],
+                             dict(zip(self.sums, row[3:])))
+                for row in self._bucket_query(query, start, end)]
+
+    def totals(self, start=None, end=None, limit=None):
+        # Count per value over the buckets in [start, end), most common
+        # first.
+        model = self.model
+        query = (model
+                 .select(model.value, fn.SUM(model.count))
+                 .group_by(model.value)
+                 .order_by(fn.SUM(model.count).desc(), model.value)
+                 .tuples())
+        if limit is not None:
+            query = query.limit(limit)
+        return list(self._bucket_query(query, start, end))
+
+
+class RowKeyAllocator(object):
+    # Hands out row keys for a keyspace. Blocks of keys are reserved by
+    # bumping a counter in the keyspace's sequence table, which takes the
+    # write lock, so connections and processes sharing the database file
+    # never receive the same key. Keys within a block are handed out from
+    # memory. The counter numbers the keys `offset + 1`, `offset + 1 + step`,
+    # and so on, so keyspaces using different offsets never share a key.
+    def __init__(self, keyspace, block_size=100, step=1, offset=0):
+        self.keyspace = keyspace
+        self.block_size = block_size
+        self.step = step
+        self.offset = offset
+        self.db_table = '%s_sequence' % keyspace.db_table
+        self.model = self.get_model_class()
+        self._lock = threading.Lock()
+        self._next = self._end = 0
+        # Largest value of the counter seen in the sequence table. Counters
+        # below it have already been reserved.
+        self._seen = 0
+
+    def get_model_class(self):
+        class BaseModel(Model):
+            next_key = IntegerField()
+
+            class Meta:
+                database = self.keyspace.database
+
+        class Meta:
+            db_table = self.db_table
+
+        return type(self.db_table, (BaseModel,), {'Meta': Meta})
+
+    def create(self):
+        self.model.create_table(True)
+        self._seed()
+
+    def drop(self):
+        self.model.drop_table(True)
+
+    def _seed(self):
+        # Continue from the largest row key when the sequence is first
+        # created for an existing keyspace.
+        self.keyspace.database.execute_sql(
+            'INSERT INTO %(sequence)s (id, next_key) '
+            'SELECT 1, (SELECT COALESCE((MAX(row_key) - %(first)s) / '
+            '%(step)s + 2, 1) FROM %(keyspace)s) '
+            'WHERE NOT EXISTS (SELECT 1 FROM %(sequence)s)' % {
+                'sequence': self.db_table,
+                'keyspace': self.keyspace.db_table,
+                'first': self.offset + 1,
+                'step': self.step})
+
+    def _reserve(self, count):
+        database = self.keyspace.database
+        with database.atomic('IMMEDIATE'):
+            cursor = database.execute_sql(
+                'UPDATE %s SET next_key = next_key + ? WHERE id = 1' %
+                self.db_table, (count,))
+            if not cursor.rowcount:
+                self._seed()
+                return self._reserve(count)
+            end = (self.model
+                   .select(self.model.next_key)
+                   .where(self.model.id == 1)
+                   .scalar())
+        self._seen = max(self._seen, end)
+        return end - count
+
+    def observe(self, row_key):
+        # Called after writing a row whose key was chosen by the caller, so
+        # that the key is never handed out for a new row. Keys that were
+        # already reserved (by any allocator) only need checking against
+        # this allocator's current block.
+        n = (row_key - self.offset - 1) // self.step + 1
+        with self._lock:
+            if self._next <= n < self._end:
+                self._next = n + 1
+            if n < self._seen:
+                return
+        database = self.keyspace.database
+        with database.atomic():
+            cursor = database.execute_sql(
+                'UPDATE %s SET next_key = MAX(next_key, ?) WHERE id = 1' %
+                self.db_table, (n + 1,))
+            if not cursor.rowcount:
+                self._seed()
+            seen = (self.model
+                    .select(self.model.next_key)
+                    .where(self.model.id == 1)
+                    .scalar())
+        with self._lock:
+            self._seen = max(self._seen, seen)
+
+    def next_key(self):
+        return self.reserve(1)
+
+    def _key(self, n):
+        return (n - 1) * self.step + self.offset + 1
+
+    def reserve(self, count):
+        # Return the first of `count` row keys, which are `step` apart.
+        with self._lock:
+            if self._end - self._next < count:
+                if count < self.block_size:
+                    self._next = self._reserve(self.block_size)
+                    self._end = self._next + self.block_size
+                else:
+                    return self._key(self._reserve(count))
+            start = self._next
+            self._next += count
+            return self._key(start)
+
+
+class BufferedWriter(object):
+    # Accumulates new rows in memory and writes them to the keyspace in one
+    # transaction once `max_rows` rows are pending or `max_delay` seconds have
+    # passed, so many rows share a single commit. Row keys are allocated
+    # immediately. When `max_pending` rows are waiting, writers block until
+    # the buffer has been flushed. The returned Rows must not be written to
+    # until they have been flushed, since the buffered insert would conflict
+    # with the cells already written.
+    #
+    # If a batch fails, its rows are written one at a time. Rows that still
+    # fail are moved to `failed` as (row_key, data) pairs, and the error is
+    # raised by flush(), or, for the background thread, by the next call to
+    # create_row(), flush() or close().
+    #
+    # The background flush thread uses its own connection, so it requires an
+    # on-disk database. With `max_delay=None` no thread is started and the
+    # buffer is flushed by the writing thread.
+    def __init__(self, keyspace, max_rows=1000, max_delay=1.0,
+                 max_pending=10000):
+        self.keyspace = keyspace
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.max_pending = max(max_pending, max_rows)
+        self._rows = []
+        self.failed = []
+        self._error = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._thread = None
+        if max_delay is not None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        keyspace.database._writers.append(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def create_row(self, **data):
+        if self._closed:
+            raise ValueError('Cannot write to a closed BufferedWriter.')
+        self._raise_error()
+        row_key = self.keyspace.allocator.next_key()
+        with self._lock:
+            while (self._thread and not self._closed and
+                   len(self._rows) >= self.max_pending):
+                self._not_full.wait()
+            if self._closed:
+                raise ValueError('Cannot write to a closed BufferedWriter.')
+            self._rows.append((row_key, data))
+            pending = len(self._rows)
+            if self._thread and pending >= self.max_rows:
+                self._wakeup.notify()
+
+        if not self._thread and pending >= self.max_rows:
+            self.flush()
+
+        row = Row(self.keyspace, row_key)
+        row._data.update(data)
+        return row
+
+    def flush(self):
+        count = self._flush()
+        self._raise_error()
+        return count
+
+    def _flush(self):
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+                self._not_full.notify_all()
+            if rows:
+                try:
+                    self.keyspace._write_rows(rows)
+                except Exception:
+                    self._write_each(rows)
+        return len(rows)
+
+    def _write_each(self, rows):
+        # Write the rows of a failed batch separately, so that one bad row
+        # does not hold back the others, and keep the ones that fail.
+        error = None
+        for row in rows:
+            try:
+                self.keyspace._write_rows([row])
+            except Exception as exc:
+                self.failed.append(row)
+                error = error or exc
+        if error is not None:
+            raise error
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._wakeup.notify()
+        if self._thread:
+            self._thread.join()
+        self.keyspace.database._writers.remove(self)
+        self.flush()
+
+    def _run(self):
+        database = self.keyspace.database
+        while True:
+            with self._lock:
+                if not self._closed and len(self._rows) < self.max_rows:
+                    self._wakeup.wait(self.max_delay)
+                closed = self._closed
+            try:
+                self._flush()
+            except Exception as exc:
+                self._error = exc
+            if closed:
+                break
+        if not database.is_closed():
+            database.close()
+
+
+Version = namedtuple('Version', ('version', 'timestamp', 'value'))
+
+Change = namedtuple('Change', (
+    'seq', 'row_key', 'column', 'operation', 'value', 'timestamp'))
+
+ManyRows = namedtuple('ManyRows', ('rows', 'missing'))
+
+
+class ChangeLog(object):
+    # Durable log of the inserts, updates and deletes in a keyspace, written
+    # by triggers. Each entry gets a sequence number that is never re-used.
+    # Named consumers read the log in batches and acknowledge their position;
+    # entries that every consumer has passed are removed by compact().
+    def __init__(self, keyspace):
+        self.keyspace = keyspace
+        self.db_table = '%s_changelog' % keyspace.db_table
+        self.model = self.get_model_class()
+        self.consumer_model = self.get_consumer_model_class()
+
+    def get_model_class(self):
+        class BaseModel(Model):
+            seq = PrimaryKeyAutoIncrementField()
+            row_key = IntegerField()
+            column = TextField()
+            operation = TextField()
+            value = TextField(null=True)
+            timestamp = FloatField()
+
+            class Meta:
+                database = self.keyspace.database
+
+        class Meta:
+            db_table = self.db_table
+
+        return type(self.db_table, (BaseModel,), {'Meta': Meta})
+
+    def get_consumer_model_class(self):
+        class BaseModel(Model):
+            name = TextField(unique=True)
+            position = IntegerField(default=0)
+
+            class Meta:
+                database = self.keyspace.database
+
+        class Meta:
+            db_table = '%s_consumers' % self.db_table
+
+        return type(Meta.db_table, (BaseModel,), {'Meta': Meta})
+
+    def create(self):
+        self.model.create_table(True)
+        self.consumer_model.create_table(True)
+        latest = self.keyspace._latest_condition('old')
+        params = {
+            'log': self.db_table,
+            'keyspace': self.keyspace.db_table,
+            'when': 'WHEN %s ' % latest if latest else ''}
+
+        # A replaced cell does not fire the delete trigger, so inserts check
+        # for an existing cell to tell an update from an insert.
+        self.keyspace.database.execute_sql(
+            'CREATE TRIGGER IF NOT EXISTS %(log)s_insert '
+            'BEFORE INSERT ON %(keyspace)s '
+            'FOR EACH ROW BEGIN '
+            'INSERT INTO %(log)s '
+            '(row_key, column, operation, value, timestamp) '
+            'VALUES (new.row_key, new.column, CASE WHEN EXISTS ('
+            'SELECT 1 FROM %(keyspace)s WHERE '
+            'row_key = new.row_key AND column = new.column) '
+            'THEN \'update\' ELSE \'insert\' END, '
+            'new.value, new.timestamp); '
+            'END' % params)
+        self.keyspace.database.execute_sql(
+            'CREATE TRIGGER IF NOT EXISTS %(log)s_delete '
+            'AFTER DELETE ON %(keyspace)s '
+            'FOR EACH ROW %(when)sBEGIN '
+            'INSERT INTO %(log)s '
+            '(row_key, column, operation, value, timestamp) '
+            'VALUES (old.row_key, old.column, \'delete\', NULL, '
+            '(julianday(\'now\') - 2440587.5) * 86400.0); '
+            'END' % params)
+
+    def drop(self):
+        for name in ('_insert', '_delete'):
+            self.keyspace.database.execute_sql(
+                'DROP TRIGGER IF EXISTS %s%s' % (self.db_table, name))
+        self.consumer_model.drop_table(True)
+        self.model.drop_table(True)
+
+    def consumer(self, name):
+        return Consumer(self, name)
+
+    def remove_consumer(self, name):
+        (self.consumer_model
+         .delete()
+         .where(self.consumer_model.name == name)
+         .execute())
+
+    def read(self, after=0, batch_size=100):
+        python_value = self.keyspace.model.value.python_value
+        query = (self.model
+                 .select(
+                     self.model.seq,
+                     self.model.row_key,
+                     self.model.column,
+                     self.model.operation,
+                     self.model.value,
+                     self.model.timestamp)
+                 .where(self.model.seq > after)
+                 .order_by(self.model.seq)
+                 .limit(batch_size)
+                 .tuples())
+        return [Change(seq, row_key, column, operation,
+                       python_value(value), timestamp)
+                for seq, row_key, column, operation, value, timestamp
+                in query]
+
+    def compact(self):
+        # Remove entries that every consumer has acknowledged. Nothing is
+        # removed when there are no consumers.
+        position = (self.consumer_model
+                    .select(fn.MIN(self.consumer_model.position))
+                    .scalar())
+        if position is None:
+            return 0
+        return (self.model
+                .delete()
+                .where(self.model.seq <= position)
+                .execute())
+
+
+class Consumer(object):
+    def __init__(self, changelog, name):
+        self.changelog = changelog
+        self.name = name
+        self.model = changelog.consumer_model
+        self.model.insert(name=name).on_conflict('IGNORE').execute()
+
+    @property
+    def position(self):
+        return (self.model
+                .select(self.model.position)
+                .where(self.model.name == self.name)
+                .scalar())
+
+    def read(self, batch_size=100):
+        # Return the next batch of changes after the acknowledged position.
+        return self.changelog.read(self.position, batch_size)
+
+    def ack(self, seq):
+        # Acknowledge all changes up to and including `seq`.
+        if isinstance(seq, Change):
+            seq = seq.seq
+        (self.model
+         .update(position=fn.MAX(self.model.position, seq))
+         .where(self.model.name == self.name)
+         .execute())
+
+
+class _PeriodicTask(object):
+    # Runs `run_once()` on a daemon thread every `interval` seconds until
+    # stopped. The thread uses its own connection, so this requires an on-disk
+    # database.
+    def __init__(self, database, interval):
+        self.database = database
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def run_once(self):
+        raise NotImplementedError
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception('Error running %s.', type(self).__name__)
+        if not self.database.is_closed():
+            self.database.close()
+
+
+class Compactor(_PeriodicTask):
+    # Periodically removes all but the newest `keep` versions of each cell of
+    # a versioned keyspace.
+    def __init__(self, keyspace, keep=1, interval=60, batch_size=1000):
+        super(Compactor, self).__init__(keyspace.database, interval)
+        self.keyspace = keyspace
+        self.keep = keep
+        self.batch_size = batch_size
+
+    def run_once(self):
+        return self.keyspace.compact(self.keep, self.batch_size)
+
+
+class Purger(_PeriodicTask):
+    # Periodically deletes the expired rows of a keyspace, a batch at a
+    # time, pausing between batches.
+    def __init__(self, keyspace, interval=60, batch_size=500, pause=0.05):
+        super(Purger, self).__init__(keyspace.database, interval)
+        self.keyspace = keyspace
+        self.batch_size = batch_size
+        self.pause = pause
+
+    def run_once(self):
+        return self.keyspace.purge(self.batch_size, self.pause)
+
+
+class Expiry(object):
+    # Expiration times of rows, kept in a side table so that writing a cell
+    # does not rewrite it. With a `ttl`, a trigger gives each new row an
+    # expiration time `ttl` seconds after its first cell was written. Rows
+    # that have expired are no longer read, and are deleted by purge(). A
+    # NULL expiration time marks a row that never expires.
+    def __init__(self, keyspace, ttl=None):
+        self.keyspace = keyspace
+        self.ttl = ttl
+        self.db_table = '%s_expiry' % keyspace.db_table
+        self.model = self.get_model_class()
+
+    def get_model_class(self):
+        class BaseModel(Model):
+            row_key = IntegerField(unique=True)
+            expires = FloatField(index=True, null=True)
+
+            class Meta:
+                database = self.keyspace.database
+
+        class Meta:
+            db_table = self.db_table
+
+        return type(self.db_table, (BaseModel,), {'Meta': Meta})
+
+    def create(self):
+        self.model.create_table(True)
+        self._drop_triggers()
+        params = {
+            'expiry': self.db_table,
+            'keyspace': self.keyspace.db_table,
+            'ttl': float(self.ttl or 0)}
+
+        # Conflict clauses in a trigger are overridden by the statement's
+        # (cells are replaced with INSERT OR REPLACE), so the existing
+        # expiration time is checked for explicitly.
+        if self.ttl:
+            self.keyspace.database.execute_sql(
+                'CREATE TRIGGER %(expiry)s_insert '
+                'AFTER INSERT ON %(keyspace)s '
+                'FOR EACH ROW BEGIN '
+                'INSERT INTO %(expiry)s (row_key, expires) '
+                'SELECT new.row_key, new.timestamp + %(ttl)r '
+                'WHERE NOT EXISTS (SELECT 1 FROM %(expiry)s '
+                'WHERE row_key = new.row_key); '
+                'END' % params)
+
+        # The expiration time is removed along with the row's last cell.
+        self.keyspace.database.execute_sql(
+            'CREATE TRIGGER %(expiry)s_delete '
+            'AFTER DELETE ON %(keyspace)s '
+            'FOR EACH ROW BEGIN '
+            'DELETE FROM %(expiry)s WHERE row_key = old.row_key AND '
+            'NOT EXISTS (SELECT 1 FROM %(keyspace)s '
+            'WHERE row_key = old.row_key); '
+            'END' % params)
+
+    def _drop_triggers(self):
+        for name in ('_insert', '_delete'):
+            self.keyspace.database.execute_sql(
+                'DROP TRIGGER IF EXISTS %s%s' % (self.db_table, name))
+
+    def drop(self):
+        self._drop_triggers()
+        self.model.drop_table(True)
+
+    def expired(self, now=None):
+        # Query for the row_keys that have expired.
+        if now is None:
+            now = time.time()
+        return (self.model
+                .select(self.model.row_key)
+                .where(self.model.expires <= now))
+
+    def get(self, row_key):
+        return (self.model
+                .select(self.model.expires)
+                .where(self.model.row_key == row_key)
+                .scalar())
+
+    def set(self, row_key, timestamp):
+        (self.model
+         .insert(row_key=row_key, expires=timestamp)
+         .on_conflict('REPLACE')
+         .execute())
+
+    def purge(self, batch_size=500, pause=0, max_batches=None):
+        # Delete expired rows, oldest first, `batch_size` rows per
+        # transaction, sleeping `pause` seconds between batches so that
+        # other writers can take the write lock. Returns the number of rows
+        # deleted.
+        database = self.keyspace.database
+        keyspace = self.keyspace.model
+        now = time.time()
+        batches = total = 0
+        while max_batches is None or batches < max_batches:
+            with database.atomic():
+                query = (self
+                         .expired(now)
+                         .order_by(self.model.expires)
+                         .limit(batch_size)
+                         .tuples())
+                row_keys = [row_key for row_key, in query]
+                if row_keys:
+                    (keyspace
+                     .delete()
+                     .where(keyspace.row_key << row_keys)
+                     .execute())
+                    # Rows without any cells are not removed by the trigger.
+                    self.model.delete().where(
+                        self.model.row_key << row_keys).execute()
+            total += len(row_keys)
+            batches += 1
+            if len(row_keys) < batch_size:
+                break
+            if pause:
+                time.sleep(pause)
+        return total
+
+
+class RowCache(object):
+    # LRU cache of cell values keyed by (row_key, column), bounded by number
+    # of entries and (optionally) by the size of the encoded values. Cells
+    # are invalidated by the write paths of Row and KeySpace. Writes made
+    # through other connections, including other processes, are detected
+    # with PRAGMA data_version and flush the whole cache. With a connection
+    # pool, the readers also see the writes of the pool's own writer, so
+    # the writer's data_version is used to tell them apart.
+    def __init__(self, keyspace, max_entries=10000, max_bytes=None,
+                 check_data_version=True):
+        self.keyspace = keyspace
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.check_data_version = check_data_version
+        self.hits = self.misses = self.evictions = 0
+        self._cells = OrderedDict()
+        self._columns = defaultdict(set)
+        self._bytes = 0
+        self._generation = 0
+        self._versions = {}
+        self._writer_version = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cells)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._cells),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / total if total else 0.}
+
+    def _check_version(self):
+        # data_version changes when another connection commits. The
+        # connection itself is stored along with its version so that its
+        # id cannot be reused while it is tracked.
+        database = self.keyspace.database
+        conn = database.get_conn()
+        version = conn.execute('PRAGMA data_version').fetchone()[0]
+        with self._lock:
+            previous = self._versions.get(id(conn))
+            if previous is not None and previous[1] != version:
+                if not self._own_writes(database._pool, conn):
+                    self._clear()
+            elif previous is None and len(self._versions) >= 64:
+                self._versions.clear()
+                self._clear()
+            elif (database._pool is not None and not self._cells and
+                  self._writer_version is None):
+                # Nothing is cached yet, so the writer's current version
+                # can be recorded without clearing.
+                self._writer_version = database._pool.writer_version()
+            self._versions[id(conn)] = (conn, version)
+
+    def _own_writes(self, pool, conn):
+        # Whether a change seen by a pooled reader can only have come from
+        # the pool's writer, whose writes are invalidated precisely. The
+        # cache is cleared whenever the writer's version changes.
+        if pool is None or not pool.is_reader(conn):
+            return False
+        version = pool.writer_version()
+        own = version is not None and version == self._writer_version
+        self._writer_version = version
+        return own
+
+    def get(self, row_key, column, fetch):
+        if self.check_data_version:
+            self._check_version()
+        key = (row_key, column)
+        with self._lock:
+            if key in self._cells:
+                self.hits += 1
+                value = self._cells.pop(key)
+                self._cells[key] = value
+                return value
+            self.misses += 1
+            generation = self._generation
+
+        value = fetch()
+
+        # Values read inside a transaction may be rolled back, and values
+        # read while the cache was being invalidated may be stale.
+        if self.keyspace.database.transaction_depth():
+            return value
+        with self._lock:
+            if generation == self._generation:
+                self._add(key, value)
+        return value
+
+    def _add(self, key, value):
+        self._cells[key] = value
+        self._columns[key[0]].add(key[1])
+        self._bytes += len(value or '')
+        while self._cells and (
+                len(self._cells) > self.max_entries or
+                (self.max_bytes is not None and
+                 self._bytes > self.max_bytes)):
+            self._remove(next(iter(self._cells)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        value = self._cells.pop(key)
+        self._bytes -= len(value or '')
+        columns = self._columns[key[0]]
+        columns.discard(key[1])
+        if not columns:
+            del self._columns[key[0]]
+
+    def invalidate(self, row_key, columns=None):
+        # Remove the given columns of a row, or all of its columns.
+        with self._lock:
+            self._generation += 1
+            if columns is None:
+                columns = list(self._columns.get(row_key, ()))
+            for column in columns:
+                if (row_key, column) in self._cells:
+                    self._remove((row_key, column))
+
+    def _clear(self):
+        self._generation += 1
+        self._cells.clear()
+        self._columns.clear()
+        self._bytes = 0
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+
+class KeySpace(object):
+    def __init__(self, database, name, *indexes, **options):
+        key_block_size = options.pop('key_block_size', 100)
+        key_step = options.pop('key_step', 1)
+        key_offset = options.pop('key_offset', 0)
+        changelog = options.pop('changelog', False)
+        versioned = options.pop('versioned', False)
+        cache_size = options.pop('cache_size', None)
+        cache_bytes = options.pop('cache_bytes', None)
+        storage = options.pop('storage', None)
+        rollups = options.pop('rollups', ())
+        allocator = options.pop('allocator', None)
+        ttl = options.pop('ttl', None)
+        expiring = options.pop('expiring', False)
+        if options:
+            raise TypeError('Unexpected keyword arguments: %s' %
+                            ', '.join(sorted(options)))
+        self.database = database
+        self.name = name
+        self.db_table = clean(self.name)
+        self.versioned = versioned
+
+        # Cells are stored as JSON text unless a BinaryStorage is given, in
+        # which case indexes extract values using schemaless_extract().
+        self.storage = storage
+        if storage is not None:
+            database._zdicts.update(storage.zdicts)
+        self.model = self.get_model_class()
+        self.allocator = allocator or RowKeyAllocator(
+            self, key_block_size, key_step, key_offset)
+        self.changelog = ChangeLog(self) if changelog else None
+        self.expiry = None
+        if ttl or expiring:
+            self.expiry = Expiry(self, ttl)
+        self.cache = None
+        if cache_size or cache_bytes:
+            # Cached cells would still be returned after their row expired.
+            if self.expiry is not None:
+                raise ValueError('The row cache cannot be used with '
+                                 'expiring rows.')
+            self.cache = RowCache(self, cache_size or 10000, cache_bytes)
+        self._trigger_columns = None
+        self.indexes = []
+        for index in indexes:
+            index.bind(self)
+            self.indexes.append(index)
+        self.rollups = []
+        for rollup in rollups:
+            rollup.bind(self)
+            self.rollups.append(rollup)
+
+    def add_index(self, index):
+        # Add index to existing KeySpace.
+        index.bind(self)
+        index._create_triggers()
+        index._populate()
+        self.indexes.append(index)
+
+    def add_rollup(self, rollup):
+        # Add rollup to existing KeySpace, counting the cells already stored.
+        rollup.bind(self)
+        rollup._create_triggers()
+        rollup.backfill()
+        self.rollups.append(rollup)
+
+    def handler(self, fn=None, columns=None):
+        # Can be used as @keyspace.handler, or as
+        # @keyspace.handler(columns=('col1', 'col2')) to only receive events
+        # for the given columns.
+        if fn is None:
+            return lambda fn: self.handler(fn, columns)
+        def wrapper(table, row_key, column, value):
+            return fn(row_key, column, value)
+        self.database.bind_handler(self, wrapper, columns)
+        def unbind():
+            self.database.unbind_handler(self, wrapper)
+        fn.unbind = unbind
+        return fn
+
+    def get_model_class(self):
+        class BaseModel(Model):
+            row_key = IntegerField(index=True)
+            column = TextField(index=True)
+            value = _JSONField(
+                self.database.json_codec,
+                self.storage,
+                null=True)
+            timestamp = FloatField(default=time.time, index=True)
+
+            class Meta:
+                database = self.database
+                indexes = (
+                    (('row_key', 'column'), True),
+                )
+
+        attrs = {}
+        if self.versioned:
+            # Cells are appended with an increasing version. The unique index
+            # on (row_key, column, version) also serves to find the latest
+            # version of each cell.
+            attrs['version'] = IntegerField(
+                default=1,
+                constraints=[SQL('DEFAULT 1')])
+
+        class Meta:
+            db_table = self.db_table
+            if self.versioned:
+                indexes = (
+                    (('row_key', 'column', 'version'), True),
+                )
+
+        attrs['Meta'] = Meta
+        return type(self.name, (BaseModel,), attrs)
+
+    @property
+    def _extract(self):
+        if self.storage is not None:
+            return 'schemaless_extract'
+        return 'json_extract'
+
+    @property
+    def _python_json(self):
+        # Whether JSON is handled by Python functions rather than JSON1.
+        return self.storage is not None or self.database._json_fallback
+
+    def migrate_storage(self, batch_size=1000):
+        # Rewrite cells stored in a different format from the keyspace's
+        # current storage, e.g. after enabling BinaryStorage. Cells are
+        # updated in place, which does not fire the index or change log
+        # triggers. The index and rollup triggers are then re-created for
+        # the new storage. Returns the number of cells rewritten.
+        model = self.model
+        table = self.database.compiler().quote(model._meta.db_table)
+        binary = self.storage is not None
+        last = 0
+        count = 0
+        while True:
+            cursor = self.database.execute_sql(
+                'SELECT rowid, value FROM %s WHERE rowid > ? '
+                'ORDER BY rowid LIMIT ?' % table,
+                (last, batch_size),
+                require_commit=False)
+            rows = cursor.fetchall()
+            if not rows:
+                with self.database.atomic():
+                    self._create_value_triggers()
+                return count
+            last = rows[-1][0]
+            updates = []
+            for rowid, value in rows:
+                if value is None or binary != isinstance(value, basestring):
+                    continue
+                text = _decode_storage(value, self.database._zdicts)
+                if binary:
+                    text = self.storage.encode(text)
+                updates.append((text, rowid))
+            if updates:
+                with self.database.atomic():
+                    self.database.get_cursor().executemany(
+                        'UPDATE %s SET value = ? WHERE rowid = ?' % table,
+                        updates)
+                count += len(updates)
+
+    def _select_cells(self, *fields):
+        # Select the current cells, which for a versioned keyspace are the
+        # latest version of each (row_key, column).
+        model = self.model
+        query = model.select(*(fields or (
+            model.row_key,
+            model.column,
+            model.value)))
+        if self.versioned:
+            query = query.where(model.version == self._latest_version())
+        if self.expiry is not None:
+            query = query.where(model.row_key.not_in(self.expiry.expired()))
+        return query
+
+    def _latest_version(self, *expressions):
+        Cell = self.model.alias()
+        return (Cell
+                .select(fn.MAX(Cell.version))
+                .where(
+                    (Cell.row_key == self.model.row_key) &
+                    (Cell.column == self.model.column),
+                    *[expression(Cell) for expression in expressions]))
+
+    def _latest_condition(self, alias):
+        # Trigger condition that is true when the given cell is the latest
+        # version, so deleting older versions leaves the indexes alone. None
+        # if the keyspace is not versioned.
+        if not self.versioned:
+            return None
+        return (
+            'NOT EXISTS (SELECT 1 FROM %(keyspace)s WHERE '
+            'row_key = %(alias)s.row_key AND column = %(alias)s.column AND '
+            'version > %(alias)s.version)' % {
+                'keyspace': self.db_table,
+                'alias': alias})
+
+    def compact(self, keep=1, batch_size=1000):
+        # Remove all but the newest `keep` versions of each cell. Rows are
+        # deleted in batches, so the write lock is only held briefly.
+        if not self.versioned:
+            raise ValueError('%s is not versioned.' % self.name)
+        model = self.model
+        Cell = model.alias()
+        newest = (Cell
+                  .select(fn.MAX(Cell.version))
+                  .where(
+                      (Cell.row_key == model.row_key) &
+                      (Cell.column == model.column)))
+        stale = (model
+                 .select(model.id)
+                 .where(model.version + keep <= newest)
+                 .limit(batch_size))
+        total = 0
+        while True:
+            deleted = model.delete().where(model.id << stale).execute()
+            total += deleted
+            if deleted < batch_size:
+                return total
+
+    def compactor(self, keep=1, interval=60, batch_size=1000):
+        return Compactor(self, keep, interval, batch_size).start()
+
+    def _check_expiring(self):
+        if self.expiry is None:
+            raise ValueError('%s does not have expiring rows.' % self.name)
+
+    def purge(self, batch_size=500, pause=0, max_batches=None):
+        # Delete the rows that have expired. See Expiry.purge().
+        self._check_expiring()
+        return self.expiry.purge(batch_size, pause, max_batches)
+
+    def purger(self, interval=60, batch_size=500, pause=0.05):
+        self._check_expiring()
+        return Purger(self, interval, batch_size, pause).start()
+
+    def create(self):
+        self.model.create_table(True)
+        self.allocator.create()
+        if self.changelog is not None:
+            self.changelog.create()
+        if self.expiry is not None:
+            self.expiry.create()
+        self._drop_trigger()
+        self._create_trigger()
+        self._create_value_triggers()
+
+    def _create_value_triggers(self):
+        # Index and rollup triggers extract values with json_extract() or
+        # schemaless_extract() depending on the storage, so existing
+        # triggers are replaced rather than kept.
+        for index in self.indexes:
+            index._drop_triggers()
+            index._create_triggers()
+        for rollup in self.rollups:
+            rollup._drop_triggers()
+            rollup._create_triggers()
+
+    def drop(self):
+        for index in self.indexes:
+            index._drop()
+        for rollup in self.rollups:
+            rollup.drop()
+        self._drop_trigger()
+        if self.changelog is not None:
+            self.changelog.drop()
+        if self.expiry is not None:
+            self.expiry.drop()
+        # A shared allocator (see PartitionedKeySpace) outlives the keyspace.
+        if self.allocator.keyspace is self:
+            self.allocator.drop()
+        self.model.drop_table()
+
+    def analyze(self):
+        # Gather the index statistics used to order the conditions of a
+        # query plan.
+        for index in self.indexes:
+            self.database.execute_sql('ANALYZE %s' % index.db_table)
+
+    def _signal_columns(self):
+        # Columns that have handlers, or None if any handler (or no handler)
+        # wants every column.
+        handlers = self.database._handlers[self.db_table]
+        if not handlers or any(cols is None for _, cols in handlers):
+            return None
+        return sorted(set().union(*[cols for _, cols in handlers]))
+
+    def _create_trigger(self):
+        # Cells in columns without handlers are filtered out by the trigger,
+        # so they never call into Python.
+        self._trigger_columns = self._signal_columns()
+        if self._trigger_columns is None:
+            when = ''
+        else:
+            when = 'WHEN new.column IN (%s) ' % ', '.join(
+                "'%s'" % column.replace("'", "''")
+                for column in self._trigger_columns)
+        trigger_name = '%s_signal' % self.db_table
+        query = (
+            'CREATE TRIGGER IF NOT EXISTS %(trigger_name)s '
+            'AFTER INSERT ON %(keyspace)s '
+            'FOR EACH ROW %(when)sBEGIN '
+            'SELECT emit_event('
+            '\'%(keyspace)s\', new.row_key, new.column, new.value);'
+            'END') % {
+                'trigger_name': trigger_name,
+                'keyspace': self.db_table,
+                'when': when,
+            }
+        self.database.execute_sql(query)
+
+    def _drop_trigger(self):
+        trigger_name = '%s_signal' % self.db_table
+        self.database.execute_sql('DROP TRIGGER IF EXISTS %s' % trigger_name)
+
+    def _update_trigger(self):
+        # Re-create the signal trigger when the set of columns with handlers
+        # changes. The trigger is stored in the database, so processes that
+        # share a database should bind the same handlers.
+        if self._trigger_columns == self._signal_columns():
+            return
+        if self.model.table_exists():
+            with self.database.atomic():
+                self._drop_trigger()
+                self._create_trigger()
+
+    def __getitem__(self, identifier):
+        return Row(self, identifier)
+
+    def __delitem__(self, identifier):
+        row = Row(self, identifier)
         return row.delete()
 
     def get_row(self, identifier, preload=None):
         return Row(self, identifier, preload=preload)
 
+    def get_many(self, row_keys, columns=None, chunk_size=500):
+        # Fetch several rows using one query per chunk of row keys. Rows are
+        # returned in the order of `row_keys`, and keys without any (of the
+        # requested) columns are returned in `missing`.
+        row_keys = list(OrderedDict.fromkeys(row_keys))
+        data = {}
+        for i in range(0, len(row_keys), chunk_size):
+            query = (self
+                     ._select_cells(
+                         self.model.row_key,
+                         self.model.column,
+                         self.model.value)
+                     .where(self.model.row_key << row_keys[i:i + chunk_size])
+                     .tuples())
+            if columns is not None:
+                query = query.where(self.model.column << list(columns))
+            for row_key, column, value in query:
+                data.setdefault(row_key, {})[column] = value
+
+        rows = []
+        missing = []
+        for row_key in row_keys:
+            if row_key in data:
+                row = Row(self, row_key)
+                row._data.update(data[row_key])
+                rows.append(row)
+            else:
+                missing.append(row_key)
+        return ManyRows(rows, missing)
+
     def create_row(self, **data):
         return Row(self, None, **data)
 
+    def create_rows(self, rows, chunk_size=500):
+        # Bulk-insert an iterable of {column: value} dicts, returning the
+        # row keys that were assigned. Each chunk gets a contiguous block of
+        # row keys and is written in a single transaction.
+        row_keys = []
+        chunk = []
+        for data in rows:
+            chunk.append(data)
+            if len(chunk) >= chunk_size:
+                row_keys.extend(self._insert_rows(chunk))
+                chunk = []
+        if chunk:
+            row_keys.extend(self._insert_rows(chunk))
+        return row_keys
+
+    def _insert_rows(self, rows):
+        start = self.allocator.reserve(len(rows))
+        step = self.allocator.step
+        row_keys = list(range(start, start + len(rows) * step, step))
+        self._write_rows(zip(row_keys, rows))
+        return row_keys
+
+    def _write_rows(self, rows):
+        # Write (row_key, {column: value}) pairs in a single transaction.
+        model = self.model
+        quote = self.database.compiler().quote
+        sql = 'INSERT INTO %s (%s) VALUES (?, ?, ?, ?)' % (
+            quote(model._meta.db_table),
+            ', '.join(quote(field.db_column) for field in (
+                model.row_key, model.column, model.value, model.timestamp)))
+        db_value = model.value.db_value
+
+        rows = list(rows)
+        with self.database.atomic():
+            timestamp = time.time()
+            params = [
+                (row_key, column, db_value(value), timestamp)
+                for row_key, data in rows
+                for column, value in data.items()]
+            with self.database.exception_wrapper:
+                self.database.get_cursor().executemany(sql, params)
+        if self.cache is not None:
+            for row_key, data in rows:
+                self.cache.invalidate(row_key, data)
+
+    def buffered(self, max_rows=1000, max_delay=1.0, max_pending=10000):
+        return BufferedWriter(self, max_rows, max_delay, max_pending)
+
     def atomic(self):
         return self.database.atomic()
 
     def all(self):
-        query = (self.model
-                 .select(
-                     self.model.row_key,
-                     self.model.column,
-                     self.model.value)
-                 .group_by(
-                     self.model.row_key,
-                     self.model.column)
-                 .order_by(self.model.row_key, self.model.timestamp.desc())
-                 .tuples())
-        for row in row_iterator(self, query):
-            yield row
+        return ScanQuery(self)
 
 
 class Row(object):
@@ -440,8 +3121,8 @@ class Row(object):
             self.multi_set(self._data)
 
     def multi_get(self, columns):
-        query = (self.model
-                 .select(self.model.column, self.model.value)
+        query = (self.keyspace
+                 ._select_cells(self.model.column, self.model.value)
                  .where(self.model.row_key == self.identifier)
                  .group_by(self.model.column)
                  .order_by(self.model.timestamp.desc())
@@ -458,51 +3139,85 @@ class Row(object):
         return data
 
     def multi_set(self, data):
-        if not self.identifier:
-            self.identifier = (self.model
-                          .select(fn.COALESCE(
-                              fn.MAX(self.model.row_key) + 1,
-                              1))
-                          .scalar())
+        if self.identifier and self.keyspace.versioned:
+            with self.keyspace.atomic():
+                for key, value in data.items():
+                    self[key] = value
+            return
+        allocated = not self.identifier
+        if allocated:
+            self.identifier = self.keyspace.allocator.next_key()
         self.model.insert_many(rows=[
             {'column': key, 'value': value, 'row_key': self.identifier}
             for key, value in data.items()]).execute()
+        if not allocated:
+            self.keyspace.allocator.observe(self.identifier)
+        self._invalidate(data)
+
+    def _invalidate(self, columns=None):
+        # Called after every write, so that a concurrent read cannot cache
+        # the value that was replaced.
+        if self.keyspace.cache is not None:
+            self.keyspace.cache.invalidate(self.identifier, columns)
 
     def __setitem__(self, key, value):
-        if self.identifier:
-            row_key = self.identifier
+        allocated = not self.identifier
+        if allocated:
+            self.identifier = self.keyspace.allocator.next_key()
+
+        if self.keyspace.versioned:
+            # Append a new version rather than replacing the cell.
+            Cell = self.model.alias()
+            version = (Cell
+                       .select(fn.COALESCE(fn.MAX(Cell.version), 0) + 1)
+                       .where(
+                           (Cell.row_key == self.identifier) &
+                           (Cell.column == key)))
+            (self.model
+             .insert(
+                 row_key=self.identifier,
+                 column=key,
+                 value=value,
+                 timestamp=time.time(),
+                 version=version)
+             .execute())
         else:
-            row_key = fn.COALESCE(
-                self.model.select(fn.MAX(self.model.row_key) + 1),
-                1)
-
-        query = (self.model
-                 .insert(
-                     row_key=row_key,
-                     column=key,
-                     value=value,
-                     timestamp=time.time())
-                 .on_conflict('REPLACE'))
-        rowid = query.execute()
-
-        if not self.identifier:
-            self.identifier = (self.model
-                               .select(self.model.row_key)
-                               .where(self.model.id == rowid)
-                               .limit(1)
-                               .scalar())
+            (self.model
+             .insert(
+                 row_key=self.identifier,
+                 column=key,
+                 value=value,
+                 timestamp=time.time())
+             .on_conflict('REPLACE')
+             .execute())
+        if not allocated:
+            self.keyspace.allocator.observe(self.identifier)
+        self._invalidate([key])
         self._data[key] = value
 
+    def _fetch(self, key, convert=True):
+        return (self.keyspace
+                ._select_cells(self.model.value)
+                .where(
+                    (self.model.row_key == self.identifier) &
+                    (self.model.column == key))
+                .order_by(self.model.timestamp.desc())
+                .limit(1)
+                .scalar(convert=convert))
+
     def __getitem__(self, key):
         if key not in self._data:
-            self._data[key] = (self.model
-                               .select(self.model.value)
-                               .where(
-                                   (self.model.row_key == self.identifier) &
-                                   (self.model.column == key))
-                               .order_by(self.model.timestamp.desc())
-                               .limit(1)
-                               .scalar(convert=True))
+            cache = self.keyspace.cache
+            if cache is None:
+                self._data[key] = self._fetch(key)
+            else:
+                # The cache holds encoded values, which cannot be modified
+                # by the caller.
+                value = cache.get(self.identifier, key,
+                                  lambda: self._fetch(key, False))
+                if value is not None:
+                    value = self.model.value.python_value(value)
+                self._data[key] = value
         return self._data[key]
 
     def __delitem__(self, key):
@@ -512,16 +3227,71 @@ class Row(object):
                      (self.model.row_key == self.identifier) &
                      (self.model.column == key)))
         query.execute()
+        self._invalidate([key])
         try:
             del self._data[key]
         except KeyError:
             pass
 
     def delete(self):
-        return (self.model
-                .delete()
-                .where(self.model.row_key == self.identifier)
-                .execute())
+        result = (self.model
+                  .delete()
+                  .where(self.model.row_key == self.identifier)
+                  .execute())
+        self._invalidate()
+        return result
+
+    def expire(self, ttl):
+        # Expire the row `ttl` seconds from now.
+        self.expire_at(time.time() + ttl)
+
+    def expire_at(self, timestamp):
+        self.keyspace._check_expiring()
+        self.keyspace.expiry.set(self.identifier, timestamp)
+
+    def persist(self):
+        # Remove the row's expiration time. The row keeps an entry without
+        # one, so that later writes do not give it a new ttl.
+        self.keyspace._check_expiring()
+        self.keyspace.expiry.set(self.identifier, None)
+
+    def expires(self):
+        # Timestamp at which the row expires, or None.
+        self.keyspace._check_expiring()
+        return self.keyspace.expiry.get(self.identifier)
+
+    def history(self, column):
+        # Return the stored versions of a column, oldest first.
+        if not self.keyspace.versioned:
+            raise ValueError('%s is not versioned.' % self.keyspace.name)
+        query = (self.model
+                 .select(
+                     self.model.version,
+                     self.model.timestamp,
+                     self.model.value)
+                 .where(
+                     (self.model.row_key == self.identifier) &
+                     (self.model.column == column))
+                 .order_by(self.model.version)
+                 .tuples())
+        return [Version(*row) for row in query]
+
+    def as_of(self, timestamp, columns=True):
+        # Return the row's columns as they were at the given time.
+        if not self.keyspace.versioned:
+            raise ValueError('%s is not versioned.' % self.keyspace.name)
+        model = self.model
+        latest = self.keyspace._latest_version(
+            lambda Cell: Cell.timestamp <= timestamp)
+        query = (model
+                 .select(model.column, model.value)
+                 .where(
+                     (model.row_key == self.identifier) &
+                     (model.version == latest))
+                 .tuples())
+        if columns is not True:
+            query = query.where(model.column.in_(columns))
+        return dict(query)
 
     def keys(self):
         if self.identifier and not self._data:
@@ -537,3 +3307,703 @@ class Row(object):
         if self.identifier and not self._data:
             self.multi_get(True)
         return self._data.items()
+
+
+PERIODS = ('day', 'week', 'month')
+
+
+def _period(period, timestamp):
+    # Label and [start, end) timestamps, in UTC, of the period containing
+    # the given timestamp. Weeks start on Monday.
+    day = datetime.datetime(1970, 1, 1) + datetime.timedelta(
+        seconds=timestamp)
+    start = datetime.datetime(day.year, day.month, day.day)
+    if period == 'day':
+        end = start + datetime.timedelta(days=1)
+    elif period == 'week':
+        start -= datetime.timedelta(days=start.weekday())
+        end = start + datetime.timedelta(days=7)
+    else:
+        start = start.replace(day=1)
+        end = datetime.datetime(start.year + start.month // 12,
+                                start.month % 12 + 1, 1)
+    label = start.strftime('%Y%m' if period == 'month' else '%Y%m%d')
+    return (label,
+            calendar.timegm(start.timetuple()),
+            calendar.timegm(end.timetuple()))
+
+
+def _intersect(lhs, rhs):
+    low = [value for value in (lhs[0], rhs[0]) if value is not None]
+    high = [value for value in (lhs[1], rhs[1]) if value is not None]
+    return (max(low) if low else None, min(high) if high else None)
+
+
+def _union(lhs, rhs):
+    low = None if None in (lhs[0], rhs[0]) else min(lhs[0], rhs[0])
+    high = None if None in (lhs[1], rhs[1]) else max(lhs[1], rhs[1])
+    return low, high
+
+
+def _expression_bounds(expression, field):
+    # Inclusive (low, high) range of the values of `field` that can satisfy
+    # the expression, where None means unbounded.
+    unbounded = (None, None)
+    if not isinstance(expression, Expression) or expression._negated:
+        return unbounded
+    op, lhs, rhs = expression.op, expression.lhs, expression.rhs
+    if op in (OP.AND, OP.OR):
+        combine = _intersect if op == OP.AND else _union
+        return combine(_expression_bounds(lhs, field),
+                       _expression_bounds(rhs, field))
+    if not isinstance(lhs, Field) or lhs.model_class is not \
+            field.model_class or lhs.name != field.name:
+        return unbounded
+    if op == OP.BETWEEN and isinstance(rhs, Clause):
+        values = [rhs.nodes[0], rhs.nodes[-1]]
+    elif op == OP.IN and isinstance(rhs, (list, tuple)):
+        values = list(rhs)
+    elif op in (OP.EQ, OP.LT, OP.LTE, OP.GT, OP.GTE):
+        values = [rhs]
+    else:
+        return unbounded
+    if not values or not all(isinstance(value, (int, float))
+                             for value in values):
+        return unbounded
+    return (None if op in (OP.LT, OP.LTE) else min(values),
+            None if op in (OP.GT, OP.GTE) else max(values))
+
+
+class _PartitionAllocator(RowKeyAllocator):
+    # Row keys are shared by all the partitions of a keyspace, so a row key
+    # identifies a single row. A new sequence continues from the largest key
+    # recorded in the partition registry.
+    def _seed(self):
+        self.keyspace.database.execute_sql(
+            'INSERT INTO %(sequence)s (id, next_key) '
+            'SELECT 1, (SELECT COALESCE(MAX(max_key) + 1, 1) '
+            'FROM %(registry)s) '
+            'WHERE NOT EXISTS (SELECT 1 FROM %(sequence)s)' % {
+                'sequence': self.db_table,
+                'registry': self.keyspace.registry._meta.db_table})
+
+
+class PartitionedKeySpace(object):
+    # Keyspace split into one table per day, week or month. Each partition
+    # is a KeySpace with its own copies of the indexes, and a row is stored
+    # in the partition of its creation time, or of the timestamp found at
+    # `timestamp=(column, path)`. A registry table records each partition's
+    # period and range of row keys. Queries only read the partitions that
+    # can match, and old data is removed by dropping whole partitions.
+    def __init__(self, database, name, *indexes, **options):
+        period = options.pop('period', 'day')
+        timestamp = options.pop('timestamp', None)
+        key_block_size = options.pop('key_block_size', 100)
+        if period not in PERIODS:
+            raise ValueError('Unrecognized period "%s", must be one of %s.' %
+                             (period, ', '.join(PERIODS)))
+        if options.get('rollups'):
+            raise ValueError('Rollups are not supported by partitioned '
+                             'keyspaces.')
+        self.database = database
+        self.name = name
+        self.db_table = clean(self.name)
+        self.period = period
+        self.timestamp = timestamp
+
+        # Remaining options are passed to the KeySpace of each partition.
+        self.options = options
+        self.registry = self.get_registry_class()
+        self.allocator = _PartitionAllocator(self, key_block_size)
+        self.indexes = []
+        for index in indexes:
+            index.bind(self)
+            self.indexes.append(index)
+        self._partitions = {}
+        self._created = set()
+        self._lock = threading.Lock()
+
+    def get_registry_class(self):
+        class BaseModel(Model):
+            name = TextField(unique=True)
+            start = FloatField(index=True)
+            end = FloatField()
+            min_key = IntegerField(null=True)
+            max_key = IntegerField(null=True)
+
+            class Meta:
+                database = self.database
+
+        class Meta:
+            db_table = '%s_partitions' % self.db_table
+
+        return type(Meta.db_table, (BaseModel,), {'Meta': Meta})
+
+    def create(self):
+        self.registry.create_table(True)
+        self.allocator.create()
+        for partition in self.partitions():
+            partition.create()
+
+    def drop(self):
+        for partition in self.partitions():
+            partition.drop()
+        self.allocator.drop()
+        self.registry.drop_table(True)
+        with self._lock:
+            self._partitions.clear()
+            self._created.clear()
+
+    def analyze(self):
+        for partition in self.partitions():
+            partition.analyze()
+
+    def add_index(self, index):
+        # Add index to the template and to every existing partition.
+        index.bind(self)
+        self.indexes.append(index)
+        for partition in self.partitions():
+            partition.add_index(index.clone())
+
+    def _keyspace(self, name):
+        with self._lock:
+            if name not in self._partitions:
+                self._partitions[name] = KeySpace(
+                    self.database,
+                    name,
+                    *[index.clone() for index in self.indexes],
+                    allocator=self.allocator,
+                    **self.options)
+            return self._partitions[name]
+
+    def partitions(self, start=None, end=None):
+        # Partitions overlapping [start, end), oldest first.
+        registry = self.registry
+        query = (registry
+                 .select(registry.name)
+                 .order_by(registry.start)
+                 .tuples())
+        if start is not None:
+            query = query.where(registry.end > start)
+        if end is not None:
+            query = query.where(registry.start < end)
+        return [self._keyspace(name) for name, in query]
+
+    def partition(self, timestamp):
+        # Partition for the given timestamp, which is created if needed.
+        label, start, end = _period(self.period, timestamp)
+        name = '%s_%s' % (self.name, label)
+        keyspace = self._keyspace(name)
+        if name not in self._created:
+            with self.database.atomic():
+                keyspace.create()
+                self.database.execute_sql(
+                    'INSERT OR IGNORE INTO %s (name, start, end) '
+                    'VALUES (?, ?, ?)' % self.registry._meta.db_table,
+                    (name, start, end))
+            with self._lock:
+                self._created.add(name)
+        return keyspace
+
+    def _partition_for(self, data):
+        if self.timestamp is None:
+            return self.partition(time.time())
+        column, path = self.timestamp
+        value = _lookup(data.get(column), path)
+        if value is _missing or not isinstance(value, (int, float)):
+            raise ValueError('Row does not have a timestamp at %s %s.' %
+                             (column, path))
+        return self.partition(value)
+
+    def _record_keys(self, keyspace, row_keys):
+        self.database.execute_sql(
+            'UPDATE %s SET '
+            'min_key = MIN(COALESCE(min_key, ?), ?), '
+            'max_key = MAX(COALESCE(max_key, ?), ?) '
+            'WHERE name = ?' % self.registry._meta.db_table,
+            (min(row_keys), min(row_keys), max(row_keys), max(row_keys),
+             keyspace.name))
+
+    def create_row(self, **data):
+        keyspace = self._partition_for(data)
+        with self.database.atomic():
+            row = keyspace.create_row(**data)
+            self._record_keys(keyspace, [row.identifier])
+        return row
+
+    def create_rows(self, rows, chunk_size=500):
+        # Rows are grouped by partition, and the row keys are returned in
+        # the order the rows were given.
+        rows = list(rows)
+        groups = OrderedDict()
+        for i, data in enumerate(rows):
+            keyspace = self._partition_for(data)
+            groups.setdefault(keyspace.name, (keyspace, []))[1].append(i)
+        row_keys = [None] * len(rows)
+        for keyspace, positions in groups.values():
+            with self.database.atomic():
+                keys = keyspace.create_rows(
+                    [rows[i] for i in positions],
+                    chunk_size)
+                self._record_keys(keyspace, keys)
+            for i, row_key in zip(positions, keys):
+                row_keys[i] = row_key
+        return row_keys
+
+    def _key_ranges(self):
+        registry = self.registry
+        query = (registry
+                 .select(registry.name, registry.min_key, registry.max_key)
+                 .where(registry.min_key.is_null(False))
+                 .order_by(registry.start.desc())
+                 .tuples())
+        return [(self._keyspace(name), low, high)
+                for name, low, high in query]
+
+    def _find(self, row_key):
+        # Partition containing the row, checking the partitions whose range
+        # of row keys includes it, newest first.
+        for keyspace, low, high in self._key_ranges():
+            if low <= row_key <= high:
+                model = keyspace.model
+                exists = (model
+                          .select(SQL('1'))
+                          .where(model.row_key == row_key)
+                          .exists())
+                if exists:
+                    return keyspace
+        raise KeyError(row_key)
+
+    def __getitem__(self, identifier):
+        return self._find(identifier)[identifier]
+
+    def __delitem__(self, identifier):
+        keyspace = self._find(identifier)
+        del keyspace[identifier]
+
+    def get_row(self, identifier, preload=None):
+        return self._find(identifier).get_row(identifier, preload)
+
+    def get_many(self, row_keys, columns=None, chunk_size=500):
+        row_keys = list(OrderedDict.fromkeys(row_keys))
+        found = {}
+        for keyspace, low, high in self._key_ranges():
+            keys = [row_key for row_key in row_keys
+                    if low <= row_key <= high and row_key not in found]
+            if keys:
+                for row in keyspace.get_many(keys, columns, chunk_size).rows:
+                    found[row.identifier] = row
+        return ManyRows(
+            [found[row_key] for row_key in row_keys if row_key in found],
+            [row_key for row_key in row_keys if row_key not in found])
+
+    def all(self, start=None, end=None):
+        # Every row of the partitions overlapping [start, end).
+        return PartitionedQuery([partition.all()
+                                 for partition in self.partitions(start, end)])
+
+    def _bounds(self, idx_query):
+        # Range of timestamps the query can match, from its conditions on an
+        # index of the partitioning path.
+        bounds = (None, None)
+        index = idx_query.index
+        if self.timestamp is not None and \
+                type(index) is Index and \
+                (index.column, index.path) == tuple(self.timestamp):
+            bounds = _expression_bounds(idx_query.expression,
+                                        index.model.value)
+        for op, rhs in idx_query.query_operations:
+            combine = _intersect if op is operator.and_ else _union
+            bounds = combine(bounds, self._bounds(rhs))
+        return bounds
+
+    def query(self, idx_query, start=None, end=None):
+        # Run an index query, built on this keyspace's indexes, against the
+        # partitions overlapping [start, end). Partitions outside the range
+        # of a condition on the partitioning path are skipped too.
+        low, high = self._bounds(idx_query)
+        if low is not None:
+            start = low if start is None else max(start, low)
+        if high is not None:
+            high = _period(self.period, high)[2]
+            end = high if end is None else min(end, high)
+        return PartitionedQuery([idx_query.rebind(partition)
+                                 for partition in self.partitions(start, end)])
+
+    def drop_before(self, timestamp):
+        # Remove the partitions that end at or before the timestamp. Each
+        # partition's tables are dropped, rather than its rows deleted one
+        # at a time. Returns the names of the partitions removed.
+        registry = self.registry
+        names = [name for name, in (registry
+                                    .select(registry.name)
+                                    .where(registry.end <= timestamp)
+                                    .order_by(registry.start)
+                                    .tuples())]
+        for name in names:
+            with self.database.atomic():
+                self._keyspace(name).drop()
+                registry.delete().where(registry.name == name).execute()
+            with self._lock:
+                self._partitions.pop(name, None)
+                self._created.discard(name)
+        return names
+
+    def atomic(self):
+        return self.database.atomic()
+
+
+def _keyed_rows(rows, position, sign):
+    for row in rows:
+        yield sign * row.identifier, position, row
+
+
+class PartitionedQuery(object):
+    # Rows matching a query in several partitions, merged in row_key order.
+    # Limits and row_key bounds are applied in each partition, then to the
+    # merged rows.
+    def __init__(self, queries, reverse=False):
+        self.queries = queries
+        self.reverse = reverse
+        self._limit = None
+
+    def _clone(self, queries):
+        clone = PartitionedQuery(queries, self.reverse)
+        clone._limit = self._limit
+        return clone
+
+    def _map(self, fn):
+        return self._clone([fn(query) for query in self.queries])
+
+    def _each(self, fn):
+        return [fn(query) for query in self.queries]
+
+    def _rows(self):
+        return self.queries
+
+    def __neg__(self):
+        clone = self._map(operator.neg)
+        clone.reverse = not self.reverse
+        return clone
+
+    def limit(self, limit):
+        clone = self._map(lambda query: query.limit(limit))
+        clone._limit = limit
+        return clone
+
+    def after(self, row_key):
+        return self._map(lambda query: query.after(row_key))
+
+    def before(self, row_key):
+        return self._map(lambda query: query.before(row_key))
+
+    def columns(self, *columns):
+        return self._map(lambda query: query.columns(*columns))
+
+    def paths(self, column, *paths):
+        return self._map(lambda query: query.paths(column, *paths))
+
+    def count(self):
+        total = sum(self._each(lambda query: query.count()))
+        if self._limit is not None:
+            return min(total, self._limit)
+        return total
+
+    def __iter__(self):
+        sign = -1 if self.reverse else 1
+        rows = heapq.merge(*[_keyed_rows(query_rows, i, sign)
+                             for i, query_rows in enumerate(self._rows())])
+        for _, _, row in itertools.islice(rows, self._limit):
+            yield row
+
+
+class ShardedSchemaless(object):
+    # Spreads each keyspace over several database files, so that writes to
+    # different shards do not contend for the same write lock. A row is
+    # stored in shard `(row_key - 1) % len(shards)`: each shard's allocator
+    # only hands out the keys of its own shard, so keys are unique without
+    # any coordination between the files. Queries run on every shard using
+    # a pool of threads, each with its own connections, which requires
+    # on-disk databases.
+    def __init__(self, filenames, workers=None, **kwargs):
+        self.shards = [Schemaless(filename, **kwargs)
+                       for filename in filenames]
+        if not self.shards:
+            raise ValueError('At least one database file is required.')
+        self.pool = ThreadPool(workers or len(self.shards))
+
+    def map(self, fn, items):
+        return self.pool.map(fn, items)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        for shard in self.shards:
+            if not shard.is_closed():
+                shard.close()
+
+    def keyspace(self, item, *indexes, **options):
+        return ShardedKeySpace(self, item, *indexes, **options)
+
+
+class ShardedKeySpace(object):
+    # A KeySpace in each shard, with its own copies of the indexes and
+    # rollups. New rows are assigned to the shards in turn.
+    def __init__(self, database, name, *indexes, **options):
+        if options.get('allocator'):
+            raise ValueError('Sharded keyspaces allocate the row keys of '
+                             'each shard, and do not accept an allocator.')
+        rollups = options.pop('rollups', ())
+        self.database = database
+        self.name = name
+        self.db_table = clean(self.name)
+        self.indexes = []
+        for index in indexes:
+            index.bind(self)
+            self.indexes.append(index)
+        self.rollups = list(rollups)
+        shards = database.shards
+        self.keyspaces = [
+            shard.keyspace(
+                name,
+                *[index.clone() for index in indexes],
+                rollups=[rollup.clone() for rollup in rollups],
+                key_step=len(shards),
+                key_offset=i,
+                **options)
+            for i, shard in enumerate(shards)]
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def create(self):
+        for keyspace in self.keyspaces:
+            keyspace.create()
+
+    def drop(self):
+        for keyspace in self.keyspaces:
+            keyspace.drop()
+
+    def analyze(self):
+        for keyspace in self.keyspaces:
+            keyspace.analyze()
+
+    def add_rollup(self, rollup):
+        for keyspace in self.keyspaces:
+            keyspace.add_rollup(rollup.clone())
+        self.rollups.append(rollup)
+
+    def _next_shard(self):
+        with self._lock:
+            return next(self._counter) % len(self.keyspaces)
+
+    def shard_for(self, row_key):
+        return self.keyspaces[(row_key - 1) % len(self.keyspaces)]
+
+    def __getitem__(self, identifier):
+        return self.shard_for(identifier)[identifier]
+
+    def __delitem__(self, identifier):
+        del self.shard_for(identifier)[identifier]
+
+    def get_row(self, identifier, preload=None):
+        return self.shard_for(identifier).get_row(identifier, preload)
+
+    def create_row(self, **data):
+        return self.keyspaces[self._next_shard()].create_row(**data)
+
+    def create_rows(self, rows, chunk_size=500):
+        # Rows are dealt out to the shards, which write them in parallel.
+        # The row keys are returned in the order the rows were given.
+        rows = list(rows)
+        count = len(self.keyspaces)
+        first = self._next_shard()
+        positions = [[] for keyspace in self.keyspaces]
+        for i in range(len(rows)):
+            positions[(first + i) % count].append(i)
+
+        def write(shard):
+            return self.keyspaces[shard].create_rows(
+                [rows[i] for i in positions[shard]],
+                chunk_size)
+
+        row_keys = [None] * len(rows)
+        for shard, keys in enumerate(self.database.map(write, range(count))):
+            for i, row_key in zip(positions[shard], keys):
+                row_keys[i] = row_key
+        return row_keys
+
+    def get_many(self, row_keys, columns=None, chunk_size=500):
+        row_keys = list(OrderedDict.fromkeys(row_keys))
+        count = len(self.keyspaces)
+
+        def fetch(shard):
+            keys = [row_key for row_key in row_keys
+                    if (row_key - 1) % count == shard]
+            if not keys:
+                return []
+            return self.keyspaces[shard].get_many(
+                keys, columns, chunk_size).rows
+
+        found = {}
+        for rows in self.database.map(fetch, range(count)):
+            for row in rows:
+                found[row.identifier] = row
+        return ManyRows(
+            [found[row_key] for row_key in row_keys if row_key in found],
+            [row_key for row_key in row_keys if row_key not in found])
+
+    def all(self):
+        return ShardedQuery(self, [keyspace.all()
+                                   for keyspace in self.keyspaces])
+
+    def query(self, idx_query):
+        # Run an index query, built on this keyspace's indexes, on every
+        # shard.
+        return ShardedQuery(
+            self,
+            [idx_query.rebind(keyspace) for keyspace in self.keyspaces],
+            idx_query.index)
+
+    def _aggregate(self, index, method, args, queries=None):
+        # Run an Index aggregate on every shard, restricted to the rows
+        # matched by each shard's query, if given.
+        position = [i for i, template in enumerate(self.indexes)
+                    if template is index]
+        if not position:
+            raise ValueError('%s is not an index of %s.' % (
+                index.name, self.name))
+
+        def run(shard):
+            shard_index = self.keyspaces[shard].indexes[position[0]]
+            row_keys = queries[shard].row_keys() if queries else None
+            return getattr(shard_index, method)(*(args + (row_keys,)))
+
+        return self.database.map(run, range(len(self.keyspaces)))
+
+    # Aggregates over all the shards' index tables, combined as the
+    # single-file Index methods would return them.
+    def count(self, index, path=None):
+        return sum(self._aggregate(index, 'count', (path,)))
+
+    def distinct(self, index, path=None):
+        return _merge_distinct(self._aggregate(index, 'distinct', (path,)))
+
+    def group_counts(self, index, limit=None, path=None):
+        return _merge_counts(
+            self._aggregate(index, 'group_counts', (None, path)),
+            limit)
+
+    def min(self, index, path=None):
+        return _merge_extreme(min, self._aggregate(index, 'min', (path,)))
+
+    def max(self, index, path=None):
+        return _merge_extreme(max, self._aggregate(index, 'max', (path,)))
+
+    def _rollup(self, rollup, method, *args):
+        # Run a Rollup method on every shard's copy of the rollup.
+        position = [i for i, template in enumerate(self.rollups)
+                    if template is rollup]
+        if not position:
+            raise ValueError('%s is not a rollup of %s.' % (
+                rollup.name, self.name))
+
+        def run(keyspace):
+            return getattr(keyspace.rollups[position[0]], method)(*args)
+
+        return self.database.map(run, self.keyspaces)
+
+    def rollup_query(self, rollup, value=None, start=None, end=None):
+        return _merge_buckets(
+            self._rollup(rollup, 'query', value, start, end),
+            rollup.sums)
+
+    def rollup_totals(self, rollup, start=None, end=None, limit=None):
+        return _merge_counts(self._rollup(rollup, 'totals', start, end),
+                             limit)
+
+    def histogram(self, index, bucket_size, start=0, path=None):
+        return sorted(_merge_counts(self._aggregate(
+            index, 'histogram', (bucket_size, start, path))))
+
+
+def _merge_distinct(results):
+    values = heapq.merge(*results)
+    return [value for value, _ in itertools.groupby(values)]
+
+
+def _merge_counts(results, limit=None):
+    # Sum the (value, count) pairs of each shard, most common first.
+    counts = defaultdict(int)
+    for pairs in results:
+        for value, count in pairs:
+            counts[value] += count
+    ordered = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+    return ordered[:limit] if limit is not None else ordered
+
+
+def _merge_buckets(results, sums):
+    # Add up the RollupBuckets of each shard, ordered by value and bucket.
+    merged = {}
+    for buckets in results:
+        for item in buckets:
+            key = (item.value, item.bucket)
+            if key in merged:
+                total = merged[key]
+                item = item._replace(
+                    count=total.count + item.count,
+                    sums=dict((path, total.sums[path] + item.sums[path])
+                              for path in sums))
+            merged[key] = item
+    return [merged[key] for key in sorted(merged)]
+
+
+def _merge_extreme(fn, results):
+    values = [value for value in results if value is not None]
+    return fn(values) if values else None
+
+
+class ShardedQuery(PartitionedQuery):
+    # Query run on every shard. Each shard's rows are read in full on the
+    # thread pool, then merged in row_key order, so large results should be
+    # read a page at a time with limit() and after().
+    def __init__(self, keyspace, queries, index=None, reverse=False):
+        super(ShardedQuery, self).__init__(queries, reverse)
+        self.keyspace = keyspace
+        self.index = index
+
+    def _clone(self, queries):
+        clone = ShardedQuery(self.keyspace, queries, self.index, self.reverse)
+        clone._limit = self._limit
+        return clone
+
+    def _each(self, fn):
+        return self.keyspace.database.map(fn, self.queries)
+
+    def _rows(self):
+        return self._each(list)
+
+    # Aggregates over the values of the query's index (or another index of
+    # the keyspace) for the matching rows.
+    def _aggregate(self, index, method, args):
+        if index is None and self.index is None:
+            raise ValueError('An index is required to aggregate all rows.')
+        return self.keyspace._aggregate(
+            index or self.index, method, args, self.queries)
+
+    def distinct(self, index=None, path=None):
+        return _merge_distinct(self._aggregate(index, 'distinct', (path,)))
+
+    def group_counts(self, limit=None, index=None, path=None):
+        return _merge_counts(
+            self._aggregate(index, 'group_counts', (None, path)),
+            limit)
+
+    def min(self, index=None, path=None):
+        return _merge_extreme(min, self._aggregate(index, 'min', (path,)))
+
+    def max(self, index=None, path=None):
+        return _merge_extreme(max, self._aggregate(index, 'max', (path,)))
+
+    def histogram(self, bucket_size, start=0, index=None, path=None):
+        return sorted(_merge_counts(self._aggregate(
+            index, 'histogram', (bucket_size, start, path))))
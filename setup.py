@@ -13,7 +13,7 @@ setup(
     author='Charles Leifer',
     author_email='coleifer@gmail.com',
     url='http://github.com/coleifer/sqlite-schemaless/',
-    py_modules=['schemaless'],
+    py_modules=['schemaless', 'aioschemaless'],
     install_requires=['peewee'],
     classifiers=[
         'Development Status :: 5 - Production/Stable',
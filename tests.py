@@ -1,13 +1,37 @@
 #!/usr/bin/env python
 
+import datetime
 import json
 import operator
+import os
+import shutil
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
 import unittest
+from collections import OrderedDict
 
+from peewee import fn
+from peewee import IntegrityError
 from schemaless import _json_extract_fallback
+from schemaless import _JSONFunctions
+from schemaless import get_json_codec
+from schemaless import ArrayIndex
+from schemaless import BinaryStorage
+from schemaless import CompositeIndex
 from schemaless import Index
+from schemaless import JSON_CODECS
+from schemaless import PartitionedKeySpace
+from schemaless import Rollup
 from schemaless import Schemaless
+from schemaless import ShardedSchemaless
+try:
+    import asyncio
+    from aioschemaless import AsyncSchemaless
+except (ImportError, SyntaxError):
+    AsyncSchemaless = None
 
 
 class TestKeySpace(unittest.TestCase):
@@ -114,6 +138,274 @@ class TestKeySpace(unittest.TestCase):
             {'k1': 'v1-4', 'k2': 'v2-4'},
         ])
 
+    def test_pagination(self):
+        idx = Index('data', '$.k', value_type='integer')
+        keyspace = self.db.keyspace('pages', idx)
+        keyspace.create()
+        row_keys = keyspace.create_rows(
+            {'data': {'k': i}, 'other': i} for i in range(25))
+
+        def identifiers(query):
+            return [row.identifier for row in query]
+
+        query = keyspace.all()
+        self.assertEqual(identifiers(query), row_keys)
+        # Reading every row does not look up the row_keys first.
+        self.assertFalse(' IN ' in query.query().sql()[0])
+        self.assertTrue(' IN ' in query.limit(3).query().sql()[0])
+        self.assertEqual(identifiers(query.limit(3)), row_keys[:3])
+        self.assertEqual(identifiers(query.after(row_keys[20])),
+                         row_keys[21:])
+        self.assertEqual(identifiers(query.before(row_keys[2])),
+                         row_keys[:2])
+        self.assertEqual(identifiers((-query).limit(2)),
+                         [row_keys[24], row_keys[23]])
+        self.assertEqual(
+            identifiers(query.after(row_keys[4]).before(row_keys[8])),
+            row_keys[5:8])
+
+        # Limits apply to rows rather than cells.
+        rows = list(query.limit(2))
+        self.assertEqual([row._data for row in rows], [
+            {'data': {'k': 0}, 'other': 0},
+            {'data': {'k': 1}, 'other': 1}])
+
+        query = idx.query(10, '>=')
+        self.assertEqual(identifiers(query.limit(2)), row_keys[10:12])
+        self.assertEqual(identifiers((-query).before(row_keys[20]).limit(2)),
+                         [row_keys[19], row_keys[18]])
+
+        # Streaming fetches one page at a time.
+        self.assertEqual(identifiers(query.iterate(4)), row_keys[10:])
+        self.assertEqual(identifiers((-query).iterate(4)),
+                         row_keys[10:][::-1])
+        self.assertEqual(identifiers(query.limit(6).iterate(4)),
+                         row_keys[10:16])
+        self.assertEqual(identifiers(keyspace.all().iterate(5)), row_keys)
+        self.assertEqual(list(idx.query(100).iterate(4)), [])
+
+    def test_get_many(self):
+        keyspace = self.db.keyspace('many', Index('data', '$.k'),
+                                    versioned=True)
+        keyspace.create()
+        row_keys = keyspace.create_rows(
+            {'data': {'k': i}, 'other': i} for i in range(10))
+        keyspace[row_keys[3]]['other'] = 'updated'
+        keyspace[row_keys[4]].delete()
+
+        requested = [row_keys[5], 1000, row_keys[3], row_keys[4],
+                     row_keys[0], row_keys[5]]
+        rows, missing = keyspace.get_many(requested, chunk_size=2)
+        self.assertEqual([row.identifier for row in rows],
+                         [row_keys[5], row_keys[3], row_keys[0]])
+        self.assertEqual([row._data for row in rows], [
+            {'data': {'k': 5}, 'other': 5},
+            {'data': {'k': 3}, 'other': 'updated'},
+            {'data': {'k': 0}, 'other': 0}])
+        self.assertEqual(missing, [1000, row_keys[4]])
+
+        result = keyspace.get_many(row_keys[:3], columns=('other',))
+        self.assertEqual([row._data for row in result.rows],
+                         [{'other': 0}, {'other': 1}, {'other': 2}])
+        self.assertEqual(result.missing, [])
+        self.assertEqual(keyspace.get_many([]), ([], []))
+
+    def test_row_cache(self):
+        keyspace = self.db.keyspace('cached', cache_size=3)
+        keyspace.create()
+        cache = keyspace.cache
+        row = keyspace.create_row(k1={'a': 1}, k2='v2')
+
+        self.assertEqual(keyspace[row.identifier]['k1'], {'a': 1})
+        self.assertEqual(keyspace[row.identifier]['k1'], {'a': 1})
+        self.assertEqual(keyspace[row.identifier]['missing'], None)
+        self.assertEqual(keyspace[row.identifier]['missing'], None)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 2))
+        self.assertEqual(stats['hit_rate'], .5)
+
+        # Values are decoded for each read, so they can be modified safely.
+        keyspace[row.identifier]['k1']['a'] = 2
+        self.assertEqual(keyspace[row.identifier]['k1'], {'a': 1})
+
+        # Writes invalidate the cached cells.
+        row['k1'] = {'a': 3}
+        self.assertEqual(keyspace[row.identifier]['k1'], {'a': 3})
+        del row['k1']
+        self.assertEqual(keyspace[row.identifier]['k1'], None)
+        keyspace[row.identifier].multi_set({'k1': 'v1'})
+        self.assertEqual(keyspace[row.identifier]['k1'], 'v1')
+        self.assertEqual(keyspace[row.identifier]['k2'], 'v2')
+        self.assertEqual(len(cache), 3)
+        row.delete()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(keyspace[row.identifier]['k2'], None)
+
+        # Least-recently used cells are evicted.
+        row_keys = keyspace.create_rows({'k': i} for i in range(5))
+        for row_key in row_keys:
+            self.assertEqual(keyspace[row_key]['k'], row_key - row_keys[0])
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.stats()['evictions'], 3)
+        self.assertEqual(sorted(key for key, _ in cache._cells),
+                         row_keys[2:])
+
+        # Cells read inside a transaction are not cached.
+        cache.clear()
+        with keyspace.atomic():
+            self.assertEqual(keyspace[row_keys[0]]['k'], 0)
+        self.assertEqual(len(cache), 0)
+
+        # The size of the encoded values can be bounded as well.
+        keyspace = self.db.keyspace('cached', cache_bytes=10)
+        row = keyspace.create_row(k1='x' * 6, k2='y' * 6)
+        self.assertEqual(keyspace[row.identifier]['k1'], 'x' * 6)
+        self.assertEqual(keyspace[row.identifier]['k2'], 'y' * 6)
+        self.assertEqual(list(keyspace.cache._cells),
+                         [(row.identifier, 'k2')])
+
+    def test_create_rows(self):
+        idx = Index('data', '$.k')
+        keyspace = self.db.keyspace('bulk', idx)
+        keyspace.create()
+        keyspace.create_row(data={'k': 'v0'})
+
+        accum = []
+
+        @keyspace.handler
+        def handler(row_key, column, value):
+            accum.append((row_key, column))
+
+        rows = ({'data': {'k': 'v%s' % i}, 'n': i} for i in range(1, 8))
+        row_keys = keyspace.create_rows(rows, chunk_size=3)
+        self.assertEqual(row_keys, [2, 3, 4, 5, 6, 7, 8])
+        self.assertEqual(keyspace.create_rows([]), [])
+
+        self.assertEqual([row._data for row in keyspace.all()][-2:], [
+            {'data': {'k': 'v6'}, 'n': 6},
+            {'data': {'k': 'v7'}, 'n': 7}])
+        self.assertEqual([row.identifier for row in idx.query('v3')], [4])
+        self.assertEqual(len(accum), 14)
+
+    def test_row_key_allocator(self):
+        keyspace = self.db.keyspace('alloc', key_block_size=10)
+        keyspace.create()
+        allocator = keyspace.allocator
+
+        self.assertEqual([allocator.next_key() for i in range(3)], [1, 2, 3])
+        self.assertEqual(allocator.reserve(5), 4)
+        self.assertEqual(allocator.next_key(), 9)
+
+        # Reservations larger than a block come straight from the table.
+        self.assertEqual(allocator.reserve(25), 11)
+        self.assertEqual(allocator.next_key(), 10)
+        self.assertEqual(allocator.next_key(), 36)
+
+        # A new allocator, e.g. in another process, continues after the
+        # blocks that have already been handed out.
+        keyspace2 = self.db.keyspace('alloc', key_block_size=10)
+        self.assertEqual(keyspace2.create_row(k='v').identifier, 46)
+
+        # The sequence is seeded from existing data.
+        keyspace3 = self.db.keyspace('alloc3')
+        keyspace3.model.create_table()
+        keyspace3.model.create(row_key=7, column='k', value='v')
+        keyspace3.create()
+        self.assertEqual(keyspace3.create_row(k='v').identifier, 8)
+
+        self.assertRaises(TypeError, self.db.keyspace, 'alloc', foo=1)
+
+    def test_row_key_allocator_caller_keys(self):
+        keyspace = self.db.keyspace('alloc', key_block_size=10)
+        keyspace.create()
+
+        # Rows written with keys chosen by the caller are skipped.
+        keyspace[1]['x'] = 1
+        self.assertEqual(keyspace.create_row(x=2).identifier, 2)
+        keyspace[5].multi_set({'x': 5})
+        self.assertEqual(keyspace.create_row(x=6).identifier, 6)
+        keyspace[50]['x'] = 50
+        self.assertEqual(keyspace.create_rows([{'x': 7}, {'x': 8}]), [7, 8])
+
+        # A new allocator continues after the largest key.
+        keyspace2 = self.db.keyspace('alloc')
+        self.assertEqual(keyspace2.create_row(x=51).identifier, 51)
+        self.assertEqual(
+            sorted(row['x'] for row in keyspace.all()),
+            [1, 2, 5, 6, 7, 8, 50, 51])
+
+        versioned = self.db.keyspace('alloc_versioned', versioned=True)
+        versioned.create()
+        versioned[3]['x'] = 1
+        self.assertEqual(versioned.create_row(x=2).identifier, 4)
+
+    def test_row_key_allocator_step(self):
+        keyspace = self.db.keyspace('alloc', key_block_size=4, key_step=3,
+                                    key_offset=1)
+        keyspace.create()
+        allocator = keyspace.allocator
+        self.assertEqual([allocator.next_key() for i in range(3)], [2, 5, 8])
+        self.assertEqual(keyspace.create_rows([{'k': i} for i in range(3)]),
+                         [14, 17, 20])
+
+        # Seeding from existing keys stays on the same offset.
+        keyspace2 = self.db.keyspace('alloc2', key_step=3, key_offset=1)
+        keyspace2.model.create_table()
+        keyspace2.model.create(row_key=8, column='k', value='v')
+        keyspace2.create()
+        self.assertEqual(keyspace2.create_row(k='v').identifier, 11)
+
+    def test_buffered_writer(self):
+        Model = self.keyspace.model
+        accum = []
+
+        @self.keyspace.handler
+        def handler(row_key, column, value):
+            accum.append((row_key, column, value))
+
+        writer = self.keyspace.buffered(max_rows=3, max_delay=None)
+        r1 = writer.create_row(k='v1')
+        r2 = writer.create_row(k='v2', x='y2')
+        self.assertEqual((r1.identifier, r2.identifier), (1, 2))
+        self.assertEqual(r2['x'], 'y2')
+        self.assertEqual(len(writer), 2)
+        self.assertEqual(Model.select().count(), 0)
+        self.assertEqual(accum, [])
+
+        # Reaching max_rows flushes the buffer.
+        writer.create_row(k='v3')
+        self.assertEqual(len(writer), 0)
+        self.assertEqual(Model.select().count(), 4)
+        self.assertEqual(len(accum), 4)
+
+        writer.create_row(k='v4')
+        self.assertEqual(writer.flush(), 1)
+        self.assertEqual(writer.flush(), 0)
+        self.assertEqual(self.keyspace[4]['k'], 'v4')
+
+        # Closing the writer flushes pending rows.
+        writer.create_row(k='v5')
+        writer.close()
+        self.assertEqual(self.keyspace[5]['k'], 'v5')
+        self.assertRaises(ValueError, writer.create_row, k='v6')
+
+        with self.keyspace.buffered(max_delay=None) as writer:
+            writer.create_row(k='v6')
+        self.assertEqual(self.keyspace[6]['k'], 'v6')
+        self.assertEqual(self.db._writers, [])
+
+        # A row that cannot be written does not hold back the others.
+        writer = self.keyspace.buffered(max_delay=None)
+        row = writer.create_row(k='v7')
+        row['k'] = 'conflict'
+        writer.create_row(k='v8')
+        self.assertRaises(IntegrityError, writer.flush)
+        self.assertEqual(writer.failed, [(7, {'k': 'v7'})])
+        self.assertEqual(self.keyspace[7]['k'], 'conflict')
+        self.assertEqual(self.keyspace[8]['k'], 'v8')
+        self.assertEqual(writer.flush(), 0)
+        writer.close()
+
     def test_preload(self):
         r1 = self.keyspace.create_row()
         r2 = self.keyspace.create_row()
@@ -277,6 +569,44 @@ class TestKeySpace(unittest.TestCase):
             {'k1': 'v1-1'},
         ])
 
+    def test_query_planner(self):
+        idx2 = Index('data', '$.k2')
+        idx = self.populate_test_index(idx2)
+        keyspace = idx.keyspace
+
+        # Conditions on the same index are only merged when neither side
+        # combines other indexes: (k1 == v1-2 & k2 == x1-2) | k1 == v1-1.
+        query = ((idx.query('v1-2') & idx2.query('x1-2')) | idx.query('v1-1'))
+        self.assertEqual([row._data['data']['k1'] for row in query],
+                         ['v1-1', 'v1-2'])
+
+        query = idx2.query('v1-y') & (idx.query('v1-4') | idx.query('xx'))
+        self.assertEqual([row._data['data'] for row in query],
+                         [{'k1': 'v1-4', 'k2': 'v1-y'}])
+
+        query = (idx.query('v1-%', operator.pow) &
+                 idx2.query('v1-y', operator.le) &
+                 idx.query('v1-1', operator.gt))
+        self.assertEqual([row._data['data']['k1'] for row in query],
+                         ['v1-4'])
+
+        # The most selective condition is scanned and the others are probed.
+        for i in range(20):
+            keyspace.create_row(data={'k1': 'v1-4', 'k2': 'z%s' % i})
+        keyspace.analyze()
+        query = idx.query('v1-4') & idx2.query('v1-y')
+        plan = query.explain().splitlines()
+        self.assertEqual(plan[0], 'SCAN AND (estimated rows: 1)')
+        self.assertTrue(plan[1].startswith('  SCAN test3_data_k2 '))
+        self.assertTrue(plan[2].startswith('  PROBE test3_data_k1 '))
+        self.assertEqual([row.identifier for row in query], [6])
+
+        query = idx.query('v1-4') | idx2.query('v1-y')
+        plan = query.explain().splitlines()
+        self.assertEqual(plan[0], 'SCAN OR (estimated rows: 6)')
+        self.assertTrue(plan[1].startswith('  UNION test3_data_k2 '))
+        self.assertEqual(len(list(query)), 21)
+
     def test_multi_index(self):
         idx = self.populate_test_index()
 
@@ -342,6 +672,652 @@ class TestKeySpace(unittest.TestCase):
             {'row_key': 6, 'value': u'v1-y'},
         ])
 
+    def test_index_value_type(self):
+        ts_text = Index('data', '$.ts')
+        ts_int = Index('data', '$.ts_int', value_type='integer')
+        keyspace = self.db.keyspace('test4', ts_text, ts_int)
+        keyspace.create()
+
+        for ts in (1, 9, 10, 100):
+            keyspace.create_row(data={'ts': ts, 'ts_int': ts})
+
+        # Text affinity compares the values lexically.
+        rows = [row['data']['ts'] for row in ts_text.query('9', operator.ge)]
+        self.assertEqual(rows, [9])
+
+        # Integer affinity compares the values numerically.
+        rows = [row['data']['ts_int']
+                for row in ts_int.query(9, operator.ge)]
+        self.assertEqual(rows, [9, 10, 100])
+        self.assertEqual([item['value'] for item in ts_int.all_items()],
+                         [1, 9, 10, 100])
+
+        # Operands are not truncated or coerced by the index.
+        rows = [row['data']['ts_int'] for row in ts_int.query(9.5, '<')]
+        self.assertEqual(rows, [1, 9])
+        rows = [row['data']['ts_int'] for row in ts_int.query(9.5, '>')]
+        self.assertEqual(rows, [10, 100])
+        rows = [row['data']['ts_int'] for row in ts_int.query('10')]
+        self.assertEqual(rows, [10])
+        self.assertEqual(len(list(ts_int.query('x', '<'))), 4)
+
+        self.assertRaises(ValueError, Index, 'data', '$.ts', 'blob')
+
+    def test_index_covering(self):
+        idx = self.populate_test_index()
+        indexes = self.db.get_indexes(idx.db_table)
+        self.assertTrue(any(index.columns == ['value', 'row_key']
+                            for index in indexes))
+
+        plan = self.db.execute_sql(
+            'EXPLAIN QUERY PLAN SELECT row_key FROM %s WHERE value = ?' %
+            idx.db_table, ('v1-1',)).fetchall()
+        self.assertTrue(any('COVERING INDEX' in row[-1] for row in plan))
+
+    def test_composite_index(self):
+        idx = CompositeIndex('pv', '$.url', '$.ts',
+                             value_types=('text', 'integer'))
+        keyspace = self.db.keyspace('pageviews', idx)
+        keyspace.create()
+
+        keyspace.create_row(pv={'url': '/a/', 'ts': 1})
+        keyspace.create_row(pv={'url': '/b/', 'ts': 2})
+        keyspace.create_row(pv={'url': '/a/', 'ts': 10})
+        keyspace.create_row(pv={'url': '/a/'})
+        keyspace.create_row(pv={'url': '/a/', 'ts': 30})
+        keyspace.create_row(other={'url': '/a/', 'ts': 3})
+
+        def assertRows(query, expected):
+            self.assertEqual([row.identifier for row in query], expected)
+
+        # Prefix queries on the first path.
+        assertRows(idx.query('/a/'), [1, 3, 4, 5])
+        assertRows(idx.query(('/b/',)), [2])
+
+        # Equality on both paths.
+        assertRows(idx.query(('/a/', 10)), [3])
+
+        # Equality on the first path and a range on the second.
+        url, ts = idx.v
+        assertRows(idx.query((url == '/a/') & (ts >= 2) & (ts < 30)), [3])
+        assertRows(idx.query((idx.field('$.url') == '/a/') &
+                             (idx.field('$.ts') > 5), reverse=True), [5, 3])
+
+        self.assertEqual([item for item in idx.all_items()], [
+            {'row_key': 1, 'value_0': '/a/', 'value_1': 1},
+            {'row_key': 2, 'value_0': '/b/', 'value_1': 2},
+            {'row_key': 3, 'value_0': '/a/', 'value_1': 10},
+            {'row_key': 4, 'value_0': '/a/', 'value_1': None},
+            {'row_key': 5, 'value_0': '/a/', 'value_1': 30},
+        ])
+
+        # The range query is satisfied by the multi-column index.
+        plan = self.db.execute_sql(
+            'EXPLAIN QUERY PLAN SELECT row_key FROM %s '
+            'WHERE value_0 = ? AND value_1 > ?' % idx.db_table,
+            ('/a/', 5)).fetchall()
+        self.assertTrue(any('value_0=? AND value_1>?' in row[-1]
+                            for row in plan))
+
+        # Entries are removed along with the row, and populated for new
+        # indexes on existing data.
+        del keyspace[3]
+        assertRows(idx.query('/a/'), [1, 4, 5])
+
+        idx2 = CompositeIndex('pv', '$.ts', '$.url')
+        keyspace.add_index(idx2)
+        assertRows(idx2.query(('30', '/a/')), [5])
+
+        self.assertRaises(ValueError, CompositeIndex, 'pv', '$.url')
+        self.assertRaises(ValueError, CompositeIndex, 'pv', '$.a', '$.b',
+                          value_types=('text',))
+
+    def _test_array_index(self, db):
+        tags = ArrayIndex('post', '$.tags[*]')
+        keyspace = db.keyspace('posts', tags)
+        keyspace.create()
+
+        keyspace.create_row(post={'tags': ['a', 'b']})
+        keyspace.create_row(post={'tags': ['b', 'c', 'b']})
+        keyspace.create_row(post={'tags': []})
+        keyspace.create_row(post={'title': 'no tags'})
+        keyspace.create_row(post={'tags': 'd'})
+
+        def assertRows(query, expected):
+            self.assertEqual([row.identifier for row in query], expected)
+
+        assertRows(tags.query('a'), [1])
+        assertRows(tags.query('b'), [1, 2])
+        assertRows(tags.query('d'), [5])
+
+        # Rows matching several elements are only returned once.
+        assertRows(tags.query(['a', 'b', 'c'], 'IN'), [1, 2])
+
+        self.assertEqual([(i['row_key'], i['value'])
+                          for i in tags.all_items()], [
+            (1, 'a'), (1, 'b'), (2, 'b'), (2, 'c'), (5, 'd')])
+
+        # Replacing the cell replaces the index entries.
+        row = keyspace[1]
+        row['post'] = {'tags': ['c']}
+        assertRows(tags.query('a'), [])
+        assertRows(tags.query('c'), [1, 2])
+
+        del keyspace[2]
+        assertRows(tags.query('c'), [1])
+
+        # Populating a new index from existing data.
+        tags2 = ArrayIndex('post', '$.tags')
+        keyspace2 = db.keyspace('posts2')
+        keyspace2.create()
+        keyspace2.create_row(post={'tags': ['x', 'y']})
+        keyspace2.create_row(post={'tags': ['y']})
+        keyspace2.add_index(tags2)
+        assertRows(tags2.query('y'), [1, 2])
+        assertRows(tags2.query('x'), [1])
+
+    def test_array_index(self):
+        self._test_array_index(self.db)
+
+    def test_array_index_fallback(self):
+        db = Schemaless(':memory:', use_json_fallback=True)
+        try:
+            self._test_array_index(db)
+        finally:
+            db.close()
+
+    def _test_projection(self, db):
+        url_idx = Index('pageview', '$.url')
+        keyspace = db.keyspace('projection', url_idx)
+        keyspace.create()
+        for i in range(3):
+            keyspace.create_row(
+                pageview={'url': '/p%s/' % i, 'title': 'Page %s' % i,
+                          'meta': {'tags': ['t%s' % i, 'x'], 'n': i}},
+                headers={'User-Agent': 'x' * 100})
+
+        def data(query):
+            return [row._data for row in query]
+
+        self.assertEqual(data(keyspace.all().columns('pageview').limit(1)), [
+            {'pageview': {'url': '/p0/', 'title': 'Page 0',
+                          'meta': {'tags': ['t0', 'x'], 'n': 0}}}])
+
+        query = (url_idx.query('/p1/', '>=')
+                 .columns('pageview')
+                 .paths('pageview', '$.url', '$.meta.tags[1]', '$.meta.n'))
+        self.assertEqual(data(query), [
+            {'pageview': {'url': '/p1/', 'meta': {'tags': [None, 'x'],
+                                                  'n': 1}}},
+            {'pageview': {'url': '/p2/', 'meta': {'tags': [None, 'x'],
+                                                  'n': 2}}}])
+
+        # Other columns are read in full unless columns() is used.
+        query = keyspace.all().paths('pageview', '$.title').limit(1)
+        self.assertEqual(data(query), [
+            {'pageview': {'title': 'Page 0'},
+             'headers': {'User-Agent': 'x' * 100}}])
+        query = -keyspace.all().columns().paths('pageview', '$.meta')
+        self.assertEqual([row['pageview'] for row in query], [
+            {'meta': {'tags': ['t%s' % i, 'x'], 'n': i}}
+            for i in (2, 1, 0)])
+
+    def test_projection(self):
+        self._test_projection(self.db)
+
+    def test_projection_fallback(self):
+        db = Schemaless(':memory:', use_json_fallback=True)
+        try:
+            self._test_projection(db)
+        finally:
+            db.close()
+
+    def test_aggregates(self):
+        url_idx = Index('pageview', '$.url')
+        ts_idx = Index('pageview', '$.ts', value_type='real')
+        tag_idx = ArrayIndex('pageview', '$.tags')
+        url_ts_idx = CompositeIndex('pageview', '$.url', '$.ts',
+                                    value_types=('text', 'real'))
+        keyspace = self.db.keyspace('aggregates', url_idx, ts_idx, tag_idx,
+                                    url_ts_idx)
+        keyspace.create()
+        keyspace.create_rows([
+            {'pageview': {'url': '/a/', 'ts': -1.5, 'tags': ['x', 'y']}},
+            {'pageview': {'url': '/b/', 'ts': 0, 'tags': ['x']}},
+            {'pageview': {'url': '/a/', 'ts': 4}},
+            {'pageview': {'url': '/c/', 'ts': 10.5, 'tags': ['x', 'x']}},
+            {'pageview': {'url': '/a/', 'ts': 11}},
+            {'pageview': {'ts': 12}},
+            {'other': 1}])
+
+        self.assertEqual(url_idx.count(), 5)
+        self.assertEqual(tag_idx.count(), 3)
+        self.assertEqual(keyspace.all().count(), 7)
+        self.assertEqual(url_idx.distinct(), ['/a/', '/b/', '/c/'])
+        self.assertEqual(tag_idx.distinct(), ['x', 'y'])
+        self.assertEqual(url_idx.group_counts(),
+                         [('/a/', 3), ('/b/', 1), ('/c/', 1)])
+        self.assertEqual(url_idx.group_counts(limit=1), [('/a/', 3)])
+        self.assertEqual(tag_idx.group_counts(), [('x', 3), ('y', 1)])
+        self.assertEqual((ts_idx.min(), ts_idx.max()), (-1.5, 12))
+        self.assertEqual(ts_idx.histogram(5), [
+            (-5, 1), (0, 2), (10, 3)])
+        self.assertEqual(ts_idx.histogram(10, start=-2), [(-2, 3), (8, 3)])
+        self.assertEqual(url_ts_idx.max('$.ts'), 12)
+        self.assertEqual(url_ts_idx.distinct('$.url'), ['/a/', '/b/', '/c/'])
+        self.assertRaises(ValueError, url_idx.distinct, '$.ts')
+
+        # Aggregates on a query only consider the matching rows.
+        query = ts_idx.query(0, '>=')
+        self.assertEqual(query.count(), 5)
+        self.assertEqual(query.limit(2).count(), 2)
+        self.assertEqual(query.group_counts(index=url_idx),
+                         [('/a/', 2), ('/b/', 1), ('/c/', 1)])
+        self.assertEqual(query.distinct(index=tag_idx), ['x'])
+        self.assertEqual((query.min(), query.max()), (0, 12))
+        self.assertEqual(query.histogram(10), [(0, 2), (10, 3)])
+        query = (url_idx == '/a/') & (ts_idx.query(5, '<'))
+        self.assertEqual(query.count(), 2)
+        self.assertEqual(query.histogram(2, index=ts_idx), [(-2, 1), (4, 1)])
+        self.assertEqual(url_ts_idx.query(('/a/',)).max(path='$.ts'), 11)
+
+    def test_rollup(self):
+        url_idx = Index('pageview', '$.url')
+        hourly = Rollup('pageview', '$.url', bucket=3600, timestamp='$.ts',
+                        sums=('$.ms',))
+        totals = Rollup('pageview', '$.url', bucket=None)
+        keyspace = self.db.keyspace('rollups', url_idx,
+                                    rollups=(hourly, totals))
+        keyspace.create()
+
+        def pageview(url, ts, ms=None):
+            data = {'url': url, 'ts': ts}
+            if ms is not None:
+                data['ms'] = ms
+            return {'pageview': data}
+
+        r1, r2, r3, r4, r5 = keyspace.create_rows([
+            pageview('/a/', 10, 5),
+            pageview('/a/', 20, 7),
+            pageview('/b/', 3700, 1),
+            pageview('/a/', 3600),
+            {'pageview': {'ts': 1}, 'other': {'url': '/c/'}}])
+
+        def buckets(rollup, **kwargs):
+            return [(b.value, b.bucket, b.count, b.sums)
+                    for b in rollup.query(**kwargs)]
+
+        self.assertEqual(buckets(hourly), [
+            ('/a/', 0, 2, {'$.ms': 12.}),
+            ('/a/', 3600, 1, {'$.ms': 0.}),
+            ('/b/', 3600, 1, {'$.ms': 1.})])
+        self.assertEqual(buckets(totals), [
+            ('/a/', 0, 3, {}),
+            ('/b/', 0, 1, {})])
+
+        # Replacing a cell moves it to its new value and bucket, and buckets
+        # that become empty are removed.
+        keyspace[r2]['pageview'] = {'url': '/b/', 'ts': 7300, 'ms': 2}
+        keyspace[r3]['pageview'] = {'url': '/b/', 'ts': 3800, 'ms': 3}
+        del keyspace[r4]['pageview']
+        del keyspace[r1]
+        self.assertEqual(buckets(hourly), [
+            ('/b/', 3600, 1, {'$.ms': 3.}),
+            ('/b/', 7200, 1, {'$.ms': 2.})])
+        self.assertEqual(buckets(hourly, value='/b/', start=3600, end=7200),
+                         [('/b/', 3600, 1, {'$.ms': 3.})])
+        self.assertEqual(totals.totals(), [('/b/', 2)])
+
+        keyspace.create_rows([pageview('/a/', 1), pageview('/c/', -1)])
+        self.assertEqual(hourly.totals(), [('/b/', 2), ('/a/', 1), ('/c/', 1)])
+        self.assertEqual(hourly.totals(start=0, end=3600), [('/a/', 1)])
+        self.assertEqual(hourly.totals(limit=1), [('/b/', 2)])
+        self.assertEqual(buckets(hourly, value=['/c/']),
+                         [('/c/', -3600, 1, {'$.ms': 0.})])
+
+        # Rebuilding the summary from the cells gives the same result.
+        expected = buckets(hourly)
+        hourly.backfill()
+        self.assertEqual(buckets(hourly), expected)
+
+        # Rollups added later count the existing cells.
+        daily = Rollup('pageview', '$.url', bucket=86400, timestamp='$.ts')
+        keyspace.add_rollup(daily)
+        self.assertEqual([(b.value, b.bucket, b.count)
+                          for b in daily.query()],
+                         [('/a/', 0, 1), ('/b/', 0, 2), ('/c/', -86400, 1)])
+        keyspace.drop()
+
+    def test_rollup_versioned(self):
+        rollup = Rollup('data', '$.k', bucket=None)
+        keyspace = self.db.keyspace('rollups', versioned=True,
+                                    rollups=(rollup,))
+        keyspace.create()
+        row = keyspace.create_row(data={'k': 'a'})
+        row['data'] = {'k': 'b'}
+        row['data'] = {'k': 'b'}
+        other = keyspace.create_row(data={'k': 'a'})
+        self.assertEqual(rollup.totals(), [('a', 1), ('b', 1)])
+
+        # Removing old versions leaves the summary alone.
+        keyspace.compact()
+        self.assertEqual(rollup.totals(), [('a', 1), ('b', 1)])
+        row.delete()
+        self.assertEqual(rollup.totals(), [('a', 1)])
+        rollup.backfill()
+        self.assertEqual(rollup.totals(), [('a', 1)])
+        keyspace.drop()
+
+    def test_partitioned_keyspace(self):
+        day = 86400
+        ts_idx = Index('pageview', '$.ts', value_type='real')
+        url_idx = Index('pageview', '$.url')
+        pageviews = self.db.partitioned_keyspace(
+            'pageviews', ts_idx, url_idx,
+            period='day',
+            timestamp=('pageview', '$.ts'))
+        pageviews.create()
+
+        def pageview(url, ts):
+            return {'pageview': {'url': url, 'ts': ts}}
+
+        r1, r2, r3, r4, r5 = pageviews.create_rows([
+            pageview('/a/', 10),
+            pageview('/b/', 2 * day + 10),
+            pageview('/a/', day + 10),
+            pageview('/a/', 2 * day + 20),
+            pageview('/c/', 20)])
+        r6 = pageviews.create_row(**pageview('/a/', 5 * day)).identifier
+        self.assertEqual(sorted([r1, r2, r3, r4, r5, r6]),
+                         list(range(r1, r1 + 6)))
+        self.assertEqual([p.name for p in pageviews.partitions()], [
+            'pageviews_19700101',
+            'pageviews_19700102',
+            'pageviews_19700103',
+            'pageviews_19700106'])
+        self.assertRaises(ValueError, pageviews.create_row, other={})
+
+        # Each partition has its own index tables and triggers.
+        self.assertEqual([(p.name, [item['value'] for item in
+                                    p.indexes[1].all_items()])
+                          for p in pageviews.partitions(day, 3 * day)], [
+            ('pageviews_19700102', ['/a/']),
+            ('pageviews_19700103', ['/b/', '/a/'])])
+
+        def keys(query):
+            return [row.identifier for row in query]
+
+        # Row keys are assigned per partition, and rows are merged in row key
+        # order.
+        self.assertEqual(keys(pageviews.all()), [r1, r5, r2, r4, r3, r6])
+        self.assertEqual(keys(-pageviews.all().limit(2)), [r6, r3])
+        self.assertEqual(keys(pageviews.all(day, 3 * day)), [r2, r4, r3])
+        self.assertEqual(keys(pageviews.all().after(r2).limit(2)), [r4, r3])
+        self.assertEqual(pageviews.all().count(), 6)
+
+        query = pageviews.query(url_idx == '/a/')
+        self.assertEqual(keys(query), [r1, r4, r3, r6])
+        self.assertEqual(len(query.queries), 4)
+
+        # Conditions on the partitioning path select the partitions read.
+        query = pageviews.query((url_idx == '/a/') & (ts_idx >= day))
+        self.assertEqual(keys(query), [r4, r3, r6])
+        self.assertEqual(len(query.queries), 3)
+        query = pageviews.query(
+            (ts_idx.query(day, '<')) & (url_idx == '/a/') |
+            (ts_idx == 5 * day))
+        self.assertEqual(keys(query), [r1, r6])
+        self.assertEqual(len(query.queries), 4)
+        query = pageviews.query(
+            ts_idx.query(ts_idx.v.between(day, 2 * day + 15)))
+        self.assertEqual(keys(query), [r2, r3])
+        self.assertEqual(len(query.queries), 2)
+        query = pageviews.query(
+            url_idx.query(fn.UPPER(url_idx.v) == '/A/'))
+        self.assertEqual(keys(query), [r1, r4, r3, r6])
+        query = pageviews.query(url_idx.query(url_idx.v << ['/b/', '/c/']))
+        self.assertEqual(keys(query), [r5, r2])
+        query = pageviews.query(url_idx == '/a/', start=2 * day)
+        self.assertEqual(keys(query), [r4, r6])
+        query = pageviews.query(ts_idx.query(day, '<'), start=day)
+        self.assertEqual(keys(query), [])
+
+        # Rows are found in their partition by row key.
+        self.assertEqual(pageviews[r3]['pageview']['url'], '/a/')
+        pageviews[r3]['pageview'] = {'url': '/d/', 'ts': day + 10}
+        self.assertEqual(keys(pageviews.query(url_idx == '/d/')), [r3])
+        rows, missing = pageviews.get_many([r6, r1, 1000])
+        self.assertEqual([row.identifier for row in rows], [r6, r1])
+        self.assertEqual(missing, [1000])
+        del pageviews[r4]
+        self.assertRaises(KeyError, lambda: pageviews[r4])
+
+        # Retention drops whole partitions, including their index tables.
+        self.assertEqual(pageviews.drop_before(2 * day + 1), [
+            'pageviews_19700101',
+            'pageviews_19700102'])
+        self.assertEqual(keys(pageviews.all()), [r2, r6])
+        self.assertEqual(keys(pageviews.query(url_idx == '/a/')), [r6])
+        tables = self.db.get_tables()
+        self.assertFalse([table for table in tables
+                          if table.startswith('pageviews_19700101')])
+        self.assertTrue('pageviews_19700103_pageview_url' in tables)
+
+        # New partitions continue the sequence of row keys.
+        r7 = pageviews.create_row(**pageview('/a/', 10)).identifier
+        self.assertTrue(r7 > r6)
+        self.assertEqual(keys(pageviews.query(url_idx == '/a/')), [r6, r7])
+        pageviews.drop()
+
+    def test_partition_periods(self):
+        pageviews = self.db.partitioned_keyspace('pageviews', period='week')
+        pageviews.create()
+        now = time.time()
+        row = pageviews.create_row(data={'k': 'v'})
+        partition, = pageviews.partitions()
+        start = datetime.datetime.utcfromtimestamp(now)
+        start -= datetime.timedelta(days=start.weekday())
+        self.assertEqual(partition.name,
+                         'pageviews_%s' % start.strftime('%Y%m%d'))
+        self.assertEqual(pageviews[row.identifier]['data'], {'k': 'v'})
+
+        monthly = self.db.partitioned_keyspace(
+            'monthly', period='month', timestamp=('data', '$.ts'))
+        monthly.create()
+        monthly.create_rows([{'data': {'ts': ts}} for ts in (
+            1293839999,    # 2010-12-31 23:59:59
+            1293840000,    # 2011-01-01
+            1296518399)])  # 2011-01-31 23:59:59
+        self.assertEqual([p.name for p in monthly.partitions()],
+                         ['monthly_201012', 'monthly_201101'])
+        self.assertEqual(len(monthly.partitions(1293840000)), 1)
+        self.assertRaises(ValueError, self.db.partitioned_keyspace,
+                          'yearly', period='year')
+
+    def test_expiry(self):
+        url_idx = Index('session', '$.user')
+        keyspace = self.db.keyspace('sessions', url_idx, ttl=3600)
+        keyspace.create()
+        r1, r2, r3, r4 = keyspace.create_rows([
+            {'session': {'user': 'huey'}},
+            {'session': {'user': 'mickey'}},
+            {'session': {'user': 'huey'}, 'other': {}},
+            {'session': {'user': 'zaizee'}}])
+
+        # New rows expire `ttl` seconds after they were written, and
+        # replacing a cell does not extend the expiration time.
+        now = time.time()
+        expires = keyspace[r1].expires()
+        self.assertTrue(now + 3590 < expires <= now + 3600)
+        keyspace[r1]['session'] = {'user': 'huey'}
+        self.assertEqual(keyspace[r1].expires(), expires)
+
+        keyspace[r2].expire_at(now - 1)
+        keyspace[r3].expire(-1)
+        keyspace[r4].expire(-1)
+        keyspace[r4].persist()
+        self.assertEqual(keyspace[r4].expires(), None)
+
+        # Writing to a persisted row does not give it a new ttl.
+        keyspace[r4]['session'] = {'user': 'zaizee'}
+        keyspace[r4].multi_set({'other': 1})
+        self.assertEqual(keyspace[r4].expires(), None)
+        del keyspace[r4]['other']
+
+        # Expired rows are no longer read.
+        self.assertEqual(keyspace[r2]['session'], None)
+        self.assertEqual(keyspace[r3].multi_get(True), {})
+        self.assertEqual([row.identifier for row in keyspace.all()],
+                         [r1, r4])
+        self.assertEqual([row.identifier for row in
+                          keyspace.all().limit(2)], [r1, r4])
+        self.assertEqual(keyspace.all().count(), 2)
+        self.assertEqual([row.identifier for row in (url_idx == 'huey')],
+                         [r1])
+        self.assertEqual(url_idx.group_counts(),
+                         [('huey', 1), ('zaizee', 1)])
+        self.assertEqual(keyspace.get_many([r1, r2]).missing, [r2])
+
+        # Purging deletes the expired rows and their index entries.
+        self.assertEqual(keyspace.purge(batch_size=1), 2)
+        self.assertEqual(keyspace.purge(), 0)
+        self.assertEqual(
+            sorted(keyspace.model.select(keyspace.model.row_key).tuples()),
+            [(r1,), (r4,)])
+        self.assertEqual([item['row_key'] for item in url_idx.all_items()],
+                         [r1, r4])
+        self.assertEqual(
+            sorted(keyspace.expiry.model.select(
+                keyspace.expiry.model.row_key,
+                keyspace.expiry.model.expires).tuples()),
+            [(r1, expires), (r4, None)])
+
+        # Deleting a row removes its expiration time.
+        del keyspace[r1]
+        del keyspace[r4]
+        self.assertEqual(keyspace.expiry.model.select().count(), 0)
+
+        self.assertRaises(ValueError, self.keyspace.purge)
+        self.assertRaises(ValueError, self.keyspace[r1].expire, 10)
+        self.assertRaises(ValueError, self.db.keyspace, 'sessions',
+                          ttl=60, cache_size=100)
+        keyspace.drop()
+
+    def test_expiry_per_row(self):
+        keyspace = self.db.keyspace('sessions', expiring=True)
+        keyspace.create()
+        rows = [keyspace.create_row(k=i) for i in range(7)]
+        self.assertEqual(rows[0].expires(), None)
+        for row in rows[:5]:
+            row.expire(-1)
+        rows[5].expire(60)
+        self.assertEqual(keyspace.purge(batch_size=2, max_batches=2), 4)
+        self.assertEqual(keyspace.purge(batch_size=2), 1)
+        self.assertEqual([row['k'] for row in keyspace.all()], [5, 6])
+        keyspace.drop()
+
+    def test_binary_storage(self):
+        url_idx = Index('pageview', '$.url')
+        tag_idx = ArrayIndex('pageview', '$.tags')
+        url_n_idx = CompositeIndex('pageview', '$.url', '$.n')
+        zdict = json.dumps({'User-Agent': 'Mozilla/5.0', 'Accept': '*/*'})
+        keyspace = self.db.keyspace(
+            'binary', url_idx, tag_idx, url_n_idx,
+            storage=BinaryStorage(threshold=64, zdict=zdict.encode('utf-8')),
+            changelog=True,
+            cache_size=10)
+        keyspace.create()
+
+        events = []
+        @keyspace.handler
+        def handler(row_key, column, value):
+            events.append(value)
+
+        headers = dict(('X-Header-%s' % i, 'Mozilla/5.0') for i in range(20))
+        rows = [
+            keyspace.create_row(pageview={'url': '/a/', 'tags': ['x', 'y'],
+                                          'n': 1}),
+            keyspace.create_row(pageview={'url': '/b/', 'tags': ['y'],
+                                          'n': 2},
+                                headers=headers)]
+
+        cursor = self.db.execute_sql(
+            'SELECT "column", typeof(value), length(value) FROM binary '
+            'ORDER BY row_key, "column"')
+        (c1, t1, l1), (c2, t2, l2), (c3, t3, l3) = cursor.fetchall()
+        self.assertEqual((t1, t2, t3), ('blob', 'blob', 'blob'))
+        self.assertTrue(l2 < len(json.dumps(headers)) / 4)
+
+        self.assertEqual(keyspace[rows[1].identifier]['headers'], headers)
+        self.assertEqual(keyspace[rows[1].identifier]['headers'], headers)
+        self.assertEqual(events[-1], headers)
+        self.assertEqual(
+            [change.value for change in keyspace.changelog.read()][-1],
+            headers)
+
+        def identifiers(query):
+            return [row.identifier for row in query]
+        self.assertEqual(identifiers(url_idx.query('/b/')),
+                         [rows[1].identifier])
+        self.assertEqual(identifiers(tag_idx.query('y')),
+                         [row.identifier for row in rows])
+        self.assertEqual(identifiers(url_n_idx.query(('/a/', 1))),
+                         [rows[0].identifier])
+        self.assertEqual(
+            [row['pageview'] for row in
+             keyspace.all().columns().paths('pageview', '$.n')],
+            [{'n': 1}, {'n': 2}])
+
+    def test_migrate_storage(self):
+        url_idx = Index('data', '$.url')
+        keyspace = self.db.keyspace('migrate', url_idx, versioned=True)
+        keyspace.create()
+        row = keyspace.create_row(data={'url': '/a/', 'body': 'x' * 1000})
+        row['data'] = {'url': '/b/', 'body': 'y' * 1000}
+        keyspace.create_row(data=None)
+
+        def types():
+            return [t for t, in self.db.execute_sql(
+                'SELECT typeof(value) FROM migrate ORDER BY rowid')]
+        self.assertEqual(types(), ['text', 'text', 'null'])
+
+        binary = self.db.keyspace('migrate', url_idx, versioned=True,
+                                  storage=BinaryStorage())
+        self.assertEqual(binary.migrate_storage(batch_size=1), 2)
+        self.assertEqual(binary.migrate_storage(), 0)
+        self.assertEqual(types(), ['blob', 'blob', 'null'])
+        self.assertEqual(binary[row.identifier]['data']['url'], '/b/')
+        self.assertEqual([r.identifier for r in url_idx.query('/b/')],
+                         [row.identifier])
+        self.assertEqual(row.history('data')[0].value['url'], '/a/')
+
+        # The index triggers now read binary cells.
+        new_row = binary.create_row(data={'url': '/c/', 'body': 'z' * 1000})
+        self.assertEqual(types(), ['blob', 'blob', 'null', 'blob'])
+        self.assertEqual([r.identifier for r in url_idx.query('/c/')],
+                         [new_row.identifier])
+        self.assertEqual(binary[new_row.identifier]['data']['body'],
+                         'z' * 1000)
+
+        # Migrating back to JSON text.
+        keyspace = self.db.keyspace('migrate', url_idx, versioned=True)
+        self.assertEqual(keyspace.migrate_storage(), 3)
+        self.assertEqual(types(), ['text', 'text', 'null', 'text'])
+        self.assertEqual(keyspace[row.identifier]['data']['body'], 'y' * 1000)
+        keyspace.create_row(data={'url': '/d/'})
+        self.assertEqual([r['data']['url'] for r in url_idx.query('/d/')],
+                         ['/d/'])
+
+        # Re-creating a keyspace with a different storage also replaces the
+        # triggers.
+        binary = self.db.keyspace('migrate', url_idx, versioned=True,
+                                  storage=BinaryStorage(threshold=0))
+        binary.create()
+        binary.migrate_storage()
+        binary.create_row(data={'url': '/e/'})
+        self.assertEqual([r['data']['url'] for r in url_idx.query('/e/')],
+                         ['/e/'])
+
     def test_signal_handler(self):
         accum = []
 
@@ -374,6 +1350,260 @@ class TestKeySpace(unittest.TestCase):
         keyspace.create_row(data={'k4': 'v4'})
         self.assertEqual(len(accum), 5)
 
+    def test_signal_handler_columns(self):
+        keyspace = self.db.keyspace('testing')
+        keyspace.create()
+        accum = []
+        decoded = []
+
+        def sql():
+            return self.db.execute_sql(
+                'SELECT sql FROM sqlite_master WHERE name = ?',
+                ('testing_signal',)).fetchone()[0]
+
+        @keyspace.handler(columns=('c1',))
+        def h1(row_key, column, value):
+            accum.append(('h1', row_key, column, value))
+
+        @keyspace.handler(columns=['c1', 'c2'])
+        def h2(row_key, column, value):
+            accum.append(('h2', row_key, column, value))
+            decoded.append(value)
+
+        @self.db.handler(keyspace, columns=['c2'])
+        def h3(table, row_key, column, value):
+            decoded.append(value)
+
+        self.assertTrue("WHEN new.column IN ('c1', 'c2')" in sql())
+
+        keyspace.create_row(c1={'k': 'v1'})
+        keyspace.create_row(c2={'k': 'v2'}, c3='v3')
+        self.assertEqual(accum, [
+            ('h1', 1, 'c1', {'k': 'v1'}),
+            ('h2', 1, 'c1', {'k': 'v1'}),
+            ('h2', 2, 'c2', {'k': 'v2'})])
+
+        # Each event's value is decoded once and shared by the handlers.
+        self.assertEqual(decoded, [{'k': 'v1'}, {'k': 'v2'}, {'k': 'v2'}])
+        self.assertTrue(decoded[1] is decoded[2])
+
+        # Binding a handler for all columns removes the filter.
+        @keyspace.handler
+        def h4(row_key, column, value):
+            accum.append(('h4', row_key, column, value))
+
+        self.assertFalse('WHEN' in sql())
+        keyspace.create_row(c3='v3')
+        self.assertEqual(accum[-1], ('h4', 3, 'c3', 'v3'))
+
+        h4.unbind()
+        h2.unbind()
+        self.assertTrue("WHEN new.column IN ('c1', 'c2')" in sql())
+        keyspace.create_row(c1='x1', c2='x2', c3='x3')
+        self.assertEqual(accum[-1], ('h1', 4, 'c1', 'x1'))
+
+    def test_async_signal_handler(self):
+        db = Schemaless(':memory:', event_dispatch='async', event_workers=2)
+        keyspace = db.keyspace('testing')
+        keyspace.create()
+        accum = []
+
+        @keyspace.handler
+        def handler(row_key, column, value):
+            accum.append((row_key, column, value))
+
+        keyspace.create_row(k='v1')
+        db.flush_events()
+        self.assertEqual(accum, [(1, 'k', 'v1')])
+
+        # Events are delivered once the transaction commits.
+        with db.atomic():
+            keyspace.create_row(k='v2')
+            keyspace.create_row(k='v3')
+            db.flush_events()
+            self.assertEqual(len(accum), 1)
+        db.flush_events()
+        self.assertEqual(accum[1:], [(2, 'k', 'v2'), (3, 'k', 'v3')])
+
+        # Events for rows that are rolled back are discarded.
+        with db.atomic() as txn:
+            keyspace.create_row(k='v4')
+            txn.rollback(False)
+        with db.atomic():
+            keyspace.create_row(k='v5')
+            try:
+                with db.atomic():
+                    keyspace.create_row(k='v6')
+                    raise ValueError()
+            except ValueError:
+                pass
+            keyspace.create_row(k='v7')
+        db.flush_events()
+        self.assertEqual(accum[3:], [(5, 'k', 'v5'), (7, 'k', 'v7')])
+
+        # Events for cells written by a statement that fails are discarded,
+        # both outside of and within a transaction. Row 1 already has "k".
+        row = keyspace[1]
+        self.assertRaises(IntegrityError, row.multi_set,
+                          OrderedDict((('a', 'phantom'), ('k', 'x'))))
+        with db.atomic():
+            self.assertRaises(IntegrityError, row.multi_set,
+                              OrderedDict((('b', 'phantom'), ('k', 'x'))))
+            keyspace.create_row(k='v8')
+        keyspace.create_row(k='v9')
+        db.flush_events()
+        self.assertEqual(accum[5:], [(8, 'k', 'v8'), (9, 'k', 'v9')])
+        db.close()
+
+        self.assertRaises(ValueError, Schemaless, ':memory:',
+                          event_dispatch='deferred')
+
+    def test_async_signal_handler_overflow(self):
+        db = Schemaless(':memory:', event_dispatch='async',
+                        event_queue_size=1, event_overflow='drop')
+        keyspace = db.keyspace('testing')
+        keyspace.create()
+        accum = []
+        event = threading.Event()
+
+        @keyspace.handler
+        def handler(row_key, column, value):
+            event.wait()
+            accum.append(row_key)
+
+        with db.atomic():
+            for i in range(5):
+                keyspace.create_row(k=i)
+
+        event.set()
+        db.flush_events()
+        self.assertTrue(db._dispatcher.dropped >= 3)
+        self.assertEqual(len(accum) + db._dispatcher.dropped, 5)
+        self.assertEqual(accum, sorted(accum))
+        db.close()
+
+    def test_changelog(self):
+        keyspace = self.db.keyspace('logged', changelog=True)
+        keyspace.create()
+        changelog = keyspace.changelog
+
+        row = keyspace.create_row(k1={'a': 1})
+        row['k1'] = {'a': 2}
+        row['k2'] = 'v2'
+        del row['k2']
+        keyspace.create_row(k1='x')
+        keyspace[1].delete()
+
+        def summary(changes):
+            return [(c.seq, c.row_key, c.column, c.operation, c.value)
+                    for c in changes]
+
+        self.assertEqual(summary(changelog.read()), [
+            (1, 1, 'k1', 'insert', {'a': 1}),
+            (2, 1, 'k1', 'update', {'a': 2}),
+            (3, 1, 'k2', 'insert', 'v2'),
+            (4, 1, 'k2', 'delete', None),
+            (5, 2, 'k1', 'insert', 'x'),
+            (6, 1, 'k1', 'delete', None)])
+
+        # Consumers read in batches from their acknowledged position.
+        c1 = changelog.consumer('c1')
+        c2 = changelog.consumer('c2')
+        batch = c1.read(batch_size=4)
+        self.assertEqual([change.seq for change in batch], [1, 2, 3, 4])
+        c1.ack(batch[-1])
+        self.assertEqual(c1.position, 4)
+        self.assertEqual([change.seq for change in c1.read()], [5, 6])
+        c1.ack(6)
+        c1.ack(2)  # Positions never move backwards.
+        self.assertEqual(c1.position, 6)
+        self.assertEqual(c1.read(), [])
+
+        # Compaction only removes entries every consumer has passed.
+        c2.ack(3)
+        self.assertEqual(changelog.compact(), 3)
+        self.assertEqual([change.seq for change in c2.read()], [4, 5, 6])
+        changelog.remove_consumer('c2')
+        self.assertEqual(changelog.compact(), 3)
+        self.assertEqual(changelog.read(), [])
+
+        # Sequence numbers are not re-used after compaction.
+        keyspace.create_row(k1='y')
+        self.assertEqual(summary(c1.read()), [(7, 3, 'k1', 'insert', 'y')])
+
+        # A consumer's position survives, as it is stored in the database.
+        self.assertEqual(changelog.consumer('c1').position, 6)
+
+    def test_versioned(self):
+        idx = Index('data', '$.k')
+        keyspace = self.db.keyspace('versioned', idx, versioned=True,
+                                    changelog=True)
+        keyspace.create()
+        Model = keyspace.model
+
+        row = keyspace.create_row(data={'k': 'v1'}, other='o1')
+        t1 = time.time()
+        time.sleep(0.01)
+        row['data'] = {'k': 'v2'}
+        row['data'] = {'k': 'v3'}
+        row2 = keyspace.create_row(data={'k': 'v2'})
+
+        # Writes append new versions.
+        self.assertEqual(Model.select().count(), 5)
+        self.assertEqual([(v.version, v.value) for v in row.history('data')],
+                         [(1, {'k': 'v1'}), (2, {'k': 'v2'}), (3, {'k': 'v3'})])
+
+        # Reads return the latest version.
+        self.assertEqual(keyspace[1]['data'], {'k': 'v3'})
+        self.assertEqual(keyspace.get_row(1, True)._data, {
+            'data': {'k': 'v3'}, 'other': 'o1'})
+        self.assertEqual([r._data for r in keyspace.all()], [
+            {'data': {'k': 'v3'}, 'other': 'o1'},
+            {'data': {'k': 'v2'}}])
+
+        # Indexes follow the latest version.
+        self.assertEqual([r.identifier for r in idx.query('v2')], [2])
+        self.assertEqual([r._data for r in idx.query('v3')], [
+            {'data': {'k': 'v3'}, 'other': 'o1'}])
+        self.assertEqual([r.identifier for r in idx.query('v1')], [])
+
+        # Point-in-time reads.
+        self.assertEqual(row.as_of(t1), {'data': {'k': 'v1'}, 'other': 'o1'})
+        self.assertEqual(row.as_of(t1, ['data']), {'data': {'k': 'v1'}})
+        self.assertEqual(row.as_of(0), {})
+
+        # A new version without the indexed path removes the index entry.
+        row2['data'] = {'x': 'y'}
+        self.assertEqual([r.identifier for r in idx.query('v2')], [])
+        row2['data'] = {'k': 'v2'}
+
+        # Compaction keeps the newest versions and the index entries.
+        self.assertEqual(keyspace.compact(keep=2, batch_size=1), 2)
+        self.assertEqual([v.version for v in row.history('data')], [2, 3])
+        self.assertEqual([v.version for v in row2.history('data')], [2, 3])
+        self.assertEqual(keyspace.compact(keep=2), 0)
+        self.assertEqual([r.identifier for r in idx.query('v3')], [1])
+        self.assertEqual([r.identifier for r in idx.query('v2')], [2])
+
+        # Removing old versions is not recorded as a delete.
+        operations = [c.operation for c in keyspace.changelog.read()]
+        self.assertEqual(operations, ['insert', 'insert', 'update', 'update',
+                                      'insert', 'update', 'update'])
+
+        # New indexes are populated from the latest versions.
+        idx2 = CompositeIndex('data', '$.k', '$.x')
+        keyspace.add_index(idx2)
+        self.assertEqual([(i['row_key'], i['value_0'])
+                          for i in idx2.all_items()], [(1, 'v3'), (2, 'v2')])
+
+        # Deleting a column removes every version.
+        del row['data']
+        self.assertEqual(row.history('data'), [])
+        self.assertEqual([r.identifier for r in idx.query('v3')], [])
+
+        self.assertRaises(ValueError, self.keyspace.compact)
+        self.assertRaises(ValueError, self.keyspace[1].history, 'k')
+
     def test_json_extract_fallback(self):
         data = {
             'k1': 'v1',
@@ -408,6 +1638,614 @@ class TestKeySpace(unittest.TestCase):
         assertValue('$.[1]', 'baz')
         assertValue('$.[2].k1[0]', 'v1')
 
+    def test_json_codec(self):
+        self.assertRaises(ValueError, get_json_codec, 'pickle')
+        self.assertTrue(get_json_codec('auto').name in JSON_CODECS)
+
+        for name in JSON_CODECS:
+            codec = get_json_codec(name)
+            self.assertTrue(codec.name in (name, 'json'))
+
+            for fallback in (False, True):
+                db = Schemaless(':memory:', json_codec=name,
+                                use_json_fallback=fallback)
+                self.assertEqual(db.json_codec.name, codec.name)
+                idx = Index('data', '$.k')
+                keyspace = db.keyspace('codec', idx)
+                keyspace.create()
+
+                events = []
+                @keyspace.handler
+                def handler(row_key, column, value):
+                    events.append(value)
+
+                data = {'k': 'v', 'n': [1, 2.5, None, True]}
+                row = keyspace.create_row(data=data)
+                self.assertEqual(events, [data])
+                self.assertEqual(keyspace[row.identifier]['data'], data)
+                self.assertEqual([r.identifier for r in idx.query('v')],
+                                 [row.identifier])
+                self.assertEqual(
+                    list(keyspace.all().paths('data', '$.n[1]'))[0]['data'],
+                    {'n': [None, 2.5]})
+                db.close()
+
+    def test_json_extract_sql(self):
+        extract = _JSONFunctions().extract
+        json_data = json.dumps({'k1': 'v1', 'k2': {'k3': [1, 2]}})
+        self.assertEqual(extract(json_data, '$.k1'), 'v1')
+        self.assertEqual(extract(json_data, '$.k2'), '{"k3":[1,2]}')
+        self.assertEqual(extract(json_data, '$.k1', '$.k2.k3'),
+                         '["v1",[1,2]]')
+        self.assertEqual(extract(None, '$.k1'), None)
+
+    def test_json_functions_fallback(self):
+        db = Schemaless(':memory:', use_json_fallback=True)
+        data = json.dumps({'k1': [1, 2.5, 'x', None, True, {}], 'k2': {}})
+
+        def assertSQL(sql, expected):
+            cursor = db.execute_sql('SELECT %s' % sql, (data,))
+            self.assertEqual(cursor.fetchone()[0], expected)
+
+        assertSQL("json_type(?)", 'object')
+        assertSQL("json_type(?, '$.k1')", 'array')
+        assertSQL("json_type(?, '$.k2')", 'object')
+        assertSQL("json_type(?, '$.k1[0]')", 'integer')
+        assertSQL("json_type(?, '$.k1[1]')", 'real')
+        assertSQL("json_type(?, '$.k1[2]')", 'text')
+        assertSQL("json_type(?, '$.k1[3]')", 'null')
+        assertSQL("json_type(?, '$.k1[4]')", 'true')
+        assertSQL("json_type(?, '$.kx')", None)
+        assertSQL("json_array_length(?, '$.k1')", 6)
+        assertSQL("json_array_length(?, '$.k2')", 0)
+        assertSQL("json_array_length(?, '$.kx')", None)
+        assertSQL("json_extract(?, '$.k1[2]', '$.k2')", '["x",{}]')
+
+        # Documents are parsed once, however many indexes and paths use them.
+        parsed = []
+        loads = db._json_functions.loads
+        def counting_loads(json_text):
+            parsed.append(json_text)
+            return loads(json_text)
+        db._json_functions.loads = counting_loads
+
+        indexes = [Index('data', '$.k1'), Index('data', '$.k2'),
+                   ArrayIndex('data', '$.k3')]
+        keyspace = db.keyspace('fallback', *indexes)
+        keyspace.create()
+        keyspace.create_row(data={'k1': 'v1', 'k2': 'v2', 'k3': ['a', 'b']})
+        self.assertEqual(len(parsed), 1)
+        self.assertEqual([[row['data']['k1'] for row in idx.query(value)]
+                          for idx, value in zip(indexes, ('v1', 'v2', 'b'))],
+                         [['v1'], ['v1'], ['v1']])
+        db.close()
+
+    def test_json_each_fallback(self):
+        json_data = json.dumps({
+            'k1': ['v1', 2, {'k2': 'v3'}, ['v4']],
+            'k2': {'k3': 'v5'},
+            'k3': 'v6'})
+        each = _JSONFunctions().each
+        self.assertEqual(each(json_data, '$.k1'), [
+            'v1', 2, '{"k2":"v3"}', '["v4"]'])
+        self.assertEqual(each(json_data, '$.k2'), ['v5'])
+        self.assertEqual(each(json_data, '$.k3'), ['v6'])
+        self.assertEqual(each(json_data, '$.kx'), [])
+
+
+
+class TestFileDatabase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'test.db')
+        self.db = Schemaless(self.filename)
+        self.keyspace = self.db.keyspace('test-keyspace')
+        self.keyspace.create()
+
+    def tearDown(self):
+        if not self.db.is_closed():
+            self.db.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_row_key_allocator_threads(self):
+        keyspace = self.db.keyspace('test-keyspace', key_block_size=7)
+        accum = []
+
+        def allocate():
+            for i in range(100):
+                accum.append(keyspace.allocator.next_key())
+
+        threads = [threading.Thread(target=allocate) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(accum), list(range(1, 401)))
+
+    def test_buffered_writer_thread(self):
+        Model = self.keyspace.model
+        writer = self.keyspace.buffered(max_rows=100, max_delay=0.01)
+        for i in range(10):
+            writer.create_row(k=i)
+
+        # The rows are flushed by the background thread.
+        for i in range(100):
+            if Model.select().count() == 10:
+                break
+            time.sleep(0.01)
+        self.assertEqual(Model.select().count(), 10)
+
+        # Writers block while max_pending rows are waiting to be flushed.
+        writer = self.keyspace.buffered(max_rows=5, max_delay=10,
+                                        max_pending=5)
+        row_keys = [writer.create_row(k=i).identifier for i in range(23)]
+        self.assertTrue(len(writer) <= 5)
+        writer.close()
+        self.assertEqual(
+            sorted(row.identifier for row in self.keyspace.all()),
+            sorted(row_keys + list(range(1, 11))))
+
+        # Errors in the background thread are raised by the next call.
+        writer = self.keyspace.buffered(max_rows=2, max_delay=10)
+        row = writer.create_row(k='bad')
+        row['k'] = 'conflict'
+        good = writer.create_row(k='good')
+        for i in range(100):
+            if writer._error is not None:
+                break
+            time.sleep(0.01)
+        self.assertRaises(IntegrityError, writer.create_row, k='next')
+        self.assertEqual(writer.failed, [(row.identifier, {'k': 'bad'})])
+        self.assertEqual(self.keyspace[good.identifier]['k'], 'good')
+        writer.close()
+
+        # Closing the database flushes pending rows.
+        writer = self.keyspace.buffered(max_delay=None)
+        row = writer.create_row(k='v')
+        self.db.close()
+        self.assertEqual(self.keyspace[row.identifier]['k'], 'v')
+        writer.close()
+
+    def test_compactor(self):
+        keyspace = self.db.keyspace('versioned', versioned=True)
+        keyspace.create()
+        row = keyspace.create_row(k=0)
+        for i in range(1, 5):
+            row['k'] = i
+
+        compactor = keyspace.compactor(keep=2, interval=0.01)
+        for i in range(100):
+            if len(row.history('k')) == 2:
+                break
+            time.sleep(0.01)
+        compactor.stop()
+        self.assertEqual([v.value for v in row.history('k')], [3, 4])
+
+    def test_purger(self):
+        keyspace = self.db.keyspace('sessions', expiring=True)
+        keyspace.create()
+        for i in range(10):
+            keyspace.create_row(k=i).expire(-1)
+        live = keyspace.create_row(k='live')
+
+        purger = keyspace.purger(interval=0.01, batch_size=3, pause=0.001)
+        for i in range(100):
+            if keyspace.model.select().count() == 1:
+                break
+            time.sleep(0.01)
+        purger.stop()
+        self.assertEqual([row.identifier for row in keyspace.all()],
+                         [live.identifier])
+
+    def test_sharded(self):
+        filenames = [os.path.join(self.tmp_dir, 'shard%s.db' % i)
+                     for i in range(3)]
+        db = ShardedSchemaless(filenames)
+        url_idx = Index('pageview', '$.url')
+        ms_idx = Index('pageview', '$.ms', value_type='integer')
+        pageviews = db.keyspace('pageviews', url_idx, ms_idx)
+        pageviews.create()
+
+        urls = ['/a/', '/b/', '/a/', '/c/', '/a/', '/b/', '/d/']
+        row_keys = pageviews.create_rows(
+            {'pageview': {'url': url, 'ms': i * 10}}
+            for i, url in enumerate(urls))
+        row_keys.append(pageviews.create_row(other={'k': 'v'}).identifier)
+        self.assertEqual(len(set(row_keys)), 8)
+
+        # Each row is stored in the shard its row key maps to, and the rows
+        # are spread evenly.
+        for i, keyspace in enumerate(pageviews.keyspaces):
+            keys = [row_key for row_key, in
+                    keyspace.model.select(keyspace.model.row_key)
+                    .distinct().tuples()]
+            self.assertTrue(2 <= len(keys) <= 3)
+            self.assertTrue(all((key - 1) % 3 == i for key in keys))
+            self.assertEqual(keyspace.database.database, filenames[i])
+
+        by_url = dict((url, sorted(key for key, u in zip(row_keys, urls)
+                                   if u == url)) for url in urls)
+        self.assertEqual(pageviews[row_keys[3]]['pageview']['url'], '/c/')
+        self.assertEqual(pageviews[row_keys[-1]]['other'], {'k': 'v'})
+
+        def keys(query):
+            return [row.identifier for row in query]
+
+        self.assertEqual(keys(pageviews.all()), sorted(row_keys))
+        self.assertEqual(keys(-pageviews.all().limit(3)),
+                         sorted(row_keys, reverse=True)[:3])
+        self.assertEqual(pageviews.all().count(), 8)
+        query = pageviews.query(url_idx == '/a/')
+        self.assertEqual(keys(query), by_url['/a/'])
+        self.assertEqual(keys(query.after(by_url['/a/'][0])),
+                         by_url['/a/'][1:])
+        query = pageviews.query((url_idx == '/a/') | (url_idx == '/d/'))
+        self.assertEqual(keys(query), sorted(by_url['/a/'] + by_url['/d/']))
+        query = pageviews.query(url_idx.query(fn.UPPER(url_idx.v) == '/A/'))
+        self.assertEqual(keys(query), by_url['/a/'])
+
+        # Aggregates are combined across the shards.
+        self.assertEqual(pageviews.count(url_idx), 7)
+        self.assertEqual(pageviews.distinct(url_idx),
+                         ['/a/', '/b/', '/c/', '/d/'])
+        self.assertEqual(pageviews.group_counts(url_idx, limit=2),
+                         [('/a/', 3), ('/b/', 2)])
+        self.assertEqual((pageviews.min(ms_idx), pageviews.max(ms_idx)),
+                         (0, 60))
+        self.assertEqual(pageviews.histogram(ms_idx, 25),
+                         [(0, 3), (25, 2), (50, 2)])
+        query = pageviews.query(ms_idx >= 20)
+        self.assertEqual(query.count(), 5)
+        self.assertEqual(query.group_counts(index=url_idx),
+                         [('/a/', 2), ('/b/', 1), ('/c/', 1), ('/d/', 1)])
+        self.assertEqual(query.max(), 60)
+        self.assertRaises(ValueError, pageviews.all().distinct)
+
+        rows, missing = pageviews.get_many([row_keys[5], 1000, row_keys[0]])
+        self.assertEqual([row.identifier for row in rows],
+                         [row_keys[5], row_keys[0]])
+        self.assertEqual(missing, [1000])
+        del pageviews[row_keys[0]]
+        self.assertEqual(pageviews.count(url_idx), 6)
+
+        # Writers on several threads write to different shards.
+        def write():
+            for i in range(20):
+                pageviews.create_row(pageview={'url': '/t/'})
+
+        threads = [threading.Thread(target=write) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(pageviews.query(url_idx == '/t/').count(), 60)
+        db.close()
+
+    def test_sharded_rollups(self):
+        filenames = [os.path.join(self.tmp_dir, 'shard%s.db' % i)
+                     for i in range(2)]
+        db = ShardedSchemaless(filenames)
+        by_url = Rollup('pv', '$.url', bucket=None, sums=('$.ms',))
+        pageviews = db.keyspace('pv', rollups=(by_url,))
+        pageviews.create()
+
+        # Each shard has its own copy of the rollup, and results are added
+        # up across the shards.
+        urls = ['/a/', '/b/', '/a/', '/a/', '/c/']
+        pageviews.create_rows({'pv': {'url': url, 'ms': 10}} for url in urls)
+        self.assertEqual([keyspace.rollups[0].totals()
+                          for keyspace in pageviews.keyspaces],
+                         [[('/a/', 2), ('/c/', 1)], [('/a/', 1), ('/b/', 1)]])
+        self.assertEqual(pageviews.rollup_query(by_url), [
+            ('/a/', 0, 3, {'$.ms': 30}),
+            ('/b/', 0, 1, {'$.ms': 10}),
+            ('/c/', 0, 1, {'$.ms': 10})])
+        self.assertEqual(pageviews.rollup_query(by_url, '/b/'),
+                         [('/b/', 0, 1, {'$.ms': 10})])
+        self.assertEqual(pageviews.rollup_totals(by_url, limit=2),
+                         [('/a/', 3), ('/b/', 1)])
+
+        by_host = Rollup('pv', '$.host', bucket=None)
+        pageviews.add_rollup(by_host)
+        pageviews.create_row(pv={'url': '/d/', 'host': 'h'})
+        self.assertEqual(pageviews.rollup_totals(by_host), [('h', 1)])
+        self.assertEqual(pageviews.rollup_totals(by_url)[-1], ('/d/', 1))
+        self.assertRaises(ValueError, pageviews.rollup_totals,
+                          Rollup('pv', '$.url'))
+
+        self.assertRaises(ValueError, db.keyspace, 'other',
+                          allocator=pageviews.keyspaces[0].allocator)
+        db.close()
+
+    def test_row_key_allocator_connections(self):
+        # Two databases simulate separate processes sharing the file.
+        db2 = Schemaless(self.filename)
+        keyspace2 = db2.keyspace('test-keyspace', key_block_size=5)
+        try:
+            rows = []
+            for i in range(12):
+                rows.append(self.keyspace.create_row(k=i).identifier)
+                rows.append(keyspace2.create_row(k=i).identifier)
+            self.assertEqual(len(set(rows)), 24)
+            self.assertEqual(self.keyspace.model.select().count(), 24)
+        finally:
+            db2.close()
+
+    def test_row_cache_data_version(self):
+        keyspace = self.db.keyspace('test-keyspace', cache_size=100)
+        row = keyspace.create_row(k='v1')
+        self.assertEqual(keyspace[row.identifier]['k'], 'v1')
+        self.assertEqual(keyspace[row.identifier]['k'], 'v1')
+        self.assertEqual(keyspace.cache.hits, 1)
+
+        # A write from another connection flushes the cache.
+        db2 = Schemaless(self.filename)
+        try:
+            db2.keyspace('test-keyspace')[row.identifier]['k'] = 'v2'
+        finally:
+            db2.close()
+        self.assertEqual(keyspace[row.identifier]['k'], 'v2')
+        self.assertEqual(keyspace.cache.hits, 1)
+
+    def test_row_cache_connection_pool(self):
+        db = Schemaless(self.filename, readers=2)
+        keyspace = db.keyspace('test-keyspace', cache_size=100)
+        row_keys = keyspace.create_rows({'k': i} for i in range(50))
+
+        def read():
+            return [keyspace[row_key]['k'] for row_key in row_keys]
+
+        try:
+            read()
+            self.assertEqual(keyspace.cache.misses, 50)
+
+            # Writes through the pool's writer only invalidate their cells.
+            other = keyspace.create_row(k='other')
+            self.assertEqual(read(), list(range(50)))
+            self.assertEqual(read(), list(range(50)))
+            self.assertEqual(keyspace.cache.hits, 100)
+            keyspace[row_keys[0]]['k'] = 'changed'
+            self.assertEqual(read()[:2], ['changed', 1])
+            self.assertEqual(keyspace.cache.misses, 51)
+
+            # Writes from another connection flush the cache.
+            db2 = Schemaless(self.filename)
+            try:
+                db2.keyspace('test-keyspace')[other.identifier]['k'] = 'x'
+            finally:
+                db2.close()
+            self.assertEqual(keyspace[other.identifier]['k'], 'x')
+            read()
+            self.assertEqual(keyspace.cache.misses, 102)
+        finally:
+            db.close()
+            db.close_pool()
+
+    def test_async_handler_writes(self):
+        db = Schemaless(self.filename, event_dispatch='async',
+                        event_queue_size=2)
+        pv = db.keyspace('pv')
+        rh = db.keyspace('rh')
+        pv.create()
+        rh.create()
+
+        # Handlers may write to keyspaces without handlers, even when the
+        # worker's queue is full.
+        @pv.handler
+        def store_referer_host(row_key, column, value):
+            rh.create_row(host=value['host'])
+
+        for i in range(10):
+            pv.create_row(pageview={'host': 'h%s' % i})
+        db.flush_events()
+        self.assertEqual(sorted(row['host'] for row in rh.all()),
+                         ['h%s' % i for i in range(10)])
+
+        # Closing the database delivers the queued events.
+        with db.atomic():
+            for i in range(10, 12):
+                pv.create_row(pageview={'host': 'h%s' % i})
+        db.close()
+        self.assertEqual(db._dispatcher._threads, [])
+        self.assertEqual(rh.all().count(), 12)
+        db.close()
+
+    def test_connection_pool(self):
+        self.assertRaises(ValueError, Schemaless, ':memory:', readers=2)
+
+        db = Schemaless(self.filename, readers=2)
+        keyspace = db.keyspace('test-keyspace')
+        errors = []
+
+        def work(n):
+            try:
+                for i in range(10):
+                    row = keyspace.create_row(n=n, i=i)
+                    self.assertEqual(keyspace[row.identifier]['i'], i)
+                with keyspace.atomic():
+                    keyspace.create_row(n=n, i='tx')
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                db.close()
+
+        try:
+            threads = [threading.Thread(target=work, args=(i,))
+                       for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+
+            # No more than two readers were opened, and all are idle.
+            self.assertTrue(db._pool._readers <= 2)
+            self.assertEqual(len(db._pool._idle), db._pool._readers)
+            self.assertEqual(keyspace.model.select().count(), 88)
+
+            # Readers cannot be used to write.
+            conn = db.get_conn()
+            self.assertRaises(Exception, conn.execute,
+                              'DELETE FROM "test-keyspace"')
+
+            # Rolled back transactions release the writer.
+            def rollback():
+                with keyspace.atomic():
+                    keyspace.create_row(k='rolled back')
+                    raise ValueError()
+            self.assertRaises(ValueError, rollback)
+            self.assertEqual(db._pool.writer_depth, 0)
+            self.assertEqual(keyspace.model.select().count(), 88)
+
+            # Readers returned after the pool is closed are closed too.
+            db.close_pool()
+            self.assertEqual(db._pool._readers, 1)
+            db.close()
+            self.assertEqual(db._pool._readers, 0)
+            self.assertEqual(db._pool._idle, [])
+            self.assertRaises(sqlite3.ProgrammingError, conn.execute,
+                              'SELECT 1')
+        finally:
+            if not db.is_closed():
+                db.close()
+            db.close_pool()
+
+    def test_connection_pool_retry(self):
+        db = Schemaless(self.filename, readers=1, busy_timeout=0,
+                        retry_delay=0.01)
+        keyspace = db.keyspace('test-keyspace')
+
+        # Hold a write lock from another connection, then release it while
+        # the pooled database is retrying.
+        conn = sqlite3.connect(self.filename, check_same_thread=False)
+        conn.execute('BEGIN IMMEDIATE')
+        timer = threading.Timer(0.02, conn.commit)
+        timer.start()
+        try:
+            row = keyspace.create_row(k='v')
+            self.assertEqual(keyspace[row.identifier]['k'], 'v')
+        finally:
+            timer.join()
+            conn.close()
+            db.close()
+            db.close_pool()
+
+
+@unittest.skipIf(AsyncSchemaless is None, 'asyncio front end not supported')
+class TestAsync(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.db = AsyncSchemaless(':memory:', loop=self.loop)
+        self.index = Index('data', '$.k')
+        self.keyspace = self.db.keyspace('test-keyspace', self.index)
+        self.run_async(self.keyspace.create())
+
+    def tearDown(self):
+        self.run_async(self.db.close())
+        self.loop.close()
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def collect(self, query):
+        rows = []
+        iterator = query.__aiter__()
+        while True:
+            try:
+                rows.append(self.run_async(iterator.__anext__()))
+            except StopAsyncIteration:
+                return rows
+
+    def test_rows(self):
+        row = self.run_async(self.keyspace.create_row(data={'k': 'v1'}))
+        self.assertEqual(self.run_async(row.get('data')), {'k': 'v1'})
+
+        row = self.keyspace[row.identifier]
+        self.assertEqual(self.run_async(row.get('data')), {'k': 'v1'})
+        self.run_async(row.set('other', 1))
+        self.assertEqual(self.run_async(row.items()),
+                         {'data': {'k': 'v1'}, 'other': 1})
+
+        self.run_async(row.remove('other'))
+        row = self.run_async(self.keyspace.get_row(row.identifier, True))
+        self.assertEqual(self.run_async(row.items()), {'data': {'k': 'v1'}})
+
+        rows, missing = self.run_async(
+            self.keyspace.get_many([row.identifier, 1000]))
+        self.assertEqual(self.run_async(rows[0].get('data')), {'k': 'v1'})
+        self.assertEqual(missing, [1000])
+
+        self.run_async(self.keyspace.delete(row.identifier))
+        self.assertEqual(self.run_async(self.keyspace.all()), [])
+
+    def test_query(self):
+        row_keys = self.run_async(self.keyspace.create_rows(
+            {'data': {'k': 'v%02d' % i}} for i in range(25)))
+
+        query = self.keyspace.query(self.index >= 'v10', batch_size=4)
+        rows = self.collect(query)
+        self.assertEqual([row.identifier for row in rows], row_keys[10:])
+        self.assertEqual(self.run_async(rows[0].get('data')), {'k': 'v10'})
+
+        rows = self.collect(self.keyspace.all(batch_size=5))
+        self.assertEqual([row.identifier for row in rows], row_keys)
+
+        rows = self.run_async(self.keyspace.query(self.index < 'v02'))
+        self.assertEqual([row.identifier for row in rows], row_keys[:2])
+
+    def test_handler(self):
+        events = asyncio.Queue()
+
+        # Handlers that return a coroutine are run on the event loop.
+        @self.keyspace.handler
+        def handler(row_key, column, value):
+            return events.put((row_key, column, value))
+
+        row = self.run_async(self.keyspace.create_row(data={'k': 'v'}))
+        self.assertEqual(self.run_async(events.get()),
+                         (row.identifier, 'data', {'k': 'v'}))
+
+        handler.unbind()
+        self.run_async(row.set('data', {'k': 'v2'}))
+        self.assertTrue(events.empty())
+
+    def test_query_workers(self):
+        # Batches are independent queries, so they can run on any worker.
+        tmp_dir = tempfile.mkdtemp()
+        db = AsyncSchemaless(os.path.join(tmp_dir, 'test.db'), workers=4,
+                             loop=self.loop)
+        keyspace = db.keyspace('test-keyspace', self.index)
+        try:
+            self.run_async(keyspace.create())
+            row_keys = self.run_async(keyspace.create_rows(
+                {'data': {'k': 'v%02d' % i}} for i in range(50)))
+
+            rows = self.collect(keyspace.all(batch_size=3))
+            self.assertEqual([row.identifier for row in rows], row_keys)
+
+            query = keyspace.query(self.index >= 'v10', batch_size=4)
+            rows = self.collect(query.limit(15))
+            self.assertEqual([row.identifier for row in rows],
+                             row_keys[10:25])
+
+            query = keyspace.query(
+                self.index.query('v40', '<', reverse=True), batch_size=7)
+            rows = self.collect(query)
+            self.assertEqual([row.identifier for row in rows],
+                             row_keys[:40][::-1])
+
+            # Interleaving two iterations does not share a cursor.
+            first = keyspace.all(batch_size=2).__aiter__()
+            second = keyspace.all(batch_size=2).__aiter__()
+            for row_key in row_keys[:10]:
+                row = self.run_async(first.__anext__())
+                self.assertEqual(row.identifier, row_key)
+                row = self.run_async(second.__anext__())
+                self.assertEqual(row.identifier, row_key)
+        finally:
+            self.run_async(db.close())
+            shutil.rmtree(tmp_dir)
 
 if __name__ == '__main__':
     unittest.main(argv=sys.argv)